@@ -10,10 +10,16 @@ from langchain.memory import ConversationBufferMemory
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
 from langchain_groq import ChatGroq
 from dotenv import load_dotenv
+from news_ingest import NewsIngester
 import yfinance as yf
 import re
+import sys
 import pandas as pd
 
+# The summaries of the flask app's tools, appended so that the modules of this directory come first
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "flask"))
+from tool_compaction import summarize_ohlcv  # noqa: E402
+
 load_dotenv()
 groq_api_key = os.environ["GROQ_API_KEY"]
 
@@ -44,25 +50,55 @@ def get_stock_summary(ticker):
     return summary
 
 
-def get_historical_data(ticker, period="1mo"):
+def load_historical_data(ticker, period="1mo"):
     '''
-    Provide access to historical data which could be useful for analyzing trends.
+    Load the OHLCV history of the stock.
     '''
     stock = yf.Ticker(ticker)
     hist = stock.history(period=period)
     # Drop the 'Dividends' and 'Stock Splits' columns
-    hist = hist.drop(columns=['Dividends', 'Stock Splits'])
+    return hist.drop(columns=['Dividends', 'Stock Splits'])
+
+
+def get_historical_data(ticker, period="1mo"):
+    '''
+    Provide access to historical data which could be useful for analyzing trends.
+    '''
     # Return as Markdown
-    return hist.to_markdown()
+    return load_historical_data(ticker, period).to_markdown()
 
 
-def get_latest_news(ticker):
+def summarize_historical_data(hist, precision=2):
+    '''
+    Summarize the history in a couple of lines, so the chat history sent with every
+    later question does not carry the whole table. The statistics are those the
+    assistant's tools give the model, trend included.
+    '''
+    summary = summarize_ohlcv(hist, precision)
+    if not summary["bars"]:
+        return "No history available."
+    return (f"{summary['from']} to {summary['to']}, {summary['bars']} bars: "
+            f"close {summary['first_close']:.{precision}f} -> {summary['last_close']:.{precision}f} "
+            f"({summary['return_pct']:+.{precision}f}%, {summary.get('trend', 'sideways')}), "
+            f"range {summary['low']:.{precision}f}-{summary['high']:.{precision}f}, "
+            f"max drawdown {summary['max_drawdown_pct']:.{precision}f}%, avg volume {summary.get('avg_volume', 0)}")
+
+
+def get_latest_news(ticker, query=None):
     '''
     Retrieve the latest news articles related to the stock, as traders often need to be updated with the latest market news.
+    The articles are served from the local news index, kept up to date in the background.
     '''
-    stock = yf.Ticker(ticker)
-    news_items = stock.news
-    formatted_news = [f"{item['title']}\nRead more: {item['link']}" for item in news_items]
+    news_ingester = load_news_ingester()
+    news_ingester.watch(ticker)
+    if not news_ingester.latest(ticker, n=1):
+        # First time the ticker is asked about: index it now rather than at the next poll
+        news_ingester.ingest([ticker])
+    if query:
+        articles = [document.metadata for document in news_ingester.search(query, ticker)]
+    else:
+        articles = news_ingester.latest(ticker)
+    formatted_news = [f"{article['title']}\nRead more: {article['url']}" for article in articles]
     return formatted_news
 
 
@@ -87,6 +123,8 @@ def extract_ticker(query):
 def conversation_chat(query, chain, history):
     # Initialize the response variable
     response = ""
+    # What is kept in the chat history, when it differs from the response
+    history_entry = None
 
     # Determine the type of query and process accordingly
     if "price" in query.lower():
@@ -98,15 +136,17 @@ def conversation_chat(query, chain, history):
     elif "news" in query.lower():
         ticker = extract_ticker(query)
         if ticker:
-            news = get_latest_news(ticker)
+            news = get_latest_news(ticker, query)
             response = "\n\n".join(news) if news else "No news found."
         else:
             response = "Ticker symbol not found. Please try again."
     elif "history" in query.lower():
         ticker = extract_ticker(query)
         if ticker:
-            history_data = get_historical_data(ticker, "1mo")
-            response = f"Below is the stock history in the past month for {ticker}:\n\n{history_data}"
+            hist = load_historical_data(ticker, "1mo")
+            response = f"Below is the stock history in the past month for {ticker}:\n\n{hist.to_markdown()}"
+            # The user sees the full table, later questions only carry the summary
+            history_entry = f"Stock history in the past month for {ticker}: {summarize_historical_data(hist)}"
         else:
             response = "Ticker symbol not found. Please try again."
     else:
@@ -117,7 +157,7 @@ def conversation_chat(query, chain, history):
         })
         response = result["answer"]
 
-    history.append((query, response))
+    history.append((query, history_entry or response))
     return response
 
 
@@ -187,6 +227,21 @@ def create_conversational_chain(vector_store):
     return chain
 
 
+@st.cache_resource
+def load_embedding():
+    return HuggingFaceEmbeddings(
+        model_name="sentence-transformers/all-MiniLM-L6-v2",
+        model_kwargs={"device": "cpu"}
+    )
+
+
+@st.cache_resource
+def load_news_ingester():
+    news_ingester = NewsIngester(embedding=load_embedding())
+    news_ingester.start()
+    return news_ingester
+
+
 @st.cache_resource
 def load_guideline_document():
     pdf_path = "assets/guidelines/C029-IF-on-systems-and-controls-in-an-automated-trading-environment.pdf"
@@ -201,10 +256,7 @@ def load_guideline_document():
     )
     text_chunks = text_splitter.split_documents(text)
 
-    embedding = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={"device": "cpu"}
-    )
+    embedding = load_embedding()
 
     vector_store = Chroma.from_documents(
         documents=text_chunks,
@@ -11,8 +11,9 @@ from chains.financial_review_chain import (
     vectorstore_query,
     direct_trade_query
 )
+from utils.batch_utils import shared_lookup
 
-FINANCIAL_AGENT_MODEL = "openai"
+FINANCIAL_AGENT_MODEL = os.getenv("FINANCIAL_AGENT_MODEL", "openai")
 
 financial_agent_prompt = hub.pull("hwchase17/openai-functions-agent")
 
@@ -20,6 +21,7 @@ tools = [
     Tool(
         name="Education",
         func=vectorstore_query.invoke,
+        coroutine=shared_lookup("Education", vectorstore_query.invoke),
         description="""Useful when you need to answer questions
         about general idea of the markets and trading.
         """,
@@ -27,6 +29,7 @@ tools = [
     Tool(
         name="TradeQuery",
         func=direct_trade_query.invoke,
+        coroutine=shared_lookup("TradeQuery", direct_trade_query.invoke),
         description="""Useful for suggestions about the direct
         trading queries.
         """,
@@ -36,6 +39,8 @@ tools = [
 chat_model = ChatOpenAI(
     model=FINANCIAL_AGENT_MODEL,
     temperature=0,
+    # Tokens reach the callbacks as they are generated, for the WebSocket endpoint
+    streaming=True,
 )
 
 financial_rag_agent = create_openai_functions_agent(
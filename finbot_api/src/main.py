@@ -1,6 +1,36 @@
-from fastapi import FastAPI
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from langchain_core.messages import AIMessage, HumanMessage
+
 from agents.financial_rag_agent import financial_rag_agent_executor
+from models.financial_rag_query import BatchQueryInput, QueryInput
+from utils.agent_events import AgentEventStream
 from utils.async_utils import async_retry
+from utils.batch_utils import batch_cache, normalize_query
+from utils.deadline import Deadline, DeadlineExceeded
+from utils.session_store import (
+    CachedSessionStore,
+    ConcurrentUpdateError,
+    InMemorySessionStore,
+    SQLiteSessionStore,
+)
+
+# Conversations are shared by the uvicorn workers, SESSION_STORE=memory for a single worker
+if os.getenv("SESSION_STORE", "sqlite") == "memory":
+    session_store = InMemorySessionStore()
+else:
+    session_store = CachedSessionStore(SQLiteSessionStore(os.getenv("SESSION_DB", "sessions.db")))
+
+# Upper bound of the agent runs of one batch in flight, a request can ask for fewer
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Seconds a whole batch may take, a request can ask for less
+BATCH_DEADLINE = float(os.getenv("BATCH_DEADLINE", "300"))
 
 app = FastAPI(
     title="Financial Chatbot",
@@ -8,23 +38,205 @@ app = FastAPI(
 )
 
 @async_retry(max_retries=10, delay=1)
-async def invoke_agent_with_retry(query: str):
+async def invoke_agent_with_retry(query: str, chat_history: list = None, callbacks: list = None):
     """Retry the agent if a tool fails to run.
 
     This can help when there are intermittent connection issues
-    to external APIs.
+    to external APIs. Called with a deadline keyword, the attempts
+    and the waits between them stop when it passes.
     """
-    return await financial_rag_agent_executor.ainvoke({"input": query})
+    return await financial_rag_agent_executor.ainvoke(
+        {"input": query, "chat_history": chat_history or []},
+        config={"callbacks": callbacks} if callbacks else None,
+    )
+
+async def load_chat_history(session_id: str):
+    state, version = await asyncio.to_thread(session_store.load, session_id)
+    turns = state["turns"] if state else []
+    chat_history = [
+        HumanMessage(content=text) if role == "human" else AIMessage(content=text)
+        for role, text in turns
+    ]
+    return turns, chat_history, version
+
+async def save_turn(session_id: str, turns: list, version: int, text: str, output: str):
+    turns = turns + [("human", text), ("ai", output)]
+    await asyncio.to_thread(session_store.save, session_id, {"turns": turns}, version)
 
 @app.get("/")
 async def get_status():
     return {"status": "running"}
 
 @app.post("/finbot-rag-agent")
-async def query_financial_agent(query) :
-    query_response = await invoke_agent_with_retry(query.text)
+async def query_financial_agent(query: QueryInput):
+    deadline = Deadline.for_request(query.timeout)
+    session_id = query.session_id or uuid.uuid4().hex
+    turns, chat_history, version = await load_chat_history(session_id)
+
+    steps = AgentEventStream()
+    try:
+        query_response = await invoke_agent_with_retry(
+            query.text, chat_history, callbacks=[steps], deadline=deadline
+        )
+    except DeadlineExceeded:
+        # Not saved, so that asking again starts from the same history
+        return {
+            "output": steps.partial_output(),
+            "intermediate_steps": [str(s) for s in steps.steps],
+            "partial": True,
+            "session_id": session_id,
+        }
     query_response["intermediate_steps"] = [
         str(s) for s in query_response["intermediate_steps"]
     ]
+    query_response.pop("chat_history", None)
+    query_response["partial"] = False
+
+    try:
+        await save_turn(session_id, turns, version, query.text, query_response["output"])
+    except ConcurrentUpdateError:
+        raise HTTPException(
+            status_code=409,
+            detail="The conversation was updated by another request, please retry.",
+        )
+    query_response["session_id"] = session_id
+
+    return query_response
+
+@app.post("/finbot-rag-agent/batch")
+async def query_financial_agent_batch(batch: BatchQueryInput):
+    """Answer many stateless questions in one request.
+
+    Questions are deduplicated after normalization, and the unique ones
+    run with a bounded concurrency, sharing the tool lookups. The
+    results are streamed as NDJSON in completion order, one line per
+    unique question with the positions of its duplicates.
+    """
+    unique = {}
+    for index, text in enumerate(batch.queries):
+        key = normalize_query(text)
+        if key:
+            unique.setdefault(key, (text.strip(), []))[1].append(index)
+
+    concurrency = min(batch.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    # One deadline for the batch, the questions still queued when it passes get a partial answer
+    deadline = Deadline.for_request(batch.timeout, BATCH_DEADLINE)
+
+    async def answer(text: str, indices: list):
+        submitted = time.perf_counter()
+        async with semaphore:
+            started = time.perf_counter()
+            result = {"query": text, "indices": indices}
+            steps = AgentEventStream()
+            try:
+                query_response = await invoke_agent_with_retry(
+                    text, callbacks=[steps], deadline=deadline
+                )
+                result["output"] = query_response["output"]
+                result["intermediate_steps"] = [
+                    str(s) for s in query_response["intermediate_steps"]
+                ]
+            except DeadlineExceeded:
+                result["output"] = steps.partial_output()
+                result["intermediate_steps"] = [str(s) for s in steps.steps]
+                result["partial"] = True
+            except Exception as e:
+                result["error"] = str(e)
+            finished = time.perf_counter()
+        result["queued_seconds"] = round(started - submitted, 4)
+        result["run_seconds"] = round(finished - started, 4)
+        return result
+
+    async def results():
+        # The tasks copy the context, so they all see this batch's cache
+        token = batch_cache.set({})
+        try:
+            tasks = [asyncio.create_task(answer(text, indices)) for text, indices in unique.values()]
+        finally:
+            batch_cache.reset(token)
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield json.dumps(await next_result) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.websocket("/finbot-rag-agent/ws")
+async def stream_financial_agent(websocket: WebSocket):
+    """Stream the events of the agent while it answers.
+
+    The connection is kept open for the following questions. Each
+    question is a QueryInput JSON message, answered by the tool,
+    document and token events of the run, then an "end" event with
+    the output, or an "error" event. When a failed attempt is retried, a
+    "reset" event tells the client to drop the events streamed so far.
+    When the deadline of the question passes, the "end" event has
+    partial set and the tool outputs so far.
+    """
+    await websocket.accept()
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                query = QueryInput(**json.loads(message))
+            except (TypeError, ValueError) as e:
+                # Not JSON, or not a QueryInput: the connection stays usable for the next question
+                await websocket.send_json({"event": "error", "status_code": 422, "detail": str(e)})
+                continue
+            deadline = Deadline.for_request(query.timeout)
+            session_id = query.session_id or uuid.uuid4().hex
+            try:
+                turns, chat_history, version = await load_chat_history(session_id)
+            except Exception as e:
+                # e.g. the session database is locked
+                await websocket.send_json({"event": "error", "status_code": 500, "detail": str(e)})
+                continue
+
+            stream = AgentEventStream()
+            run = asyncio.create_task(
+                invoke_agent_with_retry(
+                    query.text, chat_history, callbacks=[stream], deadline=deadline
+                )
+            )
+            try:
+                async for event in stream.events(run):
+                    await websocket.send_json(event)
+                query_response = run.result()
+                await save_turn(session_id, turns, version, query.text, query_response["output"])
+            except WebSocketDisconnect:
+                raise
+            except DeadlineExceeded:
+                # Not saved, so that asking again starts from the same history
+                await websocket.send_json({
+                    "event": "end",
+                    "output": stream.partial_output(),
+                    "intermediate_steps": [str(s) for s in stream.steps],
+                    "partial": True,
+                    "session_id": session_id,
+                })
+                continue
+            except ConcurrentUpdateError:
+                await websocket.send_json({
+                    "event": "error",
+                    "status_code": 409,
+                    "detail": "The conversation was updated by another request, please retry.",
+                })
+                continue
+            except Exception as e:
+                await websocket.send_json({"event": "error", "status_code": 500, "detail": str(e)})
+                continue
+            finally:
+                run.cancel()
 
-    return query_response
\ No newline at end of file
+            await websocket.send_json({
+                "event": "end",
+                "output": query_response["output"],
+                "intermediate_steps": [str(s) for s in query_response["intermediate_steps"]],
+                "partial": False,
+                "session_id": session_id,
+            })
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,17 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class QueryInput(BaseModel):
+    text: str
+    session_id: Optional[str] = None
+    # Seconds the client waits for the answer, capped by AGENT_DEADLINE
+    timeout: Optional[float] = None
+
+
+class BatchQueryInput(BaseModel):
+    queries: List[str]
+    concurrency: Optional[int] = None
+    # Seconds the whole batch may take, capped by BATCH_DEADLINE
+    timeout: Optional[float] = None
@@ -0,0 +1,90 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+# Only the head of the long tool outputs and documents is streamed
+MAX_EVENT_TEXT = 2000
+
+
+def _truncate(text: Any) -> str:
+    text = str(text)
+    return text if len(text) <= MAX_EVENT_TEXT else text[:MAX_EVENT_TEXT] + "..."
+
+
+def _json_value(value: Any) -> Any:
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+
+class AgentEventStream(AsyncCallbackHandler):
+    """Collect the events of an agent run as they happen.
+
+    The callbacks put JSON-ready events on a queue, which the WebSocket
+    endpoint drains while the agent is still running.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # (tool, output) of the finished tool calls, the partial answer of a run cut by its deadline
+        self.steps: List[tuple] = []
+        # The agent runs started, more than one when a failed attempt is retried
+        self.attempts = 0
+
+    def emit(self, event: str, **data):
+        self.queue.put_nowait({"event": event, **data})
+
+    async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *,
+                             parent_run_id: Optional[Any] = None, **kwargs) -> None:
+        if parent_run_id is not None:
+            return
+        if self.attempts:
+            # A retry answers again from the start, the client drops what the failed attempt streamed
+            self.steps.clear()
+            self.emit("reset", attempt=self.attempts + 1)
+        self.attempts += 1
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if token:
+            self.emit("token", text=token)
+
+    async def on_agent_action(self, action, **kwargs) -> None:
+        self.emit("agent_action", tool=action.tool, tool_input=_truncate(action.tool_input))
+
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs) -> None:
+        self.emit("tool_start", tool=(serialized or {}).get("name"), input=_truncate(input_str))
+
+    async def on_tool_end(self, output: Any, name: Optional[str] = None, **kwargs) -> None:
+        self.steps.append((name, _truncate(output)))
+        self.emit("tool_end", tool=name, output=_truncate(output))
+
+    def partial_output(self) -> str:
+        """The answer of a run stopped by its deadline, from the tool outputs it got."""
+        if not self.steps:
+            return "Sorry, I could not answer in time. Please ask again in a moment."
+        found = "\n".join(f"{tool}: {output}" for tool, output in self.steps)
+        return f"I ran out of time to write a full answer. Here is what I found:\n{found}"
+
+    async def on_tool_error(self, error: BaseException, **kwargs) -> None:
+        self.emit("tool_error", error=str(error))
+
+    async def on_retriever_end(self, documents: List[Any], **kwargs) -> None:
+        self.emit(
+            "retrieved_documents",
+            documents=[
+                {
+                    "content": _truncate(document.page_content),
+                    "metadata": {key: _json_value(value) for key, value in document.metadata.items()},
+                }
+                for document in documents
+            ],
+        )
+
+    async def events(self, task: asyncio.Task):
+        """Yield the events until the run finishes, then the ones left."""
+        while not task.done() or not self.queue.empty():
+            getter = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+            else:
+                getter.cancel()
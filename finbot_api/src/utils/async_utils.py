@@ -1,18 +1,33 @@
 import asyncio
 
+from utils.deadline import DeadlineExceeded
+
 def async_retry(max_retries: int=3, delay: int=1):
+    """Retry a coroutine function, within the deadline given as its deadline keyword.
+
+    Each attempt gets the remaining budget as timeout. An attempt cut by
+    the deadline, or a retry that would start after it, raises
+    DeadlineExceeded instead of going on.
+    """
     def decorator(func):
-        async def wrapper(*args, **kwargs):
+        async def wrapper(*args, deadline=None, **kwargs):
             for attempt in range(1, max_retries + 1):
                 try:
-                    result = await func(*args, **kwargs)
-                    return result
+                    if deadline is None:
+                        return await func(*args, **kwargs)
+                    # Before the coroutine is created, so that none is left unawaited past the deadline
+                    timeout = deadline.timeout()
+                    return await asyncio.wait_for(func(*args, **kwargs), timeout)
+                except DeadlineExceeded:
+                    raise
                 except Exception as e:
-                    print(f"Attempt {attempt} failed: {str(e)}")
-                    await asyncio.sleep(delay)
+                    print(f"Attempt {attempt} failed: {str(e) or type(e).__name__}")
+                    if deadline is not None and deadline.remaining() <= delay:
+                        raise DeadlineExceeded(f"Deadline of {deadline.budget}s reached after {attempt} attempts") from e
+                await asyncio.sleep(delay)
 
             raise ValueError(f"Failed after {max_retries} attempts")
 
         return wrapper
 
-    return decorator
\ No newline at end of file
+    return decorator
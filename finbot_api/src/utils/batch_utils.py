@@ -0,0 +1,38 @@
+import asyncio
+import re
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+# Results of the tool lookups shared by the queries of the current batch
+batch_cache: ContextVar[Optional[dict]] = ContextVar("batch_cache", default=None)
+
+
+def normalize_query(text: str) -> str:
+    """Collapse the whitespace and case, so repeated questions match."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def shared_lookup(name: str, func: Callable):
+    """Wrap a blocking tool function so the queries of a batch share its results.
+
+    Inside a batch, the first call for an input runs the function in a
+    thread and the identical calls await the same result. Outside of
+    a batch every call runs the function.
+    """
+
+    async def lookup(query: str):
+        cache = batch_cache.get()
+        if cache is None:
+            return await asyncio.to_thread(func, query)
+
+        key = (name, normalize_query(str(query)))
+        future = cache.get(key)
+        if future is None:
+            future = cache[key] = asyncio.ensure_future(asyncio.to_thread(func, query))
+            # A failed lookup is retried by the next query instead of shared
+            future.add_done_callback(
+                lambda done: cache.pop(key, None) if done.cancelled() or done.exception() else None
+            )
+        return await asyncio.shield(future)
+
+    return lookup
@@ -0,0 +1,38 @@
+import os
+import time
+from typing import Optional
+
+# Seconds an agent run may take, a client can ask for less
+AGENT_DEADLINE = float(os.getenv("AGENT_DEADLINE", "60"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the time budget of a request runs out."""
+
+
+class Deadline:
+    """The time budget of a request, carried through its stages.
+
+    Each stage (an agent attempt, the wait before a retry) takes its
+    timeout from the remaining budget, so a request never runs longer
+    than the budget whatever the retries.
+    """
+
+    def __init__(self, budget: float = AGENT_DEADLINE):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    @classmethod
+    def for_request(cls, requested: Optional[float] = None, limit: float = AGENT_DEADLINE) -> "Deadline":
+        """The deadline of a request, the client's own when it is shorter."""
+        return cls(min(requested, limit) if requested else limit)
+
+    def remaining(self) -> float:
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def timeout(self, reserve: float = 0.0, minimum: float = 0.05) -> float:
+        """The seconds the next stage may take, keeping reserve for the following ones."""
+        timeout = self.remaining() - reserve
+        if timeout < minimum:
+            raise DeadlineExceeded(f"Deadline of {self.budget}s reached")
+        return timeout
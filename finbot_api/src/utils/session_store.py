@@ -0,0 +1,165 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class ConcurrentUpdateError(Exception):
+    """The session was saved by another worker since it was loaded."""
+
+
+def serialize(state: dict) -> bytes:
+    if msgpack is not None:
+        return b"m" + msgpack.packb(state, use_bin_type=True)
+    return b"j" + json.dumps(state, separators=(",", ":")).encode()
+
+
+def deserialize(data: bytes) -> dict:
+    data = bytes(data)
+    if data[:1] == b"m":
+        return msgpack.unpackb(data[1:], raw=False)
+    return json.loads(data[1:])
+
+
+class SessionStore:
+    """Conversation state shared by the workers, with optimistic concurrency.
+
+    Every save bumps the version of the session and is only accepted if
+    the session is still at the version it was loaded at.
+    """
+
+    def load(self, session_id: str) -> tuple:
+        """Return (state, version), (None, 0) for a new session."""
+        raise NotImplementedError
+
+    def version(self, session_id: str) -> int:
+        raise NotImplementedError
+
+    def save(self, session_id: str, state: dict, expected_version: int) -> int:
+        """Save the state and return the new version, or raise ConcurrentUpdateError."""
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """Sessions of a single worker process."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def load(self, session_id: str) -> tuple:
+        with self.lock:
+            data, version = self.sessions.get(session_id, (None, 0))
+        return (deserialize(data) if data is not None else None), version
+
+    def version(self, session_id: str) -> int:
+        with self.lock:
+            return self.sessions.get(session_id, (None, 0))[1]
+
+    def save(self, session_id: str, state: dict, expected_version: int) -> int:
+        data = serialize(state)
+        with self.lock:
+            version = self.sessions.get(session_id, (None, 0))[1]
+            if version != expected_version:
+                raise ConcurrentUpdateError(f"Session {session_id} is at version {version}")
+            self.sessions[session_id] = (data, version + 1)
+            return version + 1
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in an embedded SQLite database in WAL mode, shared by the workers of a machine."""
+
+    def __init__(self, path: str = "sessions.db", timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def load(self, session_id: str) -> tuple:
+        row = self._connection().execute(
+            "SELECT data, version FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        return (deserialize(row[0]), row[1]) if row else (None, 0)
+
+    def version(self, session_id: str) -> int:
+        row = self._connection().execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, session_id: str, state: dict, expected_version: int) -> int:
+        data = serialize(state)
+        connection = self._connection()
+        with connection:
+            if expected_version == 0:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO sessions (id, version, data, updated) VALUES (?, 1, ?, ?)",
+                    (session_id, data, time.time()),
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE sessions SET version = version + 1, data = ?, updated = ? WHERE id = ? AND version = ?",
+                    (data, time.time(), session_id, expected_version),
+                )
+        if cursor.rowcount != 1:
+            raise ConcurrentUpdateError(f"Session {session_id} is not at version {expected_version} anymore")
+        return expected_version + 1
+
+
+class CachedSessionStore(SessionStore):
+    """Per worker read-through cache: only the version is read while it is up to date."""
+
+    def __init__(self, store: SessionStore, max_sessions: int = 1024):
+        self.store = store
+        self.max_sessions = max_sessions
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, session_id: str) -> tuple:
+        version = self.store.version(session_id)
+        with self.lock:
+            cached = self.cache.get(session_id)
+            if cached is not None and cached[1] == version:
+                self.cache.move_to_end(session_id)
+                return deserialize(cached[0]), version
+        state, version = self.store.load(session_id)
+        if state is not None:
+            self._remember(session_id, serialize(state), version)
+        return state, version
+
+    def version(self, session_id: str) -> int:
+        return self.store.version(session_id)
+
+    def save(self, session_id: str, state: dict, expected_version: int) -> int:
+        try:
+            version = self.store.save(session_id, state, expected_version)
+        except ConcurrentUpdateError:
+            with self.lock:
+                self.cache.pop(session_id, None)
+            raise
+        self._remember(session_id, serialize(state), version)
+        return version
+
+    def _remember(self, session_id: str, data: bytes, version: int):
+        with self.lock:
+            self.cache[session_id] = (data, version)
+            self.cache.move_to_end(session_id)
+            while len(self.cache) > self.max_sessions:
+                self.cache.popitem(last=False)
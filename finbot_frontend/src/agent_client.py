@@ -0,0 +1,75 @@
+import json
+import queue
+import time
+
+import websocket
+
+
+class AgentConnectionPool:
+    """A pool of persistent WebSocket connections to the agent API.
+
+    Connections are opened on demand, reused across questions and
+    Streamlit reruns, and dropped when they fail. Each question is
+    sent with timeout as its deadline, and the answer is awaited for
+    at most timeout plus grace seconds, the time for the API to send
+    its partial answer.
+    """
+
+    def __init__(self, url: str, size: int = 4, timeout: float = 60, grace: float = 5):
+        self.url = url
+        self.timeout = timeout
+        self.grace = grace
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return websocket.create_connection(self.url, timeout=self.timeout)
+
+    def _release(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def ask(self, text: str, session_id: str = None):
+        """Send a question and yield the events of the answer as they arrive.
+
+        The last event is "end" or "error". A connection that was
+        closed while idle is replaced once before giving up, and
+        WebSocketTimeoutException is raised once the deadline passes.
+        """
+        message = json.dumps({"text": text, "session_id": session_id, "timeout": self.timeout})
+        expires = time.monotonic() + self.timeout + self.grace
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                connection.settimeout(max(expires - time.monotonic(), 0.1))
+                connection.send(message)
+                event = json.loads(connection.recv())
+                break
+            except websocket.WebSocketTimeoutException:
+                # The question was sent, asking it again would run it twice
+                connection.close()
+                raise
+            except (websocket.WebSocketException, OSError):
+                connection.close()
+                if attempt:
+                    raise
+
+        try:
+            while True:
+                yield event
+                if event["event"] in ("end", "error"):
+                    break
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    raise websocket.WebSocketTimeoutException("No answer within the deadline")
+                connection.settimeout(remaining)
+                event = json.loads(connection.recv())
+        except BaseException:
+            # Unread events would be taken for the answer to the next question
+            connection.close()
+            raise
+        self._release(connection)
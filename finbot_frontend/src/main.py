@@ -1,8 +1,29 @@
 import os
-import requests
 import streamlit as st
 
-CHATBOT_URL = os.getenv("FINBOT_URL", "http://localhost:8000/financial-rag-agent")
+from agent_client import AgentConnectionPool
+
+CHATBOT_WS_URL = os.getenv("FINBOT_WS_URL", "ws://localhost:8000/finbot-rag-agent/ws")
+# Seconds a question may take, the API sends what it has by then
+CHATBOT_TIMEOUT = float(os.getenv("FINBOT_TIMEOUT", "60"))
+
+
+@st.cache_resource
+def get_connection_pool():
+    # Shared by all the browser sessions, the connections outlive the reruns
+    return AgentConnectionPool(CHATBOT_WS_URL, timeout=CHATBOT_TIMEOUT)
+
+
+def render_event(event):
+    if event["event"] == "tool_start":
+        st.markdown(f"**Using {event['tool']}** with `{event['input']}`")
+    elif event["event"] == "tool_end":
+        st.info(event["output"])
+    elif event["event"] == "tool_error":
+        st.error(event["error"])
+    elif event["event"] == "retrieved_documents":
+        for document in event["documents"]:
+            st.caption(document["content"])
 
 with st.sidebar:
     st.header("About")
@@ -43,22 +64,40 @@ if prompt := st.chat_input("What do you want to know?"):
 
     st.session_state.messages.append({"role": "user", "output": prompt})
 
-    data = {"text": prompt}
-
-    with st.spinner("Searching for an answer..."):
-        response = requests.post(CHATBOT_URL, json=data)
-
-        if response.status_code == 200:
-            output_text = response.json()["output"]
-            explanation = response.json()["intermediate_steps"]
+    output_text = """An error occurred while processing your message.
+    Please try again or rephrase your message."""
+    explanation = output_text
 
-        else:
-            output_text = """An error occurred while processing your message.
-            Please try again or rephrase your message."""
-            explanation = output_text
+    with st.chat_message("assistant"):
+        answer = st.empty()
+        status = st.status("How was this generated", expanded=True)
+        tokens = ""
+        try:
+            events = get_connection_pool().ask(prompt, st.session_state.get("session_id"))
+            for event in events:
+                if event["event"] == "token":
+                    tokens += event["text"]
+                    answer.markdown(tokens)
+                elif event["event"] == "reset":
+                    # The agent is answering again after a failed attempt
+                    tokens = ""
+                    answer.empty()
+                    with status:
+                        st.caption(f"Retrying, attempt {event['attempt']}.")
+                elif event["event"] == "end":
+                    output_text = event["output"]
+                    explanation = event["intermediate_steps"]
+                    st.session_state.session_id = event["session_id"]
+                    if event.get("partial"):
+                        st.caption("The answer was cut short to keep within the time limit.")
+                elif event["event"] != "error":
+                    with status:
+                        render_event(event)
+        except Exception as e:
+            print(f"Agent request failed: {str(e)}")
 
-    st.chat_message("assistant").markdown(output_text)
-    st.status("How was this generated", state="complete").info(explanation)
+        answer.markdown(output_text)
+        status.update(state="complete", expanded=False)
 
     st.session_state.messages.append(
         {
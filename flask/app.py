@@ -1,8 +1,68 @@
-from flask import Flask, request, render_template_string
+import contextlib
+import json
+import logging
+import os
+import threading
+import uuid
+from flask import Flask, Response, request, render_template_string, make_response
+from compute_pool import default_pool
+from conversation_flow import AWAITING_CONFIRMATION
+from deadline import TURN_BUDGET, Deadline
+from model_router import default_router
 from trade_agent import GPTAssistant  # Make sure to update the import path if necessary
+from paper_trading import default_engine
+from prefetch import default_prefetcher
+from price_feed import default_feed, SimulatedSource, YFinancePoller
+from session_store import CachedSessionStore, ConcurrentUpdateError, InMemorySessionStore, SQLiteSessionStore
+from trade_ledger import TradeLedger
+
+# LOG_LEVEL=INFO shows the model routes and the tool result reports
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+
+# Fork the compute workers of the backtest sweeps first, before any background thread is started
+default_pool.start()
+
+# Restore the paper-trading accounts from the durable ledger before serving. The workers share
+# the ledger: each order first applies the trades the other workers logged, then logs its own
+trade_ledger = TradeLedger(os.getenv("TRADE_LEDGER_DIR", "trade_ledger"), shared=True)
+trade_ledger.recover(default_engine)
+default_engine.ledger = trade_ledger
+
+# PRICE_FEED=simulated runs without network access, e.g. for demos and tests
+if os.getenv("PRICE_FEED", "yfinance") == "simulated":
+    default_feed.start(SimulatedSource(interval=1.0))
+else:
+    default_feed.start(YFinancePoller(interval=float(os.getenv("PRICE_FEED_INTERVAL", "15"))))
+
+# Conversations outlive restarts in SQLite, SESSION_STORE=memory to keep them in memory only
+if os.getenv("SESSION_STORE", "sqlite") == "memory":
+    session_store = InMemorySessionStore()
+else:
+    session_store = CachedSessionStore(SQLiteSessionStore(os.getenv("SESSION_DB", "sessions.db")))
+SESSION_COOKIE = "finbot_session"
+# One turn at a time per session in a worker, two tabs of a chat never run concurrent turns.
+# Turns of a session on two workers are caught by the version check of the session store.
+SESSION_LOCKS = {}  # session id -> [lock, number of requests using it]
+SESSION_LOCKS_GUARD = threading.Lock()
+
+
+@contextlib.contextmanager
+def session_lock(session_id):
+    # The lock of a session only lives while requests of the session use it
+    with SESSION_LOCKS_GUARD:
+        entry = SESSION_LOCKS.setdefault(session_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with SESSION_LOCKS_GUARD:
+            entry[1] -= 1
+            if not entry[1]:
+                del SESSION_LOCKS[session_id]
+
 
 app = Flask(__name__)
-assistant = GPTAssistant()
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -94,8 +154,25 @@ HTML_TEMPLATE = """
     </div>
 
     <script>
+        var priceStream = null;
+
+        // Keep the price of a trade awaiting confirmation live under its prompt
+        function watchPrice(symbol, botDiv) {
+            var priceDiv = document.createElement('div');
+            botDiv.appendChild(priceDiv);
+            priceStream = new EventSource('/prices?symbols=' + encodeURIComponent(symbol));
+            priceStream.onmessage = function(event) {
+                var quote = JSON.parse(event.data);
+                priceDiv.textContent = 'Live price of ' + quote.symbol + ': ' + quote.price.toFixed(2);
+            };
+        }
+
         function sendMessage() {
             var input = document.getElementById('user_input');
+            if (priceStream) {
+                priceStream.close();
+                priceStream = null;
+            }
             var chat = document.getElementById('chat');
             if(input.value.trim() !== '') {
                 var userDiv = document.createElement('div');
@@ -117,6 +194,9 @@ HTML_TEMPLATE = """
                     botDiv.textContent = data.response;
                     botDiv.className = 'message bot';
                     chat.appendChild(botDiv);
+                    if (data.pending_symbol) {
+                        watchPrice(data.pending_symbol, botDiv);
+                    }
                     chat.scrollTop = chat.scrollHeight; // Ensure new messages are seen
                 });
 
@@ -131,10 +211,55 @@ HTML_TEMPLATE = """
 @app.route('/', methods=['GET', 'POST'])
 def home():
     if request.method == 'POST':
+        # The budget of the turn starts with the request, the session load included
+        deadline = Deadline(TURN_BUDGET)
         user_input = request.json['user_input']
-        response = assistant.conversation(user_input)
-        return {'response': response}
+        session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+        with session_lock(session_id):
+            state, version = session_store.load(session_id)
+            assistant = GPTAssistant(session_id=session_id)
+            if state is not None:
+                assistant.load_state(state)
+            response = assistant.conversation(user_input, deadline=deadline)
+            try:
+                session_store.save(session_id, assistant.dump_state(), version)
+            except ConcurrentUpdateError:
+                if assistant.traded:
+                    # Sending the message again would trade twice
+                    return {'response': f"{response} (This conversation was also updated from another window, "
+                                        "this reply is not kept in its history.)"}
+                return {'response': "This conversation was updated from another window, please send your message again."}, 409
+        pending = assistant.flow.pending if assistant.flow.state == AWAITING_CONFIRMATION else None
+        result = make_response({'response': response, 'pending_symbol': pending and pending['stock_name']})
+        result.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="Lax")
+        return result
     return render_template_string(HTML_TEMPLATE, response=None)
 
+@app.route('/prices', methods=['GET'])
+def prices():
+    # Server-sent events of the last trades of a few symbols, the latest known quotes first
+    symbols = [symbol for symbol in request.args.get('symbols', '').split(',') if symbol.strip()][:10]
+    if not symbols:
+        return {'error': 'No symbols given'}, 400
+
+    def events():
+        for symbol in symbols:
+            quote = default_feed.last(symbol, max_age=None)
+            if quote is not None:
+                yield f"data: {json.dumps(quote._asdict())}\n\n"
+        for quotes in default_feed.updates(symbols):
+            if not quotes:
+                yield ": keep-alive\n\n"
+            for quote in quotes.values():
+                yield f"data: {json.dumps(quote._asdict())}\n\n"
+
+    return Response(events(), mimetype='text/event-stream')
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return {'prefetch': default_prefetcher.stats(), 'models': default_router.report()}
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # The reloader would run this module again in a child process, with a second compute
+    # pool, price feed and ledger recovery
+    app.run(debug=True, use_reloader=False)
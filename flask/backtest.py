@@ -0,0 +1,277 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from compute_pool import default_pool
+from indicators import _fill_gaps, ema, sma
+from market_data import normalize_symbols
+from portfolio_risk import download_closes
+
+TRADING_DAYS = 252
+_METRIC_BLOCK = 4
+METRICS = ("total_return", "cagr", "volatility", "sharpe", "max_drawdown", "trades", "exposure")
+
+# The parameter grids swept by the tool, small enough to answer within a turn
+DEFAULT_GRIDS = {
+    "buy_and_hold": [()],
+    "ma_crossover": [(fast, slow) for fast, slow in itertools.product((5, 10, 20, 50), (50, 100, 200)) if fast < slow],
+    "rsi": list(itertools.product((14,), (20, 25, 30, 35), (60, 70, 80))),
+}
+GRID_PARAMETERS = {
+    "buy_and_hold": (),
+    "ma_crossover": ("fast", "slow"),
+    "rsi": ("period", "lower", "upper"),
+}
+
+
+def _latch(entries, exits):
+    # Position 1 from an entry until the next exit, 0 before the first entry
+    signals = np.where(entries, 1.0, np.where(exits, 0.0, np.nan))
+    last = np.where(~np.isnan(signals), np.arange(signals.shape[-1]), -1)
+    np.maximum.accumulate(last, axis=-1, out=last)
+    held = np.take_along_axis(np.nan_to_num(signals), np.maximum(last, 0), axis=-1)
+    return np.where(last >= 0, held, 0.0)
+
+
+def _rsi(closes, period):
+    change = np.diff(closes, axis=-1, prepend=closes[..., :1])
+    gain = ema(np.maximum(change, 0), 1 / period)
+    loss = ema(np.maximum(-change, 0), 1 / period)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(loss > 0, 100 - 100 / (1 + gain / loss), np.where(gain > 0, 100.0, 50.0))
+
+
+def strategy_positions(strategy, closes, grid):
+    """
+    Compute the positions of a strategy for every set of parameters, on every ticker.
+
+    A position is decided on the close of a bar and held over the next one.
+
+    Parameters:
+        strategy (str): buy_and_hold, ma_crossover or rsi.
+        closes (np.ndarray): The (tickers, bars) closes, without missing values.
+        grid (list): The parameter tuples, see GRID_PARAMETERS.
+
+    Returns:
+        positions (np.ndarray): The (parameters, tickers, bars) positions, 1 in the market and 0 out.
+    """
+    if strategy == "buy_and_hold":
+        return np.ones((len(grid),) + closes.shape)
+    if strategy == "ma_crossover":
+        windows = sorted({window for pair in grid for window in pair})
+        averages = {window: sma(closes, window) for window in windows}
+        # NaN comparisons are False: out of the market until both averages exist
+        return np.stack([(averages[fast] > averages[slow]).astype(float) for fast, slow in grid])
+    if strategy == "rsi":
+        indices = {period: _rsi(closes, period) for period in {period for period, _, _ in grid}}
+        return np.stack([_latch(indices[period] < lower, indices[period] > upper) for period, lower, upper in grid])
+    raise ValueError(f"Unknown strategy {strategy}")
+
+
+def backtest_metrics(closes, positions, fee=0.001, slippage=0.0005, start=None):
+    """
+    Compute the performance of positions over closes, net of fees and slippage.
+
+    Parameters:
+        closes (np.ndarray): The (tickers, bars) closes.
+        positions (np.ndarray): The (..., tickers, bars) positions.
+        fee (float): The fee per trade, as a fraction of the traded value.
+        slippage (float): The slippage per trade, as a fraction of the price.
+        start (np.ndarray): The (tickers,) first bar of each ticker, 0 by default.
+
+    Returns:
+        metrics (np.ndarray): The (..., tickers, len(METRICS)) metrics.
+    """
+    returns = closes[..., 1:] / closes[..., :-1] - 1
+    turnover = np.abs(np.diff(positions, axis=-1, prepend=0.0))
+    # Held over a bar from the previous close, trading costs paid on the bar after the trade
+    strategy_returns = positions[..., :-1] * returns - (fee + slippage) * turnover[..., :-1]
+    equity = np.cumprod(1 + strategy_returns, axis=-1)
+    start = np.zeros(closes.shape[:-1], dtype=int) if start is None else np.asarray(start)
+    # The statistics of a ticker only cover the bars since it started trading
+    valid = np.arange(returns.shape[-1]) >= start[..., None]
+    bars = np.maximum(valid.sum(axis=-1), 1)
+    years = bars / TRADING_DAYS
+    total = equity[..., -1] - 1
+    mean = np.where(valid, strategy_returns, 0.0).sum(axis=-1) / bars
+    deviation = np.sqrt(np.where(valid, (strategy_returns - mean[..., None]) ** 2, 0.0).sum(axis=-1) / bars)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpe = np.where(deviation > 0, mean / deviation * np.sqrt(TRADING_DAYS), 0.0)
+    drawdown = (equity / np.maximum.accumulate(equity, axis=-1) - 1).min(axis=-1)
+    trades = (np.diff(positions, axis=-1, prepend=0.0)[..., :-1] > 0).sum(axis=-1)
+    return np.stack([
+        total,
+        np.sign(1 + total) * np.abs(1 + total) ** (1 / years) - 1,
+        deviation * np.sqrt(TRADING_DAYS),
+        sharpe,
+        drawdown,
+        trades,
+        np.where(valid, positions[..., :-1], 0.0).sum(axis=-1) / bars,
+    ], axis=-1)
+
+
+def sweep_statistics(output, closes, strategy, grid, fee=0.001, slippage=0.0005):
+    """
+    Backtest a parameter grid on several tickers, in a compute pool worker.
+
+    Parameters:
+        output (np.ndarray): The (parameters, tickers, len(METRICS)) metrics to fill.
+        closes (np.ndarray): The (tickers, bars) closes, NaN before the first bar of a ticker.
+        strategy (str): The strategy.
+        grid (list): The parameter tuples.
+        fee (float): The fee per trade.
+        slippage (float): The slippage per trade.
+    """
+    filled, leading = _fill_gaps(closes)
+    positions = strategy_positions(strategy, filled, grid)
+    # Nothing is held before a ticker starts trading
+    positions[:, leading] = 0.0
+    # A few parameter sets at a time keep the temporaries of the metrics in cache
+    for start in range(0, len(grid), _METRIC_BLOCK):
+        block = slice(start, start + _METRIC_BLOCK)
+        output[block] = backtest_metrics(filled, positions[block], fee, slippage, start=leading.sum(axis=-1))
+
+
+class Backtester:
+    """
+    Rule based strategy backtests over the daily closes of yfinance.
+
+    The closes are cached per ticker, and a parameter sweep is split by ticker
+    over the workers of the compute pool.
+
+    Attributes:
+        pool (ComputePool): The pool running the sweeps.
+        ttl (float): The seconds the downloaded closes are kept.
+        fee (float): The fee per trade.
+        slippage (float): The slippage per trade.
+    """
+
+    def __init__(self, pool=None, ttl=6 * 3600, fee=0.001, slippage=0.0005, downloader=download_closes):
+        self.pool = pool or default_pool
+        self.ttl = ttl
+        self.fee = fee
+        self.slippage = slippage
+        self.downloader = downloader
+        self.closes = {}
+        self.lock = threading.Lock()
+
+    def load(self, symbols, period="5y"):
+        """
+        Get the closes of several tickers, downloading the ones not cached.
+
+        Parameters:
+            symbols (list): The symbols.
+            period (str): The history.
+
+        Returns:
+            (symbols, closes) (tuple): The symbols found and their (tickers, bars) closes aligned on the dates.
+        """
+        now = time.time()
+        with self.lock:
+            missing = [symbol for symbol in symbols
+                       if (symbol, period) not in self.closes or now - self.closes[(symbol, period)][0] > self.ttl]
+        if missing:
+            frame = self.downloader(missing, period)
+            with self.lock:
+                for symbol in missing:
+                    if symbol in frame and frame[symbol].notna().any():
+                        self.closes[(symbol, period)] = (now, frame[symbol].dropna())
+        with self.lock:
+            series = [(symbol, self.closes[(symbol, period)][1]) for symbol in symbols if (symbol, period) in self.closes]
+        if not series:
+            return [], np.empty((0, 0))
+        dates = sorted(set().union(*(values.index for _, values in series)))
+        closes = np.stack([values.reindex(dates).to_numpy(dtype=float) for _, values in series])
+        return [symbol for symbol, _ in series], closes
+
+    def sweep(self, closes, strategy, grid=None, chunks=None):
+        """
+        Backtest every parameter set of a grid on every ticker.
+
+        Parameters:
+            closes (np.ndarray): The (tickers, bars) closes.
+            strategy (str): The strategy.
+            grid (list): The parameter tuples, DEFAULT_GRIDS[strategy] by default.
+            chunks (int): The number of pool tasks, one per worker by default.
+
+        Returns:
+            metrics (np.ndarray): The (parameters, tickers, len(METRICS)) metrics.
+        """
+        if strategy not in GRID_PARAMETERS:
+            raise ValueError(f"Unknown strategy {strategy}")
+        grid = list(DEFAULT_GRIDS[strategy] if grid is None else grid)
+        chunks = max(min(chunks or self.pool.max_workers, closes.shape[0]), 1)
+        parts = np.array_split(np.arange(closes.shape[0]), chunks)
+
+        def run(rows):
+            return self.pool.run(
+                sweep_statistics, {"closes": closes[rows]}, output_shape=(len(grid), len(rows), len(METRICS)),
+                strategy=strategy, grid=grid, fee=self.fee, slippage=self.slippage,
+            )
+
+        # One thread per task only waits on its worker, the pool runs them in parallel
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            results = list(executor.map(run, parts))
+        return np.concatenate(results, axis=1)
+
+    def evaluate(self, symbols, strategy, period="5y", precision=2):
+        """
+        Sweep the default grid of a strategy on several stocks and compare it with buy and hold.
+
+        Parameters:
+            symbols (list): The symbols, or a comma separated string.
+            strategy (str): ma_crossover, rsi or buy_and_hold.
+            period (str): The history, e.g. 1y, 5y, 10y.
+            precision (int): The number of decimals to keep.
+
+        Returns:
+            table (str): The summary given to the model.
+        """
+        symbols, closes = self.load(normalize_symbols(symbols), period)
+        if not symbols:
+            return "Stock data not found. Please try again."
+        hold = self.sweep(closes, "buy_and_hold")
+        metrics = hold if strategy == "buy_and_hold" else self.sweep(closes, strategy)
+        return format_backtest(symbols, strategy, DEFAULT_GRIDS[strategy], metrics, hold, precision)
+
+
+def format_backtest(symbols, strategy, grid, metrics, hold_metrics, precision=2):
+    """
+    Summarize a sweep for the model: the best parameters of each ticker against buy and hold.
+
+    Parameters:
+        symbols (list): The symbols.
+        strategy (str): The strategy.
+        grid (list): The parameter tuples.
+        metrics (np.ndarray): The (parameters, tickers, len(METRICS)) metrics of the strategy.
+        hold_metrics (np.ndarray): The (1, tickers, len(METRICS)) metrics of buy and hold.
+        precision (int): The number of decimals to keep.
+
+    Returns:
+        table (str): One line per ticker and a note on the assumptions.
+    """
+    names = GRID_PARAMETERS[strategy]
+    sharpe = METRICS.index("sharpe")
+    lines = ["symbol|params|cagr_pct|max_dd_pct|sharpe|trades|exposure_pct|hold_cagr_pct|hold_max_dd_pct|median_cagr_pct"]
+    for column, symbol in enumerate(symbols):
+        best = int(np.argmax(metrics[:, column, sharpe]))
+        values = dict(zip(METRICS, metrics[best, column]))
+        hold = dict(zip(METRICS, hold_metrics[0, column]))
+        params = ",".join(f"{name}={value}" for name, value in zip(names, grid[best])) or "-"
+        median = np.median(metrics[:, column, METRICS.index("cagr")])
+        lines.append("|".join([
+            symbol, params, f"{values['cagr'] * 100:.{precision}f}", f"{values['max_drawdown'] * 100:.{precision}f}",
+            f"{values['sharpe']:.{precision}f}", str(int(values["trades"])), f"{values['exposure'] * 100:.0f}",
+            f"{hold['cagr'] * 100:.{precision}f}", f"{hold['max_drawdown'] * 100:.{precision}f}",
+            f"{median * 100:.{precision}f}",
+        ]))
+    lines.append(f"Best of {len(grid)} parameter sets by Sharpe, in-sample: past results do not predict future ones. "
+                 f"Fees and slippage included.")
+    return "\n".join(lines)
+
+
+# Backtester shared by the chat sessions of the process
+default_backtester = Backtester()
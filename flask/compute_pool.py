@@ -0,0 +1,157 @@
+import multiprocessing as mp
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# State loaded once per worker process by the initializer, e.g. models and caches
+worker_state = {}
+
+
+class SharedArray:
+    """
+    A NumPy array in shared memory, owned by the process that created it.
+
+    Only its handle (segment name, shape and dtype) is sent to the workers, which
+    map the same memory instead of receiving a pickled copy.
+    """
+
+    def __init__(self, array=None, shape=None, dtype=np.float64):
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            shape, dtype = array.shape, array.dtype
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        if array is not None:
+            self.array[...] = array
+
+    @property
+    def handle(self):
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach(handle):
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    # The creating process owns the segment: keep the worker's resource tracker
+    # from unlinking it or reporting it as leaked
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf), shm
+
+
+def _initialize_worker(preload):
+    # Warm the heavy imports and load the per worker state once
+    import pandas  # noqa: F401
+    for name, loader in preload:
+        worker_state[name] = loader()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _call(func, handles, output_handle, kwargs):
+    segments = []
+    try:
+        arrays = {}
+        for name, handle in handles.items():
+            arrays[name], shm = _attach(handle)
+            segments.append(shm)
+        output, shm = _attach(output_handle)
+        segments.append(shm)
+        func(output, **arrays, **kwargs)
+    finally:
+        for shm in segments:
+            shm.close()
+
+
+class ComputePool:
+    """
+    A warm process pool for the CPU-bound analytics of the web server.
+
+    Running pandas and NumPy work in worker processes keeps it from holding the
+    GIL of the request threads. The workers are started and initialized once,
+    and the arrays go through shared memory in both directions.
+
+    Attributes:
+        max_workers (int): The number of worker processes.
+        preload (list): (name, loader) pairs run once per worker into worker_state.
+    """
+
+    def __init__(self, max_workers=None, preload=()):
+        self.max_workers = max_workers or max(os.cpu_count() - 1, 1)
+        self.preload = list(preload)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start and warm up the workers.
+
+        Call it before starting any thread: the workers are forked where possible.
+        """
+        with self.lock:
+            if self.executor is not None:
+                return
+            methods = mp.get_all_start_methods()
+            context = mp.get_context("fork" if "fork" in methods else methods[0])
+            executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=context,
+                initializer=_initialize_worker,
+                initargs=(self.preload,),
+            )
+            # One task per worker so that they are all up before the first request
+            wait([executor.submit(_ping) for _ in range(self.max_workers)])
+            self.executor = executor
+
+    def run(self, func, arrays, output_shape, output_dtype=np.float64, timeout=None, **kwargs):
+        """
+        Run a function on shared arrays in a worker.
+
+        Parameters:
+            func: A module level function taking the output array, then the input arrays by name.
+            arrays (dict): The input NumPy arrays by name.
+            output_shape (tuple): The shape of the output array.
+            output_dtype: The dtype of the output array.
+            timeout (float): The seconds to wait for the result.
+
+        Returns:
+            output (np.ndarray): The output array filled by the function.
+        """
+        self.start()
+        inputs = {name: SharedArray(array) for name, array in arrays.items()}
+        try:
+            with SharedArray(shape=output_shape, dtype=output_dtype) as output:
+                handles = {name: shared.handle for name, shared in inputs.items()}
+                self.executor.submit(_call, func, handles, output.handle, kwargs).result(timeout)
+                return output.array.copy()
+        finally:
+            for shared in inputs.values():
+                shared.close()
+
+    def shutdown(self):
+        """Stop the workers."""
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
+# Pool shared by the request threads of the process
+default_pool = ComputePool(max_workers=int(os.getenv("COMPUTE_WORKERS", "0")) or None)
@@ -0,0 +1,284 @@
+import re
+
+PROFILE = "profile"
+READY = "ready"
+AWAITING_CONFIRMATION = "awaiting_confirmation"
+
+EXPERIENCE_PATTERNS = (
+    ("beginner", re.compile(r"\b(beginner|novice|new to|no experience|never|first time|none|zero)\b", re.I)),
+    ("intermediate", re.compile(r"\b(intermediate|some experience|a (little|bit)|few (months|years))\b", re.I)),
+    ("experienced", re.compile(r"\b(experienced|expert|advanced|professional|many years|\d+ years)\b", re.I)),
+)
+RISK_PATTERNS = (
+    ("low", re.compile(r"\b(low|conservative|safe|minimal|little risk)\b", re.I)),
+    ("medium", re.compile(r"\b(medium|moderate|balanced|average|mid)\b", re.I)),
+    ("high", re.compile(r"\b(high|aggressive|risky|a lot of risk)\b", re.I)),
+)
+AMOUNT = re.compile(
+    r"(?:[$£€]\s?(?P<prefixed>\d[\d,]*(?:\.\d+)?)\s*(?P<prefixed_unit>k|thousand)?"
+    r"|(?P<suffixed>\d[\d,]*(?:\.\d+)?)\s*(?P<suffixed_unit>k|thousand)?\s*(?:dollars|usd|bucks|pounds|euros|gbp|eur))\b",
+    re.I,
+)
+NUMBER = re.compile(r"^\s*[$£€]?\s?(\d[\d,]*(?:\.\d+)?)\s*(k|thousand)?\s*$", re.I)
+ACTION = re.compile(r"\b(buy|purchase|sell)\b", re.I)
+QUANTITY = re.compile(r"\b(\d+)\s*(?:shares?|stocks?|units?)\b|\b(?:buy|purchase|sell)\s+(\d+)\b", re.I)
+INTEGER = re.compile(r"\b(\d+)\b")
+WORDS = re.compile(r"[a-z']+|\d+", re.I)
+GREETING_WORDS = {"hi", "hello", "hey", "good", "morning", "afternoon", "evening", "there", "start", "help"}
+AFFIRMATIVE_WORDS = {"yes", "yeah", "yep", "sure", "ok", "okay", "confirm", "confirmed", "proceed", "go"}
+NEGATIVE_WORDS = {"no", "nope", "cancel", "don't", "dont", "stop", "nevermind"}
+# Words that may surround a yes or no without changing it
+FILLER_WORDS = {"ahead", "do", "it", "please", "that", "the", "trade", "order", "place", "thanks",
+                "thank", "you", "i", "want", "to", "mind", "never", "not", "now"}
+# A message asking something, or about a stock or the market, is never a profile answer
+QUESTION = re.compile(r"\?|^\s*(what|how|why|when|which|who|where|is|are|can|could|should|would|does|do|will)\b", re.I)
+MARKET = re.compile(r"\b(stocks?|shares?|price|market|ticker|etf|index|buy|sell|purchase)\b", re.I)
+TICKER = re.compile(r"\$?\b([A-Z]{2,5})\b")
+NOT_TICKERS = {"OK", "USD", "EUR", "GBP", "LOW", "MID", "HIGH", "YES", "NO", "HI"}
+# Phrases of a reply asking the user to confirm a trade
+CONFIRMATION_REQUEST = re.compile(
+    r"\b(confirm|proceed|go ahead|shall i|should i|do you want (me )?to|would you like (me )?to)\b", re.I
+)
+
+
+def mentions_ticker(text):
+    """Check whether a message names a ticker, ignoring the messages typed in capitals."""
+    words = WORDS.findall(text)
+    if sum(word.isupper() for word in words) * 2 > len(words):
+        return False
+    return any(symbol not in NOT_TICKERS for symbol in TICKER.findall(text))
+
+
+def parse_profile(text):
+    """
+    Parse the profile fields given in a user message.
+
+    Parameters:
+        text (str): The user message.
+
+    Returns:
+        fields (dict): The experience, risk_level and amount found in the message.
+    """
+    fields = {}
+    for name, patterns in (("experience", EXPERIENCE_PATTERNS), ("risk_level", RISK_PATTERNS)):
+        for value, pattern in patterns:
+            if pattern.search(text):
+                fields[name] = value
+                break
+    match = AMOUNT.search(text) or NUMBER.match(text)
+    if match:
+        groups = match.groupdict() if match.re is AMOUNT else {"prefixed": match.group(1), "prefixed_unit": match.group(2)}
+        number = groups.get("prefixed") or groups.get("suffixed")
+        unit = groups.get("prefixed_unit") or groups.get("suffixed_unit")
+        fields["amount"] = float(number.replace(",", "")) * (1000 if unit else 1)
+    return fields
+
+
+def parse_trade_intent(text):
+    """
+    Parse the action and the number of shares of a trade request.
+
+    Parameters:
+        text (str): The user message.
+
+    Returns:
+        intent (dict): The action (buy or sell) and quantity found in the message.
+    """
+    intent = {}
+    action = ACTION.search(text)
+    if action:
+        intent["action"] = "sell" if action.group(1).lower() == "sell" else "buy"
+    quantity = QUANTITY.search(text)
+    if quantity:
+        intent["quantity"] = int(quantity.group(1) or quantity.group(2))
+    return intent
+
+
+def parse_confirmation(text, action=None):
+    """
+    Recognize a plain yes or no.
+
+    Parameters:
+        text (str): The user message.
+        action (str): The action of the trade being confirmed, buy or sell. The message may repeat it.
+
+    Returns:
+        answer (bool): True for yes, False for no, None when the message says anything else.
+    """
+    words = [word.lower() for word in WORDS.findall(text)]
+    said = parse_trade_intent(text).get("action")
+    if said is not None and said != action:
+        # "yes sell" to a proposed buy is not a confirmation
+        return None
+    allowed = AFFIRMATIVE_WORDS | NEGATIVE_WORDS | FILLER_WORDS | {"buy", "purchase", "sell"}
+    if not words or any(word not in allowed for word in words):
+        return None
+    if any(word in NEGATIVE_WORDS for word in words) or words[:2] in (["never", "mind"], ["do", "not"]):
+        return False
+    if any(word in AFFIRMATIVE_WORDS for word in words) or words[:2] == ["do", "it"]:
+        return True
+    return None
+
+
+class ConversationFlow:
+    """
+    The state machine of the structured steps of a trading conversation.
+
+    The profile questions, their answers and the confirmation of a proposed trade
+    are handled locally; only the free-form turns (questions, trade requests,
+    anything the parsers do not recognize) go to the LLM.
+
+    Attributes:
+        state (str): PROFILE, READY or AWAITING_CONFIRMATION.
+        profile (dict): The experience, risk_level and amount of the user.
+        intent (dict): What is known of the trade the user is asking about: action, quantity, stock_name and price.
+        pending (dict): The stock_name, action, quantity and price of the trade awaiting confirmation.
+        asked (list): The profile fields of the last question asked, the only ones parsed from the answer, or
+            empty before the first question, when every missing field is.
+    """
+
+    def __init__(self, state=PROFILE, profile=None, intent=None, pending=None, asked=None):
+        self.state = state
+        self.profile = dict(profile or {})
+        self.intent = dict(intent or {})
+        self.pending = dict(pending) if pending else None
+        self.asked = list(asked or [])
+
+    def to_dict(self):
+        return {"state": self.state, "profile": self.profile, "intent": self.intent, "pending": self.pending,
+                "asked": self.asked}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def missing_profile(self):
+        return [name for name in ("experience", "risk_level", "amount") if name not in self.profile]
+
+    def handle(self, user_input, trade):
+        """
+        Answer a turn locally when it is a structured step.
+
+        Parameters:
+            user_input (str): The user input.
+            trade: The function executing a trade, called with action, stock_name, price and quantity.
+
+        Returns:
+            response (str): The response, None when the turn must go to the LLM.
+        """
+        if self.state == PROFILE:
+            return self.handle_profile(user_input)
+        if self.state == AWAITING_CONFIRMATION:
+            answer = parse_confirmation(user_input, self.pending["action"])
+            if answer is True:
+                pending, self.pending, self.intent = self.pending, None, {}
+                self.state = READY
+                return trade(**pending)
+            if answer is False:
+                self.pending, self.intent = None, {}
+                self.state = READY
+                return "No problem, the trade is cancelled. What else can I do for you?"
+        # Anything else is free-form, the trade is proposed again after the LLM's answer
+        intent = parse_trade_intent(user_input)
+        if self.state == AWAITING_CONFIRMATION:
+            pending = self.pending
+            self.pending, self.intent = None, {}
+            self.state = READY
+            # e.g. "yes but only 10", a bare number changes the quantity of the pending trade
+            number = INTEGER.search(user_input)
+            if number and "quantity" not in intent:
+                intent["quantity"] = int(number.group(1))
+            if intent:
+                # Still about the same trade, but its price has to be retrieved again
+                self.intent = {"stock_name": pending["stock_name"], "action": pending["action"]}
+        self.intent.update(intent)
+        return None
+
+    def handle_profile(self, user_input):
+        if QUESTION.search(user_input) or MARKET.search(user_input) or mentions_ticker(user_input):
+            # A question before the profile is complete is free-form
+            return None
+        # Only the fields of the question asked are answered, "never" is no experience only when asked about it.
+        # Before any question, e.g. after a first message that was not a bare greeting, every missing field is.
+        expected = self.asked or self.missing_profile()
+        fields = {name: value for name, value in parse_profile(user_input).items() if name in expected}
+        words = {word.lower() for word in WORDS.findall(user_input)}
+        if not fields and not words <= GREETING_WORDS:
+            return None
+        self.profile.update(fields)
+        missing = self.missing_profile()
+        if not missing:
+            self.state = READY
+            self.asked = []
+            return (f"Thanks! I will keep to a {self.profile['risk_level']} risk level for up to "
+                    f"{self.profile['amount']:,.0f}. Which stock would you like to buy or sell?")
+        questions = {
+            "experience": "what is your experience with trading",
+            "risk_level": "how much risk are you willing to take today, low, medium or high",
+            "amount": "how much money are you willing to invest",
+        }
+        self.asked = missing
+        asked = ", ".join(questions[name] for name in missing[:-1])
+        asked = f"{asked} and {questions[missing[-1]]}" if asked else questions[missing[-1]]
+        if fields:
+            return f"Got it. {asked[0].upper()}{asked[1:]}?"
+        return f"Hi! Before we start, {asked}?"
+
+    def profile_message(self):
+        """
+        Get the system message personalising the LLM's answers to the collected profile.
+
+        Returns:
+            message (dict): The system message.
+        """
+        return {
+            "role": "system",
+            "content": (f"The user profile is collected, steps 1 to 3 are done: experience {self.profile['experience']}, "
+                        f"risk level {self.profile['risk_level']}, amount to invest {self.profile['amount']}. "
+                        "Continue from step 4. Do not execute a trade before the user confirms it."),
+        }
+
+    def observe(self, user_input, tool_calls, prices, response=None):
+        """
+        Update the state after a turn answered by the LLM.
+
+        A trade is awaiting confirmation once the LLM has retrieved the price of the
+        stock the user asked to trade, and its reply asks the user to confirm that
+        very trade: same stock, action and quantity as the intent.
+
+        Parameters:
+            user_input (str): The user input.
+            tool_calls (list): The (function name, arguments) of the tools the LLM called.
+            prices (dict): The last price retrieved for each stock.
+            response (str): The reply of the LLM.
+        """
+        self.intent.update(parse_trade_intent(user_input))
+        names = [name for name, _ in tool_calls]
+        if "trade_stock" in names:
+            # The LLM traded on its own, nothing is pending anymore
+            self.pending, self.intent = None, {}
+            self.state = READY
+            return
+        for name, args in reversed(tool_calls):
+            stock_name = args.get("stock_name")
+            if name == "get_stock_info" and stock_name and stock_name in prices:
+                if stock_name != self.intent.get("stock_name"):
+                    self.intent.pop("price", None)
+                self.intent["stock_name"] = stock_name
+                self.intent["price"] = prices[stock_name]
+                break
+        if not response or not CONFIRMATION_REQUEST.search(response):
+            return
+        proposed = parse_trade_intent(response)
+        for key in ("action", "quantity"):
+            if key in proposed and key in self.intent and proposed[key] != self.intent[key]:
+                # The reply proposes another trade than the one asked, the user is not confirming the intent
+                return
+        intent = dict(proposed, **self.intent)
+        if not all(key in intent for key in ("action", "quantity", "stock_name", "price")):
+            return
+        if not re.search(r"\b" + re.escape(intent["stock_name"]) + r"\b", response, re.I):
+            return
+        self.intent = intent
+        self.pending = dict(intent)
+        self.state = AWAITING_CONFIRMATION
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Seconds a chat turn may take end to end, from the request to the answer
+TURN_BUDGET = float(os.getenv("TURN_BUDGET", "20"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the time budget of a request runs out before a stage is done."""
+
+
+class Deadline:
+    """
+    The time budget of a request, carried through its stages.
+
+    Every stage (a completion, a tool call, a download) asks for its timeout
+    with timeout, so the sum of the stages never exceeds the budget and the
+    tail latency is bounded by configuration.
+
+    Attributes:
+        budget (float): The seconds given to the request.
+        expires (float): The time.monotonic() at which the budget runs out.
+    """
+
+    def __init__(self, budget=TURN_BUDGET):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    def remaining(self):
+        """Get the seconds left, 0 when the deadline has passed."""
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, reserve=0.0, minimum=0.05):
+        """
+        Get the timeout of a stage from the remaining budget.
+
+        Parameters:
+            cap (float): The longest the stage should take anyway.
+            reserve (float): The seconds kept for the stages that follow.
+            minimum (float): The shortest timeout worth starting the stage with.
+
+        Returns:
+            timeout (float): The seconds the stage may take.
+        """
+        timeout = self.remaining() - reserve
+        if timeout < minimum:
+            raise DeadlineExceeded(f"Deadline of {self.budget}s reached")
+        return timeout if cap is None else min(timeout, cap)
+
+
+class DeadlineExecutor:
+    """
+    The threads running the deadline bound calls.
+
+    A call given up on its deadline is cancelled if it has not started yet.
+    Otherwise it keeps its thread until it returns, so whatever it caches on the
+    way (downloads, prefetches) serves the next request. At most max_abandoned
+    such calls run at once: past that, new calls are refused straight away
+    instead of queueing behind them, so the abandoned work never takes all the
+    threads.
+
+    Attributes:
+        executor (ThreadPoolExecutor): The threads.
+        max_abandoned (int): The calls still running past their deadline from which new calls are refused.
+        abandoned (int): The calls still running past their deadline.
+    """
+
+    def __init__(self, max_workers=16, max_abandoned=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="deadline")
+        self.max_abandoned = max_abandoned if max_abandoned is not None else max(max_workers // 2, 1)
+        self.abandoned = 0
+        self.lock = threading.Lock()
+
+    def call(self, func, deadline, reserve=0.0, **kwargs):
+        """
+        Call a blocking function in a thread, giving up when the deadline passes.
+
+        Parameters:
+            func: The function.
+            deadline (Deadline): The deadline of the request.
+            reserve (float): The seconds kept for the stages that follow.
+            **kwargs: The arguments of the function.
+
+        Returns:
+            result: The result of the function.
+        """
+        with self.lock:
+            if self.abandoned >= self.max_abandoned:
+                raise DeadlineExceeded(f"{self.abandoned} calls are still running past their deadline")
+        timeout = deadline.timeout(reserve=reserve)
+        future = self.executor.submit(func, **kwargs)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if future.done():
+                raise
+        # The time spent queued counts against the deadline, a call that did not start is dropped
+        if not future.cancel():
+            with self.lock:
+                self.abandoned += 1
+            future.add_done_callback(self._finished)
+        raise DeadlineExceeded(f"Deadline of {deadline.budget}s reached")
+
+    def _finished(self, future):
+        with self.lock:
+            self.abandoned -= 1
+
+
+def call_with_deadline(func, deadline, reserve=0.0, executor=None, **kwargs):
+    """
+    Call a blocking function, giving up when the deadline passes.
+
+    Parameters:
+        func: The function.
+        deadline (Deadline): The deadline of the request.
+        reserve (float): The seconds kept for the stages that follow.
+        executor (DeadlineExecutor): The threads running the calls, default_executor by default.
+        **kwargs: The arguments of the function.
+
+    Returns:
+        result: The result of the function.
+    """
+    return (executor or default_executor).call(func, deadline, reserve, **kwargs)
+
+
+# Threads of the deadline bound calls, shared by the chat sessions of the process
+default_executor = DeadlineExecutor(max_workers=int(os.getenv("DEADLINE_WORKERS", "16")))
@@ -0,0 +1,408 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from market_data import normalize_symbols
+
+PATTERNS = ("doji", "hammer", "shooting_star", "bullish_engulfing", "bearish_engulfing")
+# Smallest weight kept by a block of the closed form EMA, far from the float64 underflow
+_MIN_WEIGHT = 1e-200
+
+
+def _fill_gaps(values):
+    # Forward fill the missing bars along the last axis, then back fill the leading ones
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    positions = np.where(valid, np.arange(values.shape[-1]), 0)
+    np.maximum.accumulate(positions, axis=-1, out=positions)
+    filled = np.take_along_axis(values, positions, axis=-1)
+    first = np.argmax(valid, axis=-1)
+    leading = np.arange(values.shape[-1]) < first[..., None]
+    first_values = np.take_along_axis(values, first[..., None], axis=-1)
+    return np.where(leading, first_values, filled), leading
+
+
+def ema(values, alpha, initial=None):
+    """
+    Exponential moving average along the last axis, without a loop over the bars.
+
+    Each block of bars is computed in closed form, e_t = w^(t+1) e_-1 + alpha w^t cumsum(x_k w^-k)
+    with w = 1 - alpha, the blocks being as long as the weights stay representable.
+
+    Parameters:
+        values (np.ndarray): The (tickers, bars) values, without missing values.
+        alpha (float): The smoothing factor, 2 / (span + 1) or 1 / period for Wilder's smoothing.
+        initial (np.ndarray): The (tickers,) averages before the first bar, the first values by default.
+
+    Returns:
+        averages (np.ndarray): The (tickers, bars) averages.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    w = 1.0 - alpha
+    previous = values[:, 0].copy() if initial is None else np.asarray(initial, dtype=float).copy()
+    block = values.shape[1] if w == 0 else max(int(np.log(_MIN_WEIGHT) / np.log(w)), 1)
+    output = np.empty_like(values)
+    for start in range(0, values.shape[1], block):
+        chunk = values[:, start:start + block]
+        powers = w ** np.arange(chunk.shape[1] + 1)
+        sums = np.cumsum(chunk / powers[:-1], axis=1)
+        output[:, start:start + block] = powers[1:] * previous[:, None] + alpha * powers[:-1] * sums
+        previous = output[:, start + chunk.shape[1] - 1]
+    return output
+
+
+def sma(values, window):
+    """
+    Simple moving average along the last axis, NaN for the first window - 1 bars.
+
+    Parameters:
+        values (np.ndarray): The (tickers, bars) values.
+        window (int): The number of bars.
+
+    Returns:
+        averages (np.ndarray): The (tickers, bars) averages.
+    """
+    output = np.full(values.shape, np.nan)
+    if values.shape[-1] >= window:
+        output[..., window - 1:] = np.lib.stride_tricks.sliding_window_view(values, window, axis=-1).mean(axis=-1)
+    return output
+
+
+def rolling_std(values, window):
+    output = np.full(values.shape, np.nan)
+    if values.shape[-1] >= window:
+        output[..., window - 1:] = np.lib.stride_tricks.sliding_window_view(values, window, axis=-1).std(axis=-1)
+    return output
+
+
+def candle_patterns(open_, high, low, close, previous_open, previous_close):
+    """
+    Flag the classic candlestick patterns of every bar.
+
+    Parameters:
+        open_, high, low, close (np.ndarray): The (tickers, bars) prices.
+        previous_open, previous_close (np.ndarray): The prices of the bars before.
+
+    Returns:
+        flags (dict): A (tickers, bars) boolean array per pattern of PATTERNS.
+    """
+    body = np.abs(close - open_)
+    candle = np.maximum(high - low, 1e-12)
+    upper_shadow = high - np.maximum(open_, close)
+    lower_shadow = np.minimum(open_, close) - low
+    rising, falling = close > open_, close < open_
+    previous_rising, previous_falling = previous_close > previous_open, previous_close < previous_open
+    return {
+        "doji": body <= 0.1 * candle,
+        "hammer": (lower_shadow >= 2 * body) & (upper_shadow <= body) & (body > 0.1 * candle),
+        "shooting_star": (upper_shadow >= 2 * body) & (lower_shadow <= body) & (body > 0.1 * candle),
+        "bullish_engulfing": rising & previous_falling & (close >= previous_open) & (open_ <= previous_close),
+        "bearish_engulfing": falling & previous_rising & (open_ >= previous_close) & (close <= previous_open),
+    }
+
+
+class IndicatorEngine:
+    """
+    Vectorized technical indicators over the OHLCV arrays of many tickers at once.
+
+    Arrays are (tickers, bars), aligned on the same dates and oldest first. compute
+    returns the indicators of every bar with a state, and update computes the
+    indicators of new bars from that state without going over the history again.
+
+    Attributes:
+        sma_windows (tuple): The windows of the simple moving averages.
+        ema_spans (tuple): The spans of the exponential moving averages.
+        rsi_period (int): The period of the RSI, with Wilder's smoothing.
+        macd_spans (tuple): The fast, slow and signal spans of the MACD.
+        bollinger (tuple): The window and the number of standard deviations of the Bollinger bands.
+        atr_period (int): The period of the ATR, with Wilder's smoothing.
+    """
+
+    def __init__(self, sma_windows=(20, 50), ema_spans=(12, 26), rsi_period=14, macd_spans=(12, 26, 9),
+                 bollinger=(20, 2.0), atr_period=14):
+        self.sma_windows = tuple(sma_windows)
+        self.ema_spans = tuple(ema_spans)
+        self.rsi_period = rsi_period
+        self.macd_spans = tuple(macd_spans)
+        self.bollinger = tuple(bollinger)
+        self.atr_period = atr_period
+        # Bars kept by the state for the windows of the next update
+        self.tail = max(self.sma_windows + (self.bollinger[0],)) - 1
+
+    def compute(self, open_, high, low, close):
+        """
+        Compute the indicators of all the bars.
+
+        Parameters:
+            open_, high, low, close (np.ndarray): The (tickers, bars) prices, NaN where a ticker has no bar.
+
+        Returns:
+            (indicators, state) (tuple): A (tickers, bars) array per indicator, and the state for update.
+        """
+        prices = [np.atleast_2d(np.asarray(values, dtype=float)) for values in (open_, high, low, close)]
+        filled = [_fill_gaps(values)[0] for values in prices]
+        missing = _fill_gaps(prices[3])[1]
+        indicators, state = self._run(*filled, state=None)
+        for name, values in indicators.items():
+            if values.dtype == bool:
+                values &= ~missing
+            else:
+                values[missing] = np.nan
+        return indicators, state
+
+    def update(self, state, open_, high, low, close):
+        """
+        Compute the indicators of new bars.
+
+        Parameters:
+            state (dict): The state returned by compute or by the previous update.
+            open_, high, low, close (np.ndarray): The (tickers, new bars) prices.
+
+        Returns:
+            (indicators, state) (tuple): A (tickers, new bars) array per indicator, and the new state.
+        """
+        prices = [_fill_gaps(np.atleast_2d(np.asarray(values, dtype=float)))[0] for values in (open_, high, low, close)]
+        return self._run(*prices, state=state)
+
+    def _run(self, open_, high, low, close, state):
+        bars = close.shape[1]
+        if state is None:
+            tail = [values[:, :0] for values in (open_, high, low, close)]
+            previous_close = close[:, 0]
+            carry = {}
+        else:
+            tail = [state["tail"][name] for name in ("open", "high", "low", "close")]
+            previous_close = tail[3][:, -1]
+            carry = state["ema"]
+        full_open, full_high, full_low, full_close = (np.concatenate([old, new], axis=1)
+                                                      for old, new in zip(tail, (open_, high, low, close)))
+        previous_open = np.concatenate([full_open[:, :1], full_open[:, :-1]], axis=1)[:, -bars:]
+        previous_closes = np.concatenate([previous_close[:, None], close[:, :-1]], axis=1)
+
+        indicators = {}
+        new_carry = {}
+
+        def smoothed(name, values, alpha):
+            averages = ema(values, alpha, carry.get(name))
+            new_carry[name] = averages[:, -1]
+            return averages
+
+        for window in self.sma_windows:
+            indicators[f"sma_{window}"] = sma(full_close, window)[:, -bars:]
+        for span in self.ema_spans:
+            indicators[f"ema_{span}"] = smoothed(f"ema_{span}", close, 2 / (span + 1))
+
+        fast, slow, signal = self.macd_spans
+        macd = (smoothed("macd_fast", close, 2 / (fast + 1)) - smoothed("macd_slow", close, 2 / (slow + 1)))
+        indicators["macd"] = macd
+        indicators["macd_signal"] = smoothed("macd_signal", macd, 2 / (signal + 1))
+        indicators["macd_histogram"] = macd - indicators["macd_signal"]
+
+        change = close - previous_closes
+        gain = smoothed("rsi_gain", np.maximum(change, 0), 1 / self.rsi_period)
+        loss = smoothed("rsi_loss", np.maximum(-change, 0), 1 / self.rsi_period)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            indicators["rsi"] = np.where(loss > 0, 100 - 100 / (1 + gain / loss), np.where(gain > 0, 100.0, 50.0))
+
+        window, deviations = self.bollinger
+        middle = sma(full_close, window)[:, -bars:]
+        spread = deviations * rolling_std(full_close, window)[:, -bars:]
+        indicators["bollinger_middle"] = middle
+        indicators["bollinger_upper"] = middle + spread
+        indicators["bollinger_lower"] = middle - spread
+
+        true_range = np.maximum.reduce([high - low, np.abs(high - previous_closes), np.abs(low - previous_closes)])
+        indicators["atr"] = smoothed("atr", true_range, 1 / self.atr_period)
+
+        previous_bar_close = np.concatenate([full_close[:, :1], full_close[:, :-1]], axis=1)[:, -bars:]
+        flags = candle_patterns(open_, high, low, close, previous_open, previous_bar_close)
+        if state is None:
+            # The first bar has no previous bar to be engulfed
+            for name in ("bullish_engulfing", "bearish_engulfing"):
+                flags[name][:, 0] = False
+        indicators.update(flags)
+
+        keep = self.tail
+        new_state = {
+            "tail": {name: values[:, -keep:] if keep else values[:, :0]
+                     for name, values in zip(("open", "high", "low", "close"),
+                                             (full_open, full_high, full_low, full_close))},
+            "ema": new_carry,
+        }
+        return indicators, new_state
+
+
+def download_ohlcv(symbols, period="6mo", interval="1d"):
+    """
+    Download the OHLCV bars of several stocks with one bulk download.
+
+    Parameters:
+        symbols (list): The symbols.
+        period (str): The period.
+        interval (str): The bar interval.
+
+    Returns:
+        (symbols, dates, prices) (tuple): The symbols found, the bar dates and a dict of (tickers, bars) arrays
+        for open, high, low and close.
+    """
+    data = yf.download(symbols, period=period, interval=interval, auto_adjust=True, progress=False,
+                       group_by="column")
+    if data.empty:
+        return [], data.index, {}
+    found = [symbol for symbol in symbols if symbol in data["Close"]] if isinstance(data["Close"], pd.DataFrame) \
+        else symbols[:1]
+    prices = {}
+    for name in ("Open", "High", "Low", "Close"):
+        frame = data[name]
+        frame = frame[found] if isinstance(frame, pd.DataFrame) else frame.to_frame(found[0])
+        prices[name.lower()] = frame.to_numpy(dtype=float).T
+    return found, data.index, prices
+
+
+OHLC = ("open", "high", "low", "close")
+
+
+def _complete_bars(dates):
+    # The bar of the current day is still in progress
+    today = pd.Timestamp.now(tz=dates.tz).normalize()
+    return np.asarray(dates < today)
+
+
+def _recent(values, indicators, row, bars=5):
+    recent = {name: array[row, -bars:] for name, array in indicators.items()}
+    if values is not None:
+        recent = {name: np.concatenate([values[name], array])[-bars:] for name, array in recent.items()}
+    return recent
+
+
+class IndicatorCache:
+    """
+    The indicators of the daily bars of the tickers asked about, kept up to date incrementally.
+
+    A ticker is computed over its history the first time. Later calls only download
+    the last days and update its state with the bars completed since; the bar in
+    progress is computed from the state without being kept. A ticker not asked
+    about for longer than the last days is computed over its history again, as the
+    bars in between are missing.
+
+    Attributes:
+        engine (IndicatorEngine): The engine.
+        period (str): The history of the first computation.
+    """
+
+    def __init__(self, engine=None, period="1y"):
+        self.engine = engine or IndicatorEngine()
+        self.period = period
+        # symbol -> (date of the last complete bar, state, indicators of the last 5 bars)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def compute(self, symbols):
+        """
+        Compute the indicators of symbols over their history, replacing their entries.
+
+        Parameters:
+            symbols (list): The symbols.
+        """
+        found, dates, prices = download_ohlcv(symbols, self.period)
+        complete = _complete_bars(dates) if found else None
+        if found and complete.any():
+            # All the tickers at once, one row each
+            indicators, state = self.engine.compute(*(prices[name][:, complete] for name in OHLC))
+            with self.lock:
+                for row, symbol in enumerate(found):
+                    self.entries[symbol] = (dates[complete][-1], _state_row(state, row),
+                                            _recent(None, indicators, row))
+
+    def latest(self, symbols):
+        """
+        Get the indicators of the last bar of each symbol.
+
+        Parameters:
+            symbols (list): The symbols.
+
+        Returns:
+            latest (dict): symbol -> (close, indicators of the last bar, patterns of the last 5 bars).
+        """
+        symbols = normalize_symbols(symbols)
+        with self.lock:
+            new = [symbol for symbol in symbols if symbol not in self.entries]
+        if new:
+            self.compute(new)
+
+        found, dates, prices = download_ohlcv(symbols, "5d")
+        stale = []
+        for row, symbol in enumerate(found):
+            with self.lock:
+                entry = self.entries.get(symbol)
+            valid = ~np.isnan(prices["close"][row])
+            if entry is not None and valid.any() and dates[valid][0] > entry[0]:
+                # The bars between the cached one and the first one downloaded are missing
+                stale.append(symbol)
+        if stale:
+            self.compute(stale)
+
+        latest = {}
+        for row, symbol in enumerate(found):
+            with self.lock:
+                entry = self.entries.get(symbol)
+            if entry is None:
+                continue
+            last_date, state, recent = entry
+            newer = np.asarray(dates > last_date)
+            complete = newer & _complete_bars(dates)
+            if complete.any():
+                indicators, state = self.engine.update(state, *(prices[name][row:row + 1, complete] for name in OHLC))
+                recent = _recent(recent, indicators, 0)
+                with self.lock:
+                    self.entries[symbol] = (dates[complete][-1], state, recent)
+            in_progress = newer & ~complete
+            if in_progress.any():
+                indicators, _ = self.engine.update(state, *(prices[name][row:row + 1, in_progress] for name in OHLC))
+                recent = _recent(recent, indicators, 0)
+            closes = prices["close"][row][~np.isnan(prices["close"][row])]
+            if closes.size:
+                latest[symbol] = _summary(closes[-1], recent)
+        return latest
+
+
+def _state_row(state, row):
+    return {part: {name: array[row:row + 1] for name, array in values.items()} for part, values in state.items()}
+
+
+def _summary(close, values):
+    latest = {name: array[-1] for name, array in values.items() if array.dtype != bool}
+    patterns = [name for name in PATTERNS if values[name].any()]
+    return close, latest, patterns
+
+
+def format_indicators(latest, precision=2):
+    """
+    Format the indicators of several tickers as a compact table for the model.
+
+    Parameters:
+        latest (dict): The result of IndicatorCache.latest.
+        precision (int): The number of decimals to keep.
+
+    Returns:
+        table (str): One line per ticker and a legend of the columns.
+    """
+    if not latest:
+        return "Stock data not found. Please try again."
+    lines = ["symbol|close|sma20|sma50|ema12|ema26|rsi14|macd|macd_signal|bb_pct|atr_pct|patterns_5d"]
+    for symbol, (close, values, patterns) in latest.items():
+        band = values["bollinger_upper"] - values["bollinger_lower"]
+        bollinger_position = (close - values["bollinger_lower"]) / band * 100 if band > 0 else np.nan
+        columns = [close, values.get("sma_20"), values.get("sma_50"), values.get("ema_12"), values.get("ema_26"),
+                   values["rsi"], values["macd"], values["macd_signal"], bollinger_position,
+                   values["atr"] / close * 100]
+        cells = ["" if value is None or np.isnan(value) else f"{value:.{precision}f}" for value in columns]
+        lines.append("|".join([symbol] + cells + [",".join(patterns) or "none"]))
+    lines.append("bb_pct: position in the Bollinger bands (0 lower, 100 upper); atr_pct: ATR in % of the close")
+    return "\n".join(lines)
+
+
+# Indicators shared by the chat sessions of the process
+default_indicators = IndicatorCache()
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+TRADING_DAYS = 252
+
+
+def normalize_symbol(symbol):
+    """
+    Get the canonical form of a symbol, under which the feed, the engine and the caches key it.
+
+    Parameters:
+        symbol (str): The symbol as typed by the user or given by the model.
+
+    Returns:
+        symbol (str): The stripped upper case symbol.
+    """
+    return symbol.strip().upper()
+
+
+def normalize_symbols(symbols):
+    """
+    Clean a list of symbols given by the model, keeping their order.
+
+    Parameters:
+        symbols (list): The symbols, or a comma separated string.
+
+    Returns:
+        symbols (list): The unique upper case symbols.
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    parts = (normalize_symbol(part) for symbol in symbols if symbol for part in symbol.split(","))
+    return list(dict.fromkeys(part for part in parts if part))
+
+
+def get_quotes(symbols, period="1mo", precision=2):
+    """
+    Get the price, daily change and volatility of several stocks with one bulk download.
+
+    Parameters:
+        symbols (list): The symbols.
+        period (str): The history used for the volatility.
+        precision (int): The number of decimals to keep.
+
+    Returns:
+        table (str): A compact table with one line per symbol.
+    """
+    symbols = normalize_symbols(symbols)
+    if not symbols:
+        return "No stock given."
+    data = yf.download(symbols, period=period, interval="1d", auto_adjust=True, progress=False)
+    closes = data["Close"]
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(symbols[0])
+
+    lines = ["symbol|price|change_pct|volatility_pct"]
+    for symbol in symbols:
+        if symbol not in closes:
+            lines.append(f"{symbol}|not found||")
+            continue
+        series = closes[symbol].dropna().to_numpy(dtype=float)
+        if series.size == 0:
+            lines.append(f"{symbol}|not found||")
+            continue
+        change = (series[-1] / series[-2] - 1) * 100 if series.size > 1 else 0.0
+        log_returns = np.diff(np.log(series))
+        volatility = np.std(log_returns, ddof=1) * np.sqrt(TRADING_DAYS) * 100 if log_returns.size > 1 else 0.0
+        lines.append(f"{symbol}|{series[-1]:.{precision}f}|{change:+.{precision}f}|{volatility:.{precision}f}")
+    return "\n".join(lines)
+
+
+def download_close_arrays(symbol, period, interval):
+    """
+    Download the adjusted closes of a stock as NumPy arrays.
+
+    Parameters:
+        symbol (str): The symbol.
+        period (str): The period.
+        interval (str): The bar interval.
+
+    Returns:
+        (dates, closes) (tuple): The bar dates as int64 nanoseconds and the closes.
+    """
+    data = yf.download(symbol, period=period, interval=interval, auto_adjust=True, progress=False)
+    closes = np.ravel(data["Close"].to_numpy(dtype=float))
+    dates = data.index.values.astype("datetime64[ns]").astype(np.int64)
+    valid = ~np.isnan(closes)
+    return dates[valid], closes[valid]
+
+
+def _beta(dates, closes, market_dates, market_closes):
+    # Returns of each series, matched on the dates both have
+    returns = closes[1:] / closes[:-1] - 1
+    market_returns = market_closes[1:] / market_closes[:-1] - 1
+    _, i, j = np.intersect1d(dates[1:], market_dates[1:], return_indices=True)
+    covariance_matrix = np.cov(returns[i], market_returns[j])
+    return covariance_matrix[0, 1] / covariance_matrix[1, 1]
+
+
+def risk_statistics(output, daily_dates, daily_closes, market_daily_dates, market_daily_closes,
+                    monthly_dates, monthly_closes, market_monthly_dates, market_monthly_closes):
+    """
+    Compute the volatility and the short and long term betas of a stock.
+
+    Parameters:
+        output (np.ndarray): The 3 output values: annualized volatility, 1 year beta, 5 year beta.
+        daily_dates, daily_closes (np.ndarray): The daily closes of the stock over a year.
+        market_daily_dates, market_daily_closes (np.ndarray): The daily closes of the market.
+        monthly_dates, monthly_closes (np.ndarray): The monthly closes of the stock over 5 years.
+        market_monthly_dates, market_monthly_closes (np.ndarray): The monthly closes of the market.
+    """
+    log_returns = np.diff(np.log(daily_closes))
+    output[0] = np.std(log_returns, ddof=1) * np.sqrt(TRADING_DAYS)
+    output[1] = _beta(daily_dates, daily_closes, market_daily_dates, market_daily_closes)
+    output[2] = _beta(monthly_dates, monthly_closes, market_monthly_dates, market_monthly_closes)
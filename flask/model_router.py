@@ -0,0 +1,355 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+
+ModelBudget = namedtuple(
+    "ModelBudget", ["max_latency", "max_cost_per_hour", "input_cost_per_1k", "output_cost_per_1k"]
+)
+RouteDecision = namedtuple("RouteDecision", ["model", "reason", "features", "turn_id"], defaults=(None,))
+
+# Dollars per 1k tokens of the OpenAI price list, the budgets are ours
+DEFAULT_BUDGETS = {
+    "gpt-4o-mini": ModelBudget(max_latency=2.0, max_cost_per_hour=1.0,
+                               input_cost_per_1k=0.00015, output_cost_per_1k=0.0006),
+    "gpt-4o": ModelBudget(max_latency=6.0, max_cost_per_hour=10.0,
+                          input_cost_per_1k=0.0025, output_cost_per_1k=0.01),
+}
+
+CONFIRMATION = re.compile(
+    r"^\s*(yes|yeah|yep|sure|ok|okay|confirm(ed)?|go ahead|do it|please do|no|nope|cancel|don't)\b", re.I
+)
+TOOL_WORDS = re.compile(
+    r"\b(buy|sell|price|prices|quote|quotes|stock|stocks|shares?|ticker|volatility|beta|history|historical|"
+    r"chart|portfolio|trade|trades|compare|invest in|worth|market)\b",
+    re.I,
+)
+# Statuses of a failed completion worth retrying, as the OpenAI client does, and the pause before the retry
+RETRYABLE_STATUSES = frozenset((408, 409, 429))
+RETRY_DELAY = 0.5
+MAX_RETRIES = 2
+# Tools acting on the user's account, a call to one is always decided by the large model
+SIDE_EFFECT_TOOLS = frozenset(("trade_stock",))
+# Upper case words that are tickers more often than not, e.g. "AAPL" or "TSLA"
+TICKER = re.compile(r"\b(?!I\b|OK\b|USD\b)[A-Z]{2,5}\b")
+
+
+logger = logging.getLogger(__name__)
+
+
+def turn_features(messages, user_input):
+    """
+    Compute the cheap local features of a turn used to pick its model.
+
+    Parameters:
+        messages (list): The conversation before the turn.
+        user_input (str): The user input of the turn.
+
+    Returns:
+        features (dict): tools_likely, turn_type (onboarding, confirmation or query) and history_length.
+    """
+    used_tools = any(message.get("tool_calls") for message in messages if isinstance(message, dict))
+    words = len(user_input.split())
+    tools_likely = bool(TOOL_WORDS.search(user_input) or TICKER.search(user_input))
+    if CONFIRMATION.match(user_input) and words <= 8:
+        turn_type = "confirmation"
+    elif not used_tools and not tools_likely:
+        turn_type = "onboarding"
+    else:
+        turn_type = "query"
+    return {
+        "tools_likely": tools_likely,
+        "turn_type": turn_type,
+        "history_length": len(messages),
+        "words": words,
+    }
+
+
+def completion_confidence(completion):
+    """
+    Get the confidence of a completion: the geometric mean of its token probabilities.
+
+    Parameters:
+        completion: A chat completion requested with logprobs.
+
+    Returns:
+        confidence (float): Between 0 and 1, None without logprobs.
+    """
+    logprobs = completion.choices[0].logprobs if completion.choices else None
+    if logprobs is None or not logprobs.content:
+        return None
+    return math.exp(sum(token.logprob for token in logprobs.content) / len(logprobs.content))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class ModelRouter:
+    """
+    Pick the model of every turn of the assistant, small first and large when needed.
+
+    Onboarding answers and confirmations go to the small model, turns that are
+    likely to use the market data tools or that have a long history go to the
+    large one. A small model answer is escalated to the large model when it calls
+    a tool with side effects or one the small model is not trusted with, or when
+    its confidence is low. The confidence only applies to text answers: the
+    logprobs cover the content tokens, not the arguments of a tool call, so a
+    tool call is judged by its tool alone. Every call is logged with its latency
+    and cost, as a JSON line sent to the model_router logger and appended to the
+    log file, to compare the routing on a replay set.
+
+    Attributes:
+        small_model (str): The cheap and fast model.
+        large_model (str): The model of the hard turns.
+        budgets (dict): The ModelBudget of each model.
+        small_tools (set): The read-only tools the small model may call without escalating.
+        side_effect_tools (set): The tools whose calls always escalate, even if listed in small_tools.
+        min_confidence (float): The confidence under which a small model answer is escalated.
+        max_small_history (int): The number of messages from which every turn goes to the large model.
+        log_path (str): The JSON lines log of the calls, None to only send them to the logger.
+    """
+
+    def __init__(self, small_model="gpt-4o-mini", large_model="gpt-4o", budgets=None,
+                 small_tools=("get_full_data",), side_effect_tools=SIDE_EFFECT_TOOLS, min_confidence=0.6,
+                 max_small_history=40, log_path=None, window=200):
+        self.small_model = small_model
+        self.large_model = large_model
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.small_tools = set(small_tools)
+        self.side_effect_tools = set(side_effect_tools)
+        self.min_confidence = min_confidence
+        self.max_small_history = max_small_history
+        self.log_path = log_path
+        self.latencies = {}
+        self.spend = {}
+        self.lock = threading.Lock()
+        self.window = window
+
+    def route(self, messages, user_input):
+        """
+        Pick the model of a turn from its features.
+
+        Parameters:
+            messages (list): The conversation before the turn.
+            user_input (str): The user input of the turn.
+
+        Returns:
+            decision (RouteDecision): The model, the reason and the features.
+        """
+        features = turn_features(messages, user_input)
+        turn_id = uuid.uuid4().hex
+        if features["history_length"] > self.max_small_history:
+            return RouteDecision(self.large_model, "long_history", features, turn_id)
+        if features["turn_type"] == "query" and features["tools_likely"]:
+            return RouteDecision(self.large_model, "tools_likely", features, turn_id)
+        if self.over_latency_budget(self.small_model):
+            # Nothing to gain from a cascade on a degraded small model
+            return RouteDecision(self.large_model, "small_over_latency_budget", features, turn_id)
+        return RouteDecision(self.small_model, features["turn_type"], features, turn_id)
+
+    def create(self, client, decision, deadline=None, **kwargs):
+        """
+        Create the first completion of a turn, escalating to the large model if needed.
+
+        Parameters:
+            client (OpenAI): The OpenAI client.
+            decision (RouteDecision): The decision of route.
+            deadline (Deadline): The deadline of the turn, None for no limit.
+            **kwargs: The arguments of client.chat.completions.create, without the model.
+
+        Returns:
+            (completion, model) (tuple): The completion and the model that produced it.
+        """
+        if decision.model != self.small_model:
+            return self.call(client, decision.model, decision, "first", deadline, **kwargs), decision.model
+
+        completion = self.call(client, self.small_model, decision, "first", deadline, logprobs=True, **kwargs)
+        reason = self.escalation_reason(completion)
+        if reason is None:
+            return completion, self.small_model
+        budget = self.budgets.get(self.large_model)
+        if deadline is not None and budget is not None and deadline.remaining() < budget.max_latency:
+            # The large model would not answer within the turn, the small model answer is better than none
+            return completion, self.small_model
+        escalated = decision._replace(model=self.large_model, reason=reason)
+        return self.call(client, self.large_model, escalated, "escalated", deadline, **kwargs), self.large_model
+
+    def escalation_reason(self, completion):
+        if not completion.choices:
+            return "empty"
+        tool_calls = completion.choices[0].message.tool_calls or []
+        names = [tool_call.function.name for tool_call in tool_calls]
+        if any(name in self.side_effect_tools for name in names):
+            return "side_effect"
+        if any(name not in self.small_tools for name in names):
+            return "tool_use"
+        if names:
+            # The logprobs do not cover the tool call arguments, there is no confidence to check
+            return None
+        confidence = completion_confidence(completion)
+        if confidence is not None and confidence < self.min_confidence:
+            # Low confidence alone is not worth busting the large model's cost budget
+            if not self.over_cost_budget(self.large_model):
+                return "low_confidence"
+        return None
+
+    def call(self, client, model, decision, stage, deadline=None, **kwargs):
+        """
+        Create a completion with a model, then log and account for it.
+
+        Parameters:
+            client (OpenAI): The OpenAI client.
+            model (str): The model.
+            decision (RouteDecision): The decision the call belongs to.
+            stage (str): The call of the turn, e.g. first, escalated or final.
+            deadline (Deadline): The deadline of the turn, None for no limit.
+
+        Returns:
+            completion: The chat completion.
+        """
+        if deadline is None:
+            start_time = time.perf_counter()
+            completion = client.chat.completions.create(model=model, **kwargs)
+        else:
+            # The client's own retries do not know the deadline, a failed call is retried here while the
+            # budget left covers the pause and the usual latency of the model
+            for attempt in range(MAX_RETRIES + 1):
+                start_time = time.perf_counter()
+                try:
+                    completion = client.with_options(timeout=deadline.timeout(), max_retries=0) \
+                        .chat.completions.create(model=model, **kwargs)
+                    break
+                except Exception as e:
+                    delay = self.retry_delay(e, model, deadline)
+                    if delay is None or attempt == MAX_RETRIES:
+                        raise
+                    logger.info("Retrying %s after %s in %.1fs", model, type(e).__name__, delay)
+                    time.sleep(delay)
+        latency = time.perf_counter() - start_time
+        self.record(model, decision, stage, latency, completion)
+        return completion
+
+    def retry_delay(self, error, model, deadline):
+        """
+        Get the pause before retrying a failed completion within the deadline of the turn.
+
+        Parameters:
+            error (Exception): The error of the completion.
+            model (str): The model.
+            deadline (Deadline): The deadline of the turn.
+
+        Returns:
+            delay (float): The seconds to wait, None when the call is not retried.
+        """
+        status = getattr(error, "status_code", None)
+        if status is None or (status not in RETRYABLE_STATUSES and status < 500):
+            return None
+        delay = RETRY_DELAY
+        response = getattr(error, "response", None)
+        try:
+            delay = max(float(response.headers.get("retry-after", delay)), delay)
+        except (AttributeError, TypeError, ValueError):
+            pass
+        with self.lock:
+            latencies = list(self.latencies.get(model, ()))
+        budget = self.budgets.get(model)
+        expected = percentile(latencies, 0.5) or (budget.max_latency if budget is not None else 0.0)
+        if deadline.remaining() < delay + expected:
+            return None
+        return delay
+
+    def record(self, model, decision, stage, latency, completion):
+        usage = getattr(completion, "usage", None)
+        budget = self.budgets.get(model)
+        cost = 0.0
+        if usage is not None and budget is not None:
+            cost = (usage.prompt_tokens * budget.input_cost_per_1k
+                    + usage.completion_tokens * budget.output_cost_per_1k) / 1000
+        now = time.time()
+        with self.lock:
+            self.latencies.setdefault(model, deque(maxlen=self.window)).append(latency)
+            self.spend.setdefault(model, deque()).append((now, cost))
+        entry = {
+            "time": now,
+            "turn_id": decision.turn_id,
+            "model": model,
+            "stage": stage,
+            "reason": decision.reason,
+            "features": decision.features,
+            "latency": round(latency, 4),
+            "cost": round(cost, 6),
+            "confidence": completion_confidence(completion) if stage != "final" else None,
+        }
+        line = json.dumps(entry)
+        logger.info("Model route: %s", line)
+        if self.log_path:
+            with self.lock, open(self.log_path, "a") as log:
+                log.write(line + "\n")
+
+    def over_latency_budget(self, model):
+        """
+        Check whether the recent median latency of a model is over its budget.
+
+        Parameters:
+            model (str): The model.
+
+        Returns:
+            over (bool): True when over budget.
+        """
+        budget = self.budgets.get(model)
+        with self.lock:
+            latencies = list(self.latencies.get(model, ()))
+        median = percentile(latencies, 0.5)
+        return budget is not None and median is not None and median > budget.max_latency
+
+    def over_cost_budget(self, model):
+        """
+        Check whether the spend of a model over the last hour is over its budget.
+
+        Parameters:
+            model (str): The model.
+
+        Returns:
+            over (bool): True when over budget.
+        """
+        budget = self.budgets.get(model)
+        if budget is None:
+            return False
+        cutoff = time.time() - 3600
+        with self.lock:
+            spend = self.spend.get(model, deque())
+            while spend and spend[0][0] < cutoff:
+                spend.popleft()
+            total = sum(cost for _, cost in spend)
+        return total > budget.max_cost_per_hour
+
+    def report(self):
+        """
+        Summarize the latency of the recent calls of each model.
+
+        Returns:
+            report (str): The p50 and p95 latency and the calls per model.
+        """
+        with self.lock:
+            latencies = {model: list(values) for model, values in self.latencies.items()}
+        return ", ".join(
+            f"{model}: p50 {percentile(values, 0.5):.2f}s p95 {percentile(values, 0.95):.2f}s over {len(values)} calls"
+            for model, values in latencies.items() if values
+        )
+
+
+# Router shared by the chat sessions of the process
+default_router = ModelRouter(
+    small_model=os.getenv("ROUTER_SMALL_MODEL", "gpt-4o-mini"),
+    large_model=os.getenv("ROUTER_LARGE_MODEL", "gpt-4o"),
+    log_path=os.getenv("ROUTER_LOG"),
+)
@@ -0,0 +1,358 @@
+import contextlib
+import heapq
+import itertools
+import threading
+from collections import namedtuple
+
+from market_data import normalize_symbol
+
+Fill = namedtuple("Fill", ["symbol", "price", "quantity", "buy_order_id", "sell_order_id",
+                           "buy_session", "sell_session"])
+OrderResult = namedtuple("OrderResult", ["order_id", "status", "filled_quantity", "average_price", "fills"])
+
+# Session used for the simulated liquidity filling orders at the reference price
+MARKET_SESSION = "market"
+
+_BUY = 0
+_SELL = 1
+_INF = float("inf")
+_SIDES = frozenset(("buy", "sell"))
+_ORDER_TYPES = frozenset(("market", "limit"))
+# Good till cancelled limit orders rest on the book, immediate or cancel ones never do
+_TIME_IN_FORCE = frozenset(("gtc", "ioc"))
+# Fields of the state of a resting order
+_REMAINING, _LIMIT, _SIDE, _ACCOUNT, _SYMBOL = range(5)
+
+
+class OrderRejected(Exception):
+    """Raised when an order does not pass the account checks."""
+
+
+class Account:
+    """
+    The cash and positions of a trading session.
+
+    Attributes:
+        cash (float): The cash, including the reserved cash.
+        reserved_cash (float): The cash held by resting buy orders.
+        positions (dict): The shares held by symbol.
+        reserved_shares (dict): The shares held by resting sell orders by symbol.
+    """
+
+    __slots__ = ("session_id", "cash", "reserved_cash", "positions", "reserved_shares")
+
+    def __init__(self, session_id, cash):
+        self.session_id = session_id
+        self.cash = cash
+        self.reserved_cash = 0.0
+        self.positions = {}
+        self.reserved_shares = {}
+
+    def snapshot(self):
+        """Return the account as a plain dict."""
+        return {
+            "cash": round(self.cash, 2),
+            "available_cash": round(self.cash - self.reserved_cash, 2),
+            "positions": {symbol: quantity for symbol, quantity in self.positions.items() if quantity},
+        }
+
+
+class OrderBook:
+    """
+    A price-time priority limit order book for one symbol.
+
+    Both sides are binary heaps of (price key, order id) tuples, order ids being
+    increasing they also give the time priority. The order state itself lives in
+    the engine's resting orders. Filled and cancelled orders are removed from the
+    heaps lazily, when they reach the top.
+    """
+
+    __slots__ = ("symbol", "bids", "asks")
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        # Bids are keyed by the negated price so that the best bid is on top
+        self.bids = []
+        self.asks = []
+
+
+class PaperTradingEngine:
+    """
+    An in-memory paper-trading matching engine shared by the chat sessions.
+
+    Supports market and limit orders with partial fills. A marketable order first
+    trades against the resting orders of other sessions; when a reference price is
+    given (the quote the user confirmed), the remainder is filled by a simulated
+    market at that price, so a session can trade without a counterparty. A market
+    buy stops where the cash of the session runs out, and an immediate or cancel
+    limit order never rests.
+
+    Attributes:
+        initial_cash (float): The cash of a new session.
+        allow_short (bool): Whether sessions can sell shares they do not hold.
+        ledger (TradeLedger): The durable ledger the trades are logged to, if any.
+    """
+
+    def __init__(self, initial_cash=100_000.0, allow_short=False, ledger=None):
+        self.initial_cash = initial_cash
+        self.allow_short = allow_short
+        self.ledger = ledger
+        self.books = {}
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self._order_ids = itertools.count()
+        # The [remaining, limit, side, account, symbol] of the resting orders by order id,
+        # an order leaves once filled or cancelled
+        self._orders = {}
+
+    def account(self, session_id):
+        """
+        Get the account of a session, opening it if needed.
+
+        Parameters:
+            session_id (str): The session.
+
+        Returns:
+            account (Account): The account.
+        """
+        account = self.accounts.get(session_id)
+        if account is None:
+            account = self.accounts[session_id] = Account(session_id, self.initial_cash)
+        return account
+
+    def submit_order(self, session_id, symbol, side, quantity, order_type="market",
+                     limit_price=None, reference_price=None, time_in_force="gtc"):
+        """
+        Submit an order and match it against the book.
+
+        Parameters:
+            session_id (str): The session placing the order.
+            symbol (str): The symbol.
+            side (str): "buy" or "sell".
+            quantity (int): The number of shares.
+            order_type (str): "market" or "limit".
+            limit_price (float): The limit price of a limit order.
+            reference_price (float): The price the simulated market fills the remainder at.
+            time_in_force (str): "gtc" for a limit order resting until filled or cancelled, "ioc" to cancel
+                what does not fill immediately.
+
+        Returns:
+            result (OrderResult): The order id, status, filled quantity, average price and fills.
+        """
+        if side not in _SIDES:
+            raise OrderRejected(f"Unknown side {side}")
+        if order_type not in _ORDER_TYPES:
+            raise OrderRejected(f"Unknown order type {order_type}")
+        if time_in_force not in _TIME_IN_FORCE:
+            raise OrderRejected(f"Unknown time in force {time_in_force}")
+        if order_type == "limit" and limit_price is None:
+            raise OrderRejected("A limit order needs a limit price")
+        if order_type == "limit" and time_in_force == "gtc" and self.ledger is not None and self.ledger.shared:
+            raise OrderRejected("Orders cannot rest on a ledger shared by several processes, use immediate or cancel")
+        quantity = int(quantity)
+        if quantity <= 0:
+            raise OrderRejected("The quantity must be positive")
+
+        symbol = normalize_symbol(symbol)
+        is_buy = side == "buy"
+        rests = order_type == "limit" and time_in_force == "gtc"
+        # A market buy may walk up the book, it is bounded by the cash while matching
+        cash_limited = is_buy and order_type == "market"
+        if order_type == "market":
+            limit_price = _INF if is_buy else 0.0
+
+        # A shared ledger first brings in the trades of the other processes
+        transaction = self.ledger.transaction(self) if self.ledger is not None else contextlib.nullcontext()
+        with self.lock, transaction:
+            book = self.books.get(symbol)
+            if book is None:
+                book = self.books[symbol] = OrderBook(symbol)
+            account = self.account(session_id)
+            if self.ledger is not None:
+                # A trade that cannot be logged is not executed
+                self.ledger.check()
+            self._check(account, book, symbol, is_buy, quantity, order_type, limit_price, reference_price)
+
+            order_id = next(self._order_ids)
+            fills, notional, remaining = self._match(book, order_id, account, is_buy, quantity, limit_price,
+                                                     cash_limited)
+
+            if remaining and reference_price is not None and \
+                    (reference_price <= limit_price if is_buy else reference_price >= limit_price):
+                filled = self._affordable(account, reference_price, remaining) if cash_limited else remaining
+                if filled:
+                    fills.append(self._fill_against_market(order_id, account, symbol, is_buy, filled, reference_price))
+                    notional += filled * reference_price
+                    remaining -= filled
+
+            if remaining and rests:
+                self._rest(book, order_id, account, symbol, is_buy, remaining, limit_price)
+            # Otherwise the rest of the order is cancelled
+
+            lsn = None
+            if fills and self.ledger is not None:
+                lsn = self.ledger.submit({
+                    "order": order_id,
+                    "fills": [(f.symbol, f.price, f.quantity, f.buy_session, f.sell_session) for f in fills],
+                })
+
+        if lsn is not None:
+            # The trade is only reported once it is durable
+            self.ledger.wait(lsn)
+            self.ledger.maybe_snapshot(self)
+
+        filled = quantity - remaining
+        if not filled:
+            status = "resting" if rests else "cancelled"
+        elif remaining:
+            status = "partially_filled" if rests else "partially_filled_cancelled"
+        else:
+            status = "filled"
+        return OrderResult(order_id, status, filled, notional / filled if filled else None, fills)
+
+    def sync(self):
+        """Apply the trades the other processes sharing the ledger executed, before reading the accounts."""
+        if self.ledger is not None:
+            with self.lock:
+                self.ledger.catch_up(self)
+
+    def cancel_order(self, order_id):
+        """
+        Cancel the rest of a resting order.
+
+        Parameters:
+            order_id (int): The order.
+
+        Returns:
+            cancelled (int): The number of shares cancelled.
+        """
+        with self.lock:
+            order = self._orders.pop(order_id, None)
+            if order is None:
+                return 0
+            self._release(order, order[_REMAINING])
+            return order[_REMAINING]
+
+    def best_bid_ask(self, symbol):
+        """
+        Get the best bid and ask of a symbol.
+
+        Parameters:
+            symbol (str): The symbol.
+
+        Returns:
+            (bid, ask) (tuple): The best prices, None for an empty side.
+        """
+        with self.lock:
+            book = self.books.get(normalize_symbol(symbol))
+            if book is None:
+                return None, None
+            self._drop_cancelled(book.bids)
+            self._drop_cancelled(book.asks)
+            bid = -book.bids[0][0] if book.bids else None
+            ask = book.asks[0][0] if book.asks else None
+            return bid, ask
+
+    def _check(self, account, book, symbol, is_buy, quantity, order_type, limit_price, reference_price):
+        if is_buy:
+            if order_type == "limit":
+                price = limit_price
+            elif reference_price is not None:
+                price = reference_price
+            else:
+                self._drop_cancelled(book.asks)
+                if not book.asks:
+                    raise OrderRejected(f"No liquidity to buy {symbol}")
+                # The best ask only bounds the cost from below, the match stops where the cash runs out
+                price = book.asks[0][0]
+            if quantity * price > account.cash - account.reserved_cash + 1e-9:
+                raise OrderRejected(f"Not enough cash to buy {quantity} {symbol}")
+        elif not self.allow_short:
+            available = account.positions.get(symbol, 0) - account.reserved_shares.get(symbol, 0)
+            if quantity > available:
+                raise OrderRejected(f"Not enough {symbol} shares to sell {quantity}")
+
+    def _match(self, book, order_id, account, is_buy, quantity, limit_price, cash_limited):
+        fills = []
+        notional = 0.0
+        remaining = quantity
+        levels = book.asks if is_buy else book.bids
+        orders = self._orders
+        while remaining and levels:
+            key, resting_id = levels[0]
+            price = key if is_buy else -key
+            if (price > limit_price) if is_buy else (price < limit_price):
+                break
+            order = orders.get(resting_id)
+            if order is None:
+                heapq.heappop(levels)
+                continue
+            resting = order[_REMAINING]
+            traded = remaining if remaining < resting else resting
+            if cash_limited:
+                traded = self._affordable(account, price, traded)
+                if not traded:
+                    break
+            remaining -= traded
+            notional += price * traded
+            if resting == traded:
+                heapq.heappop(levels)
+                del orders[resting_id]
+            else:
+                order[_REMAINING] = resting - traded
+            self._release(order, traded)
+            resting_account = order[_ACCOUNT]
+            if is_buy:
+                fills.append(self._settle(book.symbol, price, traded, order_id, resting_id, account, resting_account))
+            else:
+                fills.append(self._settle(book.symbol, price, traded, resting_id, order_id, resting_account, account))
+        return fills, notional, remaining
+
+    def _affordable(self, account, price, quantity):
+        # The shares out of quantity the available cash pays for at price
+        available = account.cash - account.reserved_cash + 1e-9
+        if quantity * price <= available:
+            return quantity
+        return max(int(available // price), 0)
+
+    def _settle(self, symbol, price, quantity, buy_id, sell_id, buyer, seller):
+        notional = price * quantity
+        buyer.cash -= notional
+        seller.cash += notional
+        buyer.positions[symbol] = buyer.positions.get(symbol, 0) + quantity
+        seller.positions[symbol] = seller.positions.get(symbol, 0) - quantity
+        return Fill(symbol, price, quantity, buy_id, sell_id, buyer.session_id, seller.session_id)
+
+    def _fill_against_market(self, order_id, account, symbol, is_buy, quantity, price):
+        notional = price * quantity
+        if is_buy:
+            account.cash -= notional
+            account.positions[symbol] = account.positions.get(symbol, 0) + quantity
+            return Fill(symbol, price, quantity, order_id, None, account.session_id, MARKET_SESSION)
+        account.cash += notional
+        account.positions[symbol] = account.positions.get(symbol, 0) - quantity
+        return Fill(symbol, price, quantity, None, order_id, MARKET_SESSION, account.session_id)
+
+    def _rest(self, book, order_id, account, symbol, is_buy, remaining, limit_price):
+        self._orders[order_id] = [remaining, limit_price, _BUY if is_buy else _SELL, account, symbol]
+        if is_buy:
+            account.reserved_cash += remaining * limit_price
+            heapq.heappush(book.bids, (-limit_price, order_id))
+        else:
+            account.reserved_shares[symbol] = account.reserved_shares.get(symbol, 0) + remaining
+            heapq.heappush(book.asks, (limit_price, order_id))
+
+    def _release(self, order, quantity):
+        account = order[_ACCOUNT]
+        if order[_SIDE] == _BUY:
+            account.reserved_cash -= quantity * order[_LIMIT]
+        else:
+            account.reserved_shares[order[_SYMBOL]] -= quantity
+
+    def _drop_cancelled(self, levels):
+        while levels and levels[0][1] not in self._orders:
+            heapq.heappop(levels)
+
+
+# Engine shared by all the chat sessions of the process
+default_engine = PaperTradingEngine()
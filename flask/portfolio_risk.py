@@ -0,0 +1,240 @@
+import threading
+import time
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+TRADING_DAYS = 252
+
+# Annualized portfolio volatility a beginner can hold at each risk level
+RISK_LEVEL_VOLATILITY = {
+    "low": 0.15,
+    "medium": 0.25,
+    "high": 0.40,
+}
+
+
+def download_closes(symbols, period="1y"):
+    """
+    Download the adjusted daily closes of several symbols in one request.
+
+    Parameters:
+        symbols (list): The symbols.
+        period (str): The period.
+
+    Returns:
+        closes (pd.DataFrame): One column per symbol.
+    """
+    data = yf.download(symbols, period=period, interval="1d", auto_adjust=True, progress=False)
+    closes = data["Close"]
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(symbols[0])
+    return closes
+
+
+class PortfolioRiskModel:
+    """
+    Portfolio risk analytics over a cached universe of daily returns.
+
+    The returns of every symbol seen so far are kept as one matrix together with
+    their covariance matrix and betas, so a portfolio (or a batch of candidate
+    portfolios) is evaluated with a few matrix products and no download. The
+    symbols without data are remembered for a while instead of being downloaded
+    again on every call, and the reports list them.
+
+    Attributes:
+        benchmark (str): The market index used for the betas.
+        period (str): The history used for the estimates.
+        ttl (float): The seconds after which the cached returns are refreshed.
+        not_found_ttl (float): The seconds a symbol without data is not downloaded again.
+    """
+
+    def __init__(self, benchmark="^GSPC", period="1y", ttl=6 * 3600, downloader=download_closes,
+                 not_found_ttl=3600):
+        self.benchmark = benchmark
+        self.period = period
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.downloader = downloader
+        self.lock = threading.Lock()
+        self.symbols = []
+        self.index = {}
+        # symbol -> time.monotonic() of the download that found no data for it
+        self.not_found = {}
+        self.loaded_at = 0.0
+        self._closes = None
+        self._last_closes = None
+        self._returns = None
+        self._covariance = None
+        self._betas = None
+
+    def ensure(self, symbols):
+        """
+        Make sure the returns of the symbols are cached, downloading only the missing ones.
+
+        Parameters:
+            symbols (list): The symbols.
+        """
+        now = time.monotonic()
+        with self.lock:
+            stale = now - self.loaded_at > self.ttl
+            wanted = self.symbols if stale else []
+            missing = [s for s in dict.fromkeys(symbols) if (s not in self.index or stale)
+                       and now - self.not_found.get(s, -self.not_found_ttl) >= self.not_found_ttl]
+            if not missing and not stale:
+                return
+        # The download runs without the lock, the other sessions keep using the cached returns
+        download = list(dict.fromkeys([self.benchmark] + wanted + missing))
+        closes = self.downloader(download, self.period).dropna(axis=1, how="all")
+        with self.lock:
+            for symbol in missing:
+                if symbol not in closes:
+                    self.not_found[symbol] = now
+            if not stale and self._closes is not None:
+                # Another session may have loaded some of the same symbols meanwhile
+                known = [self.benchmark] + [c for c in closes.columns if c in self._closes]
+                closes = self._closes.join(closes.drop(columns=known, errors="ignore"), how="outer")
+            self._load(closes.sort_index())
+
+    def analyze(self, positions, prices=None, confidence=0.95, candidates=None):
+        """
+        Compute the risk of a portfolio and of candidate portfolios in one batch.
+
+        Parameters:
+            positions (dict): The shares held by symbol.
+            prices (dict): The prices by symbol, the last close by default.
+            confidence (float): The VaR and CVaR confidence level.
+            candidates (list): Other position dicts to evaluate, e.g. after a trade.
+
+        Returns:
+            reports (list): One report per portfolio, the current one first.
+        """
+        portfolios = [positions] + list(candidates or [])
+        symbols = sorted({s for portfolio in portfolios for s, q in portfolio.items() if q})
+        if not symbols:
+            return [self._empty_report(confidence) for _ in portfolios]
+        self.ensure(symbols)
+
+        with self.lock:
+            columns = np.array([self.index[s] for s in symbols if s in self.index], dtype=int)
+            known = [s for s in symbols if s in self.index]
+            not_found = [s for s in symbols if s not in self.index]
+            last_closes = self._last_closes
+            price_vector = np.array([float((prices or {}).get(s) or last_closes[s]) for s in known])
+            returns = self._returns[:, columns]
+            covariance = self._covariance[np.ix_(columns, columns)]
+            betas = self._betas[columns]
+
+        # Positions as a (portfolios x symbols) matrix of values
+        shares = np.array([[portfolio.get(s, 0) for s in known] for portfolio in portfolios], dtype=float)
+        values = shares * price_vector
+        totals = values.sum(axis=1)
+        gross = np.abs(values).sum(axis=1)
+        # Weights of the gross exposure, so that short positions do not blow them up
+        weights = values / np.where(gross > 0, gross, 1.0)[:, None]
+
+        daily_variance = np.einsum("pi,ij,pj->p", weights, covariance, weights)
+        daily_volatility = np.sqrt(np.maximum(daily_variance, 0.0))
+        portfolio_betas = weights @ betas
+
+        # Historical VaR and CVaR from the simulated daily portfolio returns
+        portfolio_returns = returns @ weights.T
+        cutoff = np.quantile(portfolio_returns, 1 - confidence, axis=0)
+        tail = portfolio_returns <= cutoff
+        tail_mean = (portfolio_returns * tail).sum(axis=0) / np.maximum(tail.sum(axis=0), 1)
+
+        # Parametric (normal) VaR and CVaR
+        mean = portfolio_returns.mean(axis=0)
+        z = NormalDist().inv_cdf(confidence)
+        parametric_var = z * daily_volatility - mean
+        parametric_cvar = daily_volatility * np.exp(-z * z / 2) / np.sqrt(2 * np.pi) / (1 - confidence) - mean
+
+        # Marginal and component contributions to the volatility
+        marginal = (weights @ covariance) / np.where(daily_volatility > 0, daily_volatility, 1.0)[:, None]
+        contributions = weights * marginal / np.where(daily_volatility > 0, daily_volatility, 1.0)[:, None]
+
+        reports = []
+        for p in range(len(portfolios)):
+            if not gross[p]:
+                reports.append(self._empty_report(confidence, not_found))
+                continue
+            order = np.argsort(-np.abs(contributions[p]))[:5]
+            reports.append({
+                "value": float(totals[p]),
+                "annual_volatility": float(daily_volatility[p] * np.sqrt(TRADING_DAYS)),
+                "beta": float(portfolio_betas[p]),
+                "historical_var": float(-cutoff[p] * gross[p]),
+                "historical_cvar": float(-tail_mean[p] * gross[p]),
+                "parametric_var": float(parametric_var[p] * gross[p]),
+                "parametric_cvar": float(parametric_cvar[p] * gross[p]),
+                "confidence": confidence,
+                "top_risk_contributions": {known[i]: float(contributions[p, i]) for i in order},
+                "not_found": not_found,
+            })
+        return reports
+
+    def check_trade(self, positions, stock_name, quantity, action, risk_level="medium", price=None,
+                    confidence=0.95):
+        """
+        Tell whether a trade keeps the portfolio within the risk level of the user.
+
+        Parameters:
+            positions (dict): The shares held by symbol.
+            stock_name (str): The symbol traded.
+            quantity (int): The number of shares.
+            action (str): "buy" or "sell".
+            risk_level (str): "low", "medium" or "high".
+            price (float): The trade price, the last close by default.
+            confidence (float): The VaR and CVaR confidence level.
+
+        Returns:
+            report (dict): The risk before and after the trade and the verdict, None when the traded
+                stock has no price history.
+        """
+        proposed = dict(positions)
+        signed = quantity if action == "buy" else -quantity
+        proposed[stock_name] = proposed.get(stock_name, 0) + signed
+        prices = {stock_name: price} if price else None
+        current, after = self.analyze(positions, prices, confidence, candidates=[proposed])
+        limit = RISK_LEVEL_VOLATILITY.get(risk_level, RISK_LEVEL_VOLATILITY["medium"])
+        report = {
+            "current": current,
+            "after_trade": after,
+            "risk_level": risk_level,
+            "volatility_limit": limit,
+            "within_risk": after["annual_volatility"] <= limit,
+        }
+        if stock_name in after["not_found"]:
+            # The risk after the trade leaves the stock out, it says nothing about the trade
+            report["within_risk"] = None
+            report["note"] = f"No price history for {stock_name}, the risk of this trade is unknown"
+        return report
+
+    def _load(self, closes):
+        closes = closes.dropna(axis=1, how="all")
+        returns = closes.pct_change(fill_method=None).iloc[1:].fillna(0.0)
+        self._closes = closes
+        self._last_closes = closes.ffill().iloc[-1]
+        self.symbols = [c for c in closes.columns if c != self.benchmark]
+        self.index = {s: i for i, s in enumerate(self.symbols)}
+        self._returns = returns[self.symbols].to_numpy()
+        self._covariance = np.atleast_2d(np.cov(self._returns, rowvar=False))
+
+        market = returns[self.benchmark].to_numpy() if self.benchmark in returns else np.zeros(len(returns))
+        centered_market = market - market.mean()
+        centered = self._returns - self._returns.mean(axis=0)
+        market_variance = centered_market @ centered_market
+        self._betas = (centered.T @ centered_market) / market_variance if market_variance else np.zeros(len(self.symbols))
+        self.loaded_at = time.monotonic()
+
+    @staticmethod
+    def _empty_report(confidence, not_found=()):
+        return {"value": 0.0, "annual_volatility": 0.0, "beta": 0.0, "historical_var": 0.0,
+                "historical_cvar": 0.0, "parametric_var": 0.0, "parametric_cvar": 0.0,
+                "confidence": confidence, "top_risk_contributions": {}, "not_found": list(not_found)}
+
+
+# Model shared by all the chat sessions of the process
+default_risk_model = PortfolioRiskModel()
@@ -0,0 +1,237 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import yfinance as yf
+
+from market_data import download_close_arrays, risk_statistics
+from price_feed import default_feed
+
+# Company names users type instead of the ticker
+COMPANY_SYMBOLS = {
+    "apple": "AAPL", "microsoft": "MSFT", "google": "GOOGL", "alphabet": "GOOGL", "amazon": "AMZN",
+    "tesla": "TSLA", "nvidia": "NVDA", "meta": "META", "facebook": "META", "netflix": "NFLX",
+    "amd": "AMD", "intel": "INTC", "ibm": "IBM", "oracle": "ORCL", "salesforce": "CRM", "adobe": "ADBE",
+    "paypal": "PYPL", "disney": "DIS", "coca-cola": "KO", "coca cola": "KO", "pepsi": "PEP",
+    "mcdonald's": "MCD", "mcdonalds": "MCD", "nike": "NKE", "walmart": "WMT", "boeing": "BA",
+    "visa": "V", "mastercard": "MA", "jpmorgan": "JPM", "goldman sachs": "GS", "berkshire": "BRK-B",
+    "exxon": "XOM", "chevron": "CVX", "pfizer": "PFE", "johnson & johnson": "JNJ", "uber": "UBER",
+    "airbnb": "ABNB", "spotify": "SPOT", "shopify": "SHOP", "coinbase": "COIN", "palantir": "PLTR",
+}
+COMPANY = re.compile(r"\b(" + "|".join(re.escape(name) for name in sorted(COMPANY_SYMBOLS, key=len, reverse=True)) + r")\b",
+                     re.I)
+TICKER = re.compile(r"\$?\b([A-Z]{2,5}(?:-[A-Z])?)\b")
+# Upper case words that are not tickers
+NOT_TICKERS = {"OK", "USD", "EUR", "GBP", "CEO", "CFO", "ETF", "IPO", "AI", "API", "PE", "EPS", "YES", "NO", "ASAP",
+               "FAQ", "US", "UK", "EU", "USA", "THE", "AND", "VAR", "CVAR", "BUY", "SELL", "TO", "OR", "IS", "IT",
+               "IN", "ON", "OF", "MY", "ME", "DO", "SO", "BE", "AT", "AN", "AS", "IF", "UP", "WANT", "WHAT", "HOW"}
+
+
+def detect_symbols(text, known=(), max_symbols=3):
+    """
+    Detect the stocks a user message is about, without any network call.
+
+    Parameters:
+        text (str): The user message.
+        known (iterable): Symbols already seen in the conversation, matched in any case.
+        max_symbols (int): The maximum number of symbols returned.
+
+    Returns:
+        symbols (list): The symbols in order of appearance.
+    """
+    found = []
+    for match in COMPANY.finditer(text):
+        found.append((match.start(), COMPANY_SYMBOLS[match.group(1).lower()]))
+    words = re.findall(r"[A-Za-z]+", text)
+    # In a message typed in capitals every word looks like a ticker
+    if sum(word.isupper() for word in words) * 2 <= len(words):
+        for match in TICKER.finditer(text):
+            if match.group(1) not in NOT_TICKERS:
+                found.append((match.start(), match.group(1)))
+    for symbol in known:
+        for match in re.finditer(r"\b" + re.escape(symbol) + r"\b", text, re.I):
+            found.append((match.start(), symbol.upper()))
+    symbols = dict.fromkeys(symbol for _, symbol in sorted(found))
+    return list(symbols)[:max_symbols]
+
+
+def fetch_stock_info(stock_name, price_feed=None):
+    """
+    Fetch the data behind the get_stock_info tool.
+
+    Parameters:
+        stock_name (str): The symbol.
+        price_feed (PriceFeed): The feed giving the last price, default_feed by default.
+
+    Returns:
+        (price, volatility, beta_st, beta_lt) (tuple): The last price, the annual volatility and the 1 and 5 year betas.
+    """
+    price_feed = price_feed or default_feed
+    stock_price = price_feed.last_price(stock_name)
+    if stock_price is None:
+        stock_price = yf.Ticker(stock_name).history(period="1d")["Close"].values[0]
+
+    daily_dates, daily_closes = download_close_arrays(stock_name, "1y", "1d")
+    market_daily_dates, market_daily_closes = download_close_arrays("^GSPC", "1y", "1d")
+    monthly_dates, monthly_closes = download_close_arrays(stock_name, "5y", "1mo")
+    market_monthly_dates, market_monthly_closes = download_close_arrays("^GSPC", "5y", "1mo")
+
+    # A few hundred closes take well under a millisecond, less than a round trip to the compute pool
+    output = np.empty(3)
+    risk_statistics(output, daily_dates, daily_closes, market_daily_dates, market_daily_closes,
+                    monthly_dates, monthly_closes, market_monthly_dates, market_monthly_closes)
+    volatility, beta_st, beta_lt = output
+    return float(stock_price), float(volatility), float(beta_st), float(beta_lt)
+
+
+class Prefetcher:
+    """
+    Speculatively fetch the data of the stocks a user message mentions.
+
+    The fetches start in background threads while the first completion is in
+    flight, so that the tool call the model then makes finds them done or under
+    way. Results are shared by the sessions and kept for ttl seconds.
+
+    Attributes:
+        fetch: The function fetching the data of a symbol.
+        ttl (float): The seconds a prefetched result stays valid.
+        hits (int): Tool calls served by a prefetch, finished or in flight.
+        misses (int): Tool calls that had to fetch.
+        wasted (int): Prefetches expired without being used.
+        saved_seconds (float): The fetch time hidden behind the completions.
+    """
+
+    def __init__(self, fetch=fetch_stock_info, max_workers=4, ttl=60.0):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        # symbol -> [future, submitted, used]
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.wasted = 0
+        self.saved_seconds = 0.0
+
+    def _timed_fetch(self, symbol):
+        start_time = time.perf_counter()
+        result = self.fetch(symbol)
+        return result, time.perf_counter() - start_time
+
+    def _expire(self, now):
+        for symbol, (future, submitted, used) in list(self.entries.items()):
+            if future.done() and now - submitted > self.ttl:
+                del self.entries[symbol]
+                self.wasted += not used
+
+    def prefetch(self, symbols):
+        """
+        Start fetching symbols in the background, unless they already are.
+
+        Parameters:
+            symbols (list): The symbols.
+        """
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            for symbol in symbols:
+                symbol = symbol.upper()
+                if symbol not in self.entries:
+                    self.entries[symbol] = [self.executor.submit(self._timed_fetch, symbol), now, False]
+
+    def get(self, symbol, timeout=None):
+        """
+        Get the data of a symbol, from a prefetch when there is one.
+
+        A miss is fetched in the prefetch threads too and kept for ttl seconds.
+
+        Parameters:
+            symbol (str): The symbol.
+            timeout (float): The seconds to wait for a prefetch in flight.
+
+        Returns:
+            result: The result of fetch for the symbol.
+        """
+        symbol = symbol.upper()
+        with self.lock:
+            self._expire(time.time())
+            entry = self.entries.get(symbol)
+        if entry is not None:
+            start_time = time.perf_counter()
+            try:
+                result, duration = entry[0].result(timeout)
+            except Exception:
+                # A failed or slow speculation is fetched again like a miss
+                with self.lock:
+                    if self.entries.get(symbol) is entry:
+                        del self.entries[symbol]
+            else:
+                with self.lock:
+                    entry[2] = True
+                    self.hits += 1
+                    self.saved_seconds += max(duration - (time.perf_counter() - start_time), 0.0)
+                return result
+        with self.lock:
+            self.misses += 1
+            # Fetched as an entry, so that a fetch outliving a timed out turn serves the next one
+            entry = self.entries.get(symbol)
+            if entry is None:
+                entry = self.entries[symbol] = [self.executor.submit(self._timed_fetch, symbol), time.time(), True]
+        try:
+            return entry[0].result()[0]
+        except Exception:
+            with self.lock:
+                if self.entries.get(symbol) is entry:
+                    del self.entries[symbol]
+            raise
+
+    def peek(self, symbol):
+        """
+        Get the data of a symbol if a fetch of it is already done, without waiting.
+
+        Parameters:
+            symbol (str): The symbol.
+
+        Returns:
+            result: The result of fetch for the symbol, None when there is none.
+        """
+        with self.lock:
+            entry = self.entries.get(symbol.upper())
+        if entry is None or not entry[0].done() or entry[0].exception() is not None:
+            return None
+        return entry[0].result()[0]
+
+    def stats(self):
+        """
+        Get the prefetch metrics.
+
+        Returns:
+            stats (dict): The hits, misses, hit rate, wasted prefetches and saved seconds.
+        """
+        with self.lock:
+            calls = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / calls, 4) if calls else None,
+                "wasted": self.wasted,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
+
+    def report(self):
+        """
+        Summarize the prefetch metrics.
+
+        Returns:
+            report (str): The metrics in one line.
+        """
+        stats = self.stats()
+        return (f"Prefetch: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']}, "
+                f"{stats['wasted']} wasted, {stats['saved_seconds']}s saved")
+
+
+
+# Prefetcher shared by the chat sessions of the process
+default_prefetcher = Prefetcher()
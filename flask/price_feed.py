@@ -0,0 +1,364 @@
+import asyncio
+import random
+import threading
+import time
+from collections import namedtuple
+
+import pandas as pd
+import yfinance as yf
+
+from market_data import normalize_symbol
+
+Quote = namedtuple("Quote", ["symbol", "price", "timestamp"])
+
+
+class YFinancePoller:
+    """
+    A price source polling yfinance for the last trade of the watched symbols.
+
+    All the watched symbols are fetched with one bulk download per poll.
+
+    Attributes:
+        interval (float): The seconds between two polls.
+    """
+
+    def __init__(self, interval=15.0):
+        self.interval = interval
+
+    async def run(self, feed):
+        loop = asyncio.get_running_loop()
+        while True:
+            symbols = sorted(feed.watched)
+            if symbols:
+                try:
+                    quotes = await loop.run_in_executor(None, self.fetch, symbols)
+                    feed.publish(quotes)
+                except Exception as e:
+                    print(f"Price poll failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def fetch(symbols):
+        data = yf.download(symbols, period="1d", interval="1m", progress=False)
+        closes = data["Close"]
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(symbols[0])
+        # Stamped with the poll time: the age of a quote is the age of our knowledge of it
+        now = time.time()
+        quotes = []
+        for symbol in symbols:
+            if symbol not in closes:
+                continue
+            series = closes[symbol].dropna()
+            if len(series):
+                quotes.append(Quote(symbol, float(series.iloc[-1]), now))
+        return quotes
+
+
+class SimulatedSource:
+    """
+    A local price source moving the prices of the watched symbols as random walks.
+
+    Attributes:
+        prices (dict): The starting prices, symbols not listed start at 100.
+        volatility (float): The standard deviation of a tick return.
+        interval (float): The seconds between two ticks.
+    """
+
+    def __init__(self, prices=None, volatility=0.001, interval=0.1, seed=None):
+        self.prices = dict(prices or {})
+        self.listed = frozenset(self.prices)
+        self.volatility = volatility
+        self.interval = interval
+        self.random = random.Random(seed)
+
+    async def run(self, feed):
+        while True:
+            now = time.time()
+            quotes = []
+            for symbol in sorted(feed.watched | self.listed):
+                price = self.prices.get(symbol, 100.0) * (1 + self.random.gauss(0, self.volatility))
+                self.prices[symbol] = price
+                quotes.append(Quote(symbol, price, now))
+            feed.publish(quotes)
+            await asyncio.sleep(self.interval)
+
+
+class ReplaySource:
+    """
+    A price source replaying recorded ticks, e.g. in tests.
+
+    Attributes:
+        ticks (list): (timestamp, symbol, price) tuples sorted by timestamp.
+        speed (float): The replay speed, 0 to replay without waiting.
+    """
+
+    def __init__(self, ticks, speed=1.0):
+        self.ticks = ticks
+        self.speed = speed
+
+    async def run(self, feed):
+        previous = None
+        for timestamp, symbol, price in self.ticks:
+            if previous is not None and self.speed:
+                await asyncio.sleep((timestamp - previous) / self.speed)
+            else:
+                await asyncio.sleep(0)
+            previous = timestamp
+            feed.publish([Quote(symbol, float(price), timestamp)])
+
+
+class Subscription:
+    """
+    The updates of a price feed for one consumer, e.g. a chat session.
+
+    Updates are coalesced per symbol: a slow consumer only ever receives the
+    latest quote of each symbol, so it never falls behind or blocks the feed.
+
+    Attributes:
+        symbols (set): The symbols of interest, None for all.
+    """
+
+    def __init__(self, feed, symbols=None):
+        self.feed = feed
+        self.symbols = set(symbols) if symbols is not None else None
+        self._pending = {}
+        self._ready = asyncio.Queue(maxsize=1)
+        self.coalesced = 0
+
+    def offer(self, quote):
+        if self.symbols is not None and quote.symbol not in self.symbols:
+            return
+        if quote.symbol in self._pending:
+            self.coalesced += 1
+        self._pending[quote.symbol] = quote
+        if self._ready.empty():
+            self._ready.put_nowait(True)
+
+    async def get(self):
+        """
+        Wait for updates.
+
+        Returns:
+            quotes (dict): The latest quote of every symbol updated since the last call.
+        """
+        await self._ready.get()
+        quotes, self._pending = self._pending, {}
+        return quotes
+
+    def close(self):
+        """Stop receiving updates."""
+        self.feed.unsubscribe(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class PriceFeed:
+    """
+    A local price feed keeping the last trade of every symbol in memory.
+
+    A pluggable source publishes the quotes; tools read the last trade in O(1)
+    and async consumers subscribe to receive the updates. The feed runs its own
+    event loop in a background thread so that the synchronous Flask app can use it.
+    A symbol no subscription asks for and not watched for watch_ttl seconds is no
+    longer kept up to date.
+
+    Attributes:
+        max_age (float): The seconds after which a quote is considered stale.
+        watch_ttl (float): The seconds a watched symbol is kept up to date after the last watch.
+        watched (set): The symbols the source keeps up to date.
+    """
+
+    def __init__(self, max_age=60.0, watch_ttl=3600.0):
+        self.max_age = max_age
+        self.watch_ttl = watch_ttl
+        self.watched = set()
+        # symbol -> time.time() of the last watch
+        self.watched_at = {}
+        self.watch_lock = threading.Lock()
+        self._next_expiry = time.time() + watch_ttl
+        self.quotes = {}
+        self.subscriptions = set()
+        self.loop = None
+        self._thread = None
+        self._task = None
+
+    def start(self, source):
+        """
+        Start publishing the quotes of a source in a background event loop.
+
+        Parameters:
+            source: A YFinancePoller, SimulatedSource, ReplaySource or any object with an async run(feed).
+        """
+        if self._thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self._task = self.loop.create_task(source.run(self))
+            self.loop.call_soon(started.set)
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="price-feed", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        """Stop the background event loop."""
+        if self._thread is None:
+            return
+
+        async def shutdown():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        self._thread.join()
+        self._thread = None
+
+    def watch(self, symbols):
+        """
+        Ask the source to keep some symbols up to date.
+
+        Parameters:
+            symbols (list): The symbols.
+        """
+        if isinstance(symbols, str):
+            symbols = [symbols]
+        symbols = {normalize_symbol(symbol) for symbol in symbols}
+        now = time.time()
+        with self.watch_lock:
+            self.watched_at.update(dict.fromkeys(symbols, now))
+            # Replaced rather than updated, the source iterates it from the feed thread
+            self.watched = self.watched | symbols
+
+    def expire(self):
+        """Stop keeping up to date the symbols no subscription asks for and not watched for watch_ttl seconds."""
+        cutoff = time.time() - self.watch_ttl
+        subscribed = set()
+        for subscription in tuple(self.subscriptions):
+            subscribed |= subscription.symbols or set()
+        with self.watch_lock:
+            expired = {symbol for symbol, watched_at in self.watched_at.items()
+                       if watched_at < cutoff and symbol not in subscribed}
+            if not expired:
+                return
+            for symbol in expired:
+                del self.watched_at[symbol]
+                self.quotes.pop(symbol, None)
+            self.watched = self.watched - expired
+
+    def last(self, symbol, max_age=None):
+        """
+        Get the last trade of a symbol.
+
+        Parameters:
+            symbol (str): The symbol.
+            max_age (float): The maximum age in seconds, the feed's max_age by default.
+
+        Returns:
+            quote (Quote): The last quote, None when unknown or stale.
+        """
+        quote = self.quotes.get(normalize_symbol(symbol))
+        if quote is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        if max_age is not None and time.time() - quote.timestamp > max_age:
+            return None
+        return quote
+
+    def last_price(self, symbol, max_age=None):
+        """
+        Get the last price of a symbol.
+
+        Parameters:
+            symbol (str): The symbol.
+            max_age (float): The maximum age in seconds, the feed's max_age by default.
+
+        Returns:
+            price (float): The last price, None when unknown or stale.
+        """
+        quote = self.last(symbol, max_age)
+        return quote.price if quote is not None else None
+
+    def publish(self, quotes):
+        """
+        Update the last trades and fan them out to the subscriptions.
+
+        Must be called from the feed's event loop.
+
+        Parameters:
+            quotes (list): The new quotes.
+        """
+        for quote in quotes:
+            self.quotes[quote.symbol] = quote
+            for subscription in tuple(self.subscriptions):
+                subscription.offer(quote)
+        if time.time() >= self._next_expiry:
+            self._next_expiry = time.time() + self.watch_ttl / 10
+            self.expire()
+
+    def subscribe(self, symbols=None):
+        """
+        Subscribe to the updates of some symbols, from the feed's event loop.
+
+        Parameters:
+            symbols (list): The symbols, None for all.
+
+        Returns:
+            subscription (Subscription): The subscription to read the updates from.
+        """
+        if symbols:
+            self.watch(symbols)
+        subscription = Subscription(self, [normalize_symbol(s) for s in symbols] if symbols else None)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def updates(self, symbols=None, timeout=15.0):
+        """
+        Iterate over the updates of some symbols from a synchronous thread, e.g. a streaming response.
+
+        Parameters:
+            symbols (list): The symbols, None for all.
+            timeout (float): The seconds to wait for an update before yielding an empty dict.
+
+        Yields:
+            quotes (dict): The latest quote of every symbol updated since the previous dict.
+        """
+        async def subscribe():
+            return self.subscribe(symbols)
+
+        subscription = asyncio.run_coroutine_threadsafe(subscribe(), self.loop).result()
+        try:
+            while True:
+                update = asyncio.run_coroutine_threadsafe(asyncio.wait_for(subscription.get(), timeout), self.loop)
+                try:
+                    yield update.result()
+                except asyncio.TimeoutError:
+                    # Lets the consumer check that its client is still there
+                    yield {}
+        finally:
+            self.loop.call_soon_threadsafe(subscription.close)
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscription.
+
+        Parameters:
+            subscription (Subscription): The subscription.
+        """
+        self.subscriptions.discard(subscription)
+
+
+# Feed shared by all the chat sessions of the process
+default_feed = PriceFeed()
@@ -0,0 +1,272 @@
+import argparse
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from market_data import normalize_symbols, risk_statistics
+
+MAGIC = b"FBRS"
+FORMAT_VERSION = 1
+# magic, format version, generation, number of records, created timestamp, padded to 32 bytes
+HEADER = struct.Struct("<4sIIIdxxxxxxxx")
+RECORD = np.dtype([
+    ("symbol", "S12"),
+    ("price", "<f8"),
+    ("volatility", "<f8"),
+    ("beta_st", "<f8"),
+    ("beta_lt", "<f8"),
+    ("return_1y", "<f8"),
+    ("high_52w", "<f8"),
+    ("low_52w", "<f8"),
+    ("max_drawdown_1y", "<f8"),
+    ("as_of", "<f8"),
+    ("updated", "<f8"),
+])
+MARKET = "^GSPC"
+SP500_URL = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
+# The names users ask about most, the default universe
+POPULAR = ["AAPL", "MSFT", "GOOGL", "AMZN", "TSLA", "NVDA", "META", "NFLX", "AMD", "INTC", "IBM", "ORCL", "CRM",
+           "ADBE", "PYPL", "DIS", "KO", "PEP", "MCD", "NKE", "WMT", "BA", "V", "MA", "JPM", "GS", "BRK-B", "XOM",
+           "CVX", "PFE", "JNJ", "UBER", "ABNB", "SPOT", "SHOP", "COIN", "PLTR", "SPY", "QQQ"]
+
+
+def load_universe(name):
+    """
+    Get the symbols of a universe.
+
+    Parameters:
+        name (str): popular, sp500, a file with one symbol per line or a comma separated list of symbols.
+
+    Returns:
+        symbols (list): The symbols.
+    """
+    if name == "popular":
+        return list(POPULAR)
+    if name == "sp500":
+        table = pd.read_html(SP500_URL)[0]
+        return normalize_symbols([symbol.replace(".", "-") for symbol in table["Symbol"]])
+    if os.path.exists(name):
+        with open(name) as f:
+            return normalize_symbols([line.split("#")[0] for line in f])
+    return normalize_symbols(name)
+
+
+def _close_arrays(series):
+    series = series.dropna()
+    return series.index.values.astype("datetime64[ns]").astype(np.int64), series.to_numpy(dtype=float)
+
+
+def _monthly(series):
+    # Last close of every month, stamped with its trading day like the live monthly bars
+    series = series.dropna()
+    return series.groupby(series.index.to_period("M")).tail(1)
+
+
+def compute_records(symbols, chunk_size=100, now=None):
+    """
+    Compute the snapshot records of a universe from 5 years of daily closes.
+
+    Parameters:
+        symbols (list): The symbols.
+        chunk_size (int): The number of symbols per bulk download.
+        now (float): The timestamp of the records, the current time by default.
+
+    Returns:
+        records (np.ndarray): The RECORD array, sorted by symbol, without the symbols lacking data.
+    """
+    now = time.time() if now is None else now
+    market = yf.download(MARKET, period="5y", interval="1d", auto_adjust=True, progress=False)["Close"]
+    if isinstance(market, pd.DataFrame):
+        market = market.iloc[:, 0]
+    year_start = market.index[-1] - pd.DateOffset(years=1)
+    market_daily = _close_arrays(market[market.index > year_start])
+    market_monthly = _close_arrays(_monthly(market))
+
+    rows = []
+    output = np.empty(3)
+    for start in range(0, len(symbols), chunk_size):
+        chunk = symbols[start:start + chunk_size]
+        closes = yf.download(chunk, period="5y", interval="1d", auto_adjust=True, progress=False)["Close"]
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(chunk[0])
+        for symbol in chunk:
+            if symbol not in closes:
+                continue
+            series = closes[symbol].dropna()
+            year = series[series.index > year_start]
+            if len(year) < 20 or len(_monthly(series)) < 12:
+                print(f"Not enough history for {symbol}, skipped")
+                continue
+            daily_dates, daily_closes = _close_arrays(year)
+            monthly_dates, monthly_closes = _close_arrays(_monthly(series))
+            risk_statistics(output, daily_dates, daily_closes, *market_daily,
+                            monthly_dates, monthly_closes, *market_monthly)
+            running_max = np.maximum.accumulate(daily_closes)
+            rows.append((
+                symbol.encode(), daily_closes[-1], output[0], output[1], output[2],
+                daily_closes[-1] / daily_closes[0] - 1, daily_closes.max(), daily_closes.min(),
+                (daily_closes / running_max - 1).min(), daily_dates[-1] / 1e9, now,
+            ))
+    records = np.array(rows, dtype=RECORD)
+    return records[np.argsort(records["symbol"])]
+
+
+def write_snapshot(path, records):
+    """
+    Write a snapshot file, replacing the previous one atomically.
+
+    Parameters:
+        path (str): The snapshot file.
+        records (np.ndarray): The RECORD array sorted by symbol.
+
+    Returns:
+        generation (int): The generation of the new snapshot, one more than the replaced one.
+    """
+    generation = 1
+    if os.path.exists(path):
+        try:
+            generation = read_header(path)[1] + 1
+        except ValueError:
+            pass
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, generation, len(records), time.time()))
+        f.write(np.ascontiguousarray(records, dtype=RECORD).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    # Readers keep mapping the old file until they notice the new one
+    os.replace(temporary, path)
+    return generation
+
+
+def read_header(path):
+    """
+    Read the header of a snapshot file.
+
+    Parameters:
+        path (str): The snapshot file.
+
+    Returns:
+        (format_version, generation, count, created) (tuple): The header fields.
+    """
+    with open(path, "rb") as f:
+        magic, format_version, generation, count, created = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} risk snapshot")
+    return format_version, generation, count, created
+
+
+class RiskSnapshot:
+    """
+    Read only view of the risk snapshot file written by the batch job.
+
+    The records are memory-mapped and found through a symbol index, so a lookup
+    costs a dictionary access and a row read. The file is mapped again when the
+    batch job replaces it.
+
+    Attributes:
+        path (str): The snapshot file.
+        max_age (float): The seconds after which a record is stale.
+        generation (int): The generation of the mapped snapshot, 0 when there is none.
+    """
+
+    def __init__(self, path="risk_snapshot.bin", max_age=36 * 3600, check_interval=5.0):
+        self.path = path
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.generation = 0
+        # (symbol index, records), swapped as one so that a lookup never mixes two files
+        self.view = ({}, None)
+        self.lock = threading.Lock()
+        self._checked = float("-inf")
+        self._stat = None
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self.lock:
+            self._checked = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.view, self.generation, self._stat = ({}, None), 0, None
+                return
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if key == self._stat:
+                return
+            try:
+                _, generation, count, _ = read_header(self.path)
+            except (ValueError, struct.error) as e:
+                print(f"Risk snapshot not loaded: {str(e)}")
+                return
+            if count:
+                records = np.memmap(self.path, dtype=RECORD, mode="r", offset=HEADER.size, shape=(count,))
+            else:
+                records = np.empty(0, dtype=RECORD)
+            index = {symbol.decode(): row for row, symbol in enumerate(records["symbol"])}
+            self.view, self.generation, self._stat = (index, records), generation, key
+
+    def lookup(self, symbol, max_age=None):
+        """
+        Get the record of a symbol.
+
+        Parameters:
+            symbol (str): The symbol.
+            max_age (float): The seconds after which the record is stale, self.max_age by default.
+
+        Returns:
+            record (dict): The RECORD fields, None when the symbol is missing or stale.
+        """
+        self._refresh()
+        index, records = self.view
+        row = index.get(symbol.upper())
+        if row is None:
+            return None
+        record = records[row]
+        if time.time() - record["updated"] > (self.max_age if max_age is None else max_age):
+            return None
+        return {name: record[name].item() for name in RECORD.names[1:]}
+
+    def __contains__(self, symbol):
+        return self.lookup(symbol) is not None
+
+
+# Snapshot read by all the chat sessions of the process
+default_snapshot = RiskSnapshot(os.getenv("RISK_SNAPSHOT", "risk_snapshot.bin"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or read the risk snapshot of a universe of stocks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="compute the snapshot of a universe")
+    build.add_argument("--universe", default="popular",
+                       help="popular, sp500, a file with one symbol per line or a comma separated list")
+    build.add_argument("--output", default=os.getenv("RISK_SNAPSHOT", "risk_snapshot.bin"))
+    build.add_argument("--chunk-size", type=int, default=100)
+    show = commands.add_parser("show", help="print the records of some symbols")
+    show.add_argument("symbols", nargs="+")
+    show.add_argument("--snapshot", default=os.getenv("RISK_SNAPSHOT", "risk_snapshot.bin"))
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start_time = time.perf_counter()
+        symbols = load_universe(args.universe)
+        records = compute_records(symbols, chunk_size=args.chunk_size)
+        generation = write_snapshot(args.output, records)
+        print(f"Wrote generation {generation} of {args.output}: {len(records)}/{len(symbols)} symbols, "
+              f"{os.path.getsize(args.output)} bytes")
+        print(f"Run time: {time.perf_counter() - start_time} seconds")
+    else:
+        snapshot = RiskSnapshot(args.snapshot, max_age=float("inf"))
+        for symbol in normalize_symbols(args.symbols):
+            print(symbol, snapshot.lookup(symbol))
+
+
+if __name__ == "__main__":
+    main()
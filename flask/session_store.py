@@ -0,0 +1,262 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a session was saved by another worker since it was loaded."""
+
+
+def serialize(state):
+    """
+    Serialize a session state, with msgpack when it is installed.
+
+    Parameters:
+        state (dict): The session state.
+
+    Returns:
+        data (bytes): The serialized state.
+    """
+    if msgpack is not None:
+        return b"m" + msgpack.packb(state, use_bin_type=True)
+    return b"j" + json.dumps(state, separators=(",", ":")).encode()
+
+
+def deserialize(data):
+    """
+    Deserialize a session state written by serialize.
+
+    Parameters:
+        data (bytes): The serialized state.
+
+    Returns:
+        state (dict): The session state.
+    """
+    data = bytes(data)
+    if data[:1] == b"m":
+        return msgpack.unpackb(data[1:], raw=False)
+    return json.loads(data[1:])
+
+
+class SessionStore:
+    """
+    The interface of the conversation state stores.
+
+    Every save bumps the version of the session; a save is only accepted if the
+    session is still at the version it was loaded at (optimistic concurrency).
+    """
+
+    def load(self, session_id):
+        """
+        Load a session.
+
+        Parameters:
+            session_id (str): The session.
+
+        Returns:
+            (state, version) (tuple): The state, None and version 0 for a new session.
+        """
+        raise NotImplementedError
+
+    def version(self, session_id):
+        """
+        Get the current version of a session without loading it.
+
+        Parameters:
+            session_id (str): The session.
+
+        Returns:
+            version (int): The version, 0 for a new session.
+        """
+        raise NotImplementedError
+
+    def save(self, session_id, state, expected_version):
+        """
+        Save a session if nobody saved it since it was loaded.
+
+        Parameters:
+            session_id (str): The session.
+            state (dict): The new state.
+            expected_version (int): The version returned by load.
+
+        Returns:
+            version (int): The new version.
+
+        Raises:
+            ConcurrentUpdateError: The session is not at the expected version anymore.
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """
+        Delete a session.
+
+        Parameters:
+            session_id (str): The session.
+        """
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """A session store for a single worker process, e.g. in development."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        with self.lock:
+            data, version = self.sessions.get(session_id, (None, 0))
+        return (deserialize(data) if data is not None else None), version
+
+    def version(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id, (None, 0))[1]
+
+    def save(self, session_id, state, expected_version):
+        data = serialize(state)
+        with self.lock:
+            version = self.sessions.get(session_id, (None, 0))[1]
+            if version != expected_version:
+                raise ConcurrentUpdateError(f"Session {session_id} is at version {version}, not {expected_version}")
+            self.sessions[session_id] = (data, version + 1)
+            return version + 1
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    A session store in an embedded SQLite database in WAL mode.
+
+    Several worker processes on the same machine share it: WAL lets the readers
+    run while a writer commits. Each thread uses its own connection.
+
+    Attributes:
+        path (str): The database file.
+    """
+
+    def __init__(self, path="sessions.db", timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Durable at every checkpoint rather than every commit, fine for chat history
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def load(self, session_id):
+        row = self._connection().execute(
+            "SELECT data, version FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None, 0
+        return deserialize(row[0]), row[1]
+
+    def version(self, session_id):
+        row = self._connection().execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, session_id, state, expected_version):
+        data = serialize(state)
+        connection = self._connection()
+        with connection:
+            if expected_version == 0:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO sessions (id, version, data, updated) VALUES (?, 1, ?, ?)",
+                    (session_id, data, time.time()),
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE sessions SET version = version + 1, data = ?, updated = ? WHERE id = ? AND version = ?",
+                    (data, time.time(), session_id, expected_version),
+                )
+        if cursor.rowcount != 1:
+            raise ConcurrentUpdateError(f"Session {session_id} is not at version {expected_version} anymore")
+        return expected_version + 1
+
+    def delete(self, session_id):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+
+class CachedSessionStore(SessionStore):
+    """
+    A per worker read-through cache of the sessions in front of a shared store.
+
+    A load only asks the store for the version of the session, and reads and
+    deserializes the state when another worker has saved a newer one.
+
+    Attributes:
+        store (SessionStore): The shared store.
+        max_sessions (int): The number of sessions kept by the cache.
+    """
+
+    def __init__(self, store, max_sessions=1024):
+        self.store = store
+        self.max_sessions = max_sessions
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, session_id):
+        version = self.store.version(session_id)
+        with self.lock:
+            cached = self.cache.get(session_id)
+            if cached is not None and cached[1] == version:
+                self.cache.move_to_end(session_id)
+                self.hits += 1
+                # States are kept serialized, so every caller gets its own copy
+                return deserialize(cached[0]), version
+            self.misses += 1
+        state, version = self.store.load(session_id)
+        if state is not None:
+            self._remember(session_id, serialize(state), version)
+        return state, version
+
+    def version(self, session_id):
+        return self.store.version(session_id)
+
+    def save(self, session_id, state, expected_version):
+        try:
+            version = self.store.save(session_id, state, expected_version)
+        except ConcurrentUpdateError:
+            with self.lock:
+                self.cache.pop(session_id, None)
+            raise
+        self._remember(session_id, serialize(state), version)
+        return version
+
+    def delete(self, session_id):
+        with self.lock:
+            self.cache.pop(session_id, None)
+        self.store.delete(session_id)
+
+    def _remember(self, session_id, data, version):
+        with self.lock:
+            self.cache[session_id] = (data, version)
+            self.cache.move_to_end(session_id)
+            while len(self.cache) > self.max_sessions:
+                self.cache.popitem(last=False)
@@ -0,0 +1,240 @@
+import json
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.encoding_for_model("gpt-4o")
+except Exception:
+    # tiktoken is optional (and needs to download its BPE files once),
+    # fall back to the usual ~4 characters per token estimate.
+    _ENCODING = None
+
+
+def count_tokens(text):
+    """
+    Count the prompt tokens of a text.
+
+    Parameters:
+        text (str): The text.
+
+    Returns:
+        tokens (int): The number of tokens.
+    """
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def round_values(value, precision=2):
+    """
+    Recursively round the floats of a tool result.
+
+    Parameters:
+        value: A number, string, list or dict.
+        precision (int): The number of decimals to keep.
+
+    Returns:
+        value: The same structure with rounded floats.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (float, np.floating)):
+        return round(float(value), precision)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, dict):
+        return {key: round_values(item, precision) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [round_values(item, precision) for item in value]
+    return value
+
+
+def summarize_ohlcv(hist, precision=2):
+    """
+    Summarize an OHLCV DataFrame (as returned by yfinance) into a few statistics.
+
+    Parameters:
+        hist (pd.DataFrame): The history with Open, High, Low, Close and Volume columns.
+        precision (int): The number of decimals to keep.
+
+    Returns:
+        summary (dict): Range, return, drawdown, trend and volume profile.
+    """
+    close = hist["Close"].to_numpy(dtype=float)
+    if close.size == 0:
+        return {"bars": 0}
+    high = hist["High"].to_numpy(dtype=float) if "High" in hist else close
+    low = hist["Low"].to_numpy(dtype=float) if "Low" in hist else close
+    volume = hist["Volume"].to_numpy(dtype=float) if "Volume" in hist else None
+
+    index = hist.index
+    summary = {
+        "from": str(pd.Timestamp(index[0]).date()) if len(index) else None,
+        "to": str(pd.Timestamp(index[-1]).date()) if len(index) else None,
+        "bars": int(close.size),
+        "first_close": close[0],
+        "last_close": close[-1],
+        "low": float(np.min(low)),
+        "high": float(np.max(high)),
+        "return_pct": (close[-1] / close[0] - 1.0) * 100.0,
+    }
+
+    # Max drawdown from the running peak of the closes
+    running_peak = np.maximum.accumulate(close)
+    summary["max_drawdown_pct"] = float(np.min(close / running_peak - 1.0)) * 100.0
+
+    if close.size > 1:
+        log_returns = np.diff(np.log(close))
+        summary["daily_volatility_pct"] = float(np.std(log_returns, ddof=1)) * 100.0 if log_returns.size > 1 else 0.0
+        summary["up_days_pct"] = float(np.mean(log_returns > 0)) * 100.0
+
+        # Least squares slope of the log closes, expressed as % per bar
+        slope = np.polyfit(np.arange(close.size), np.log(close), 1)[0]
+        summary["trend_pct_per_bar"] = float(np.expm1(slope)) * 100.0
+        # Sideways when the fitted move over the whole window is under 5%, whatever the number of bars
+        if abs(np.expm1(slope * (close.size - 1))) < 0.05:
+            summary["trend"] = "sideways"
+        else:
+            summary["trend"] = "up" if slope > 0 else "down"
+
+    if volume is not None and volume.size:
+        average_volume = float(np.mean(volume))
+        summary["avg_volume"] = int(average_volume)
+        summary["last_volume_vs_avg"] = float(volume[-1] / average_volume) if average_volume else 0.0
+        # Share of the volume traded on up bars
+        if close.size > 1 and volume[1:].sum():
+            summary["up_volume_pct"] = float(volume[1:][np.diff(close) > 0].sum() / volume[1:].sum()) * 100.0
+
+    return round_values(summary, precision)
+
+
+def format_compact(value):
+    """
+    Serialize a tool result with as few tokens as possible.
+
+    Parameters:
+        value: A JSON serializable value.
+
+    Returns:
+        text (str): The compact text.
+    """
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(",", ":"), default=str)
+
+
+class ToolResultCompactor:
+    """
+    Turn tool results into compact prompt messages and keep the full data aside.
+
+    Tool results stay in the message history for the rest of the conversation, so
+    every token saved here is saved again on each later turn.
+
+    Attributes:
+        precision (int): The number of decimals kept in numbers.
+        max_tokens (int): The hard ceiling of tokens for a single tool message.
+        max_full_results (int): The number of uncompacted results kept, the oldest are dropped.
+        full_results (dict): The uncompacted results by reference, saved with the session.
+        saved_tokens (int): The tokens saved by the messages currently in the history.
+    """
+
+    def __init__(self, precision=2, max_tokens=250, max_full_results=8):
+        self.precision = precision
+        self.max_tokens = max_tokens
+        self.max_full_results = max_full_results
+        self.full_results = {}
+        self.saved_tokens = 0
+        self.turn_saved_tokens = 0
+
+    def start_turn(self):
+        """Reset the per turn statistics."""
+        self.turn_saved_tokens = 0
+
+    def compact(self, tool_name, result):
+        """
+        Compact a tool result into the content of a tool message.
+
+        Parameters:
+            tool_name (str): The name of the tool that produced the result.
+            result: The raw result of the tool.
+
+        Returns:
+            content (str): The compact content.
+        """
+        reference = None
+        if isinstance(result, pd.DataFrame):
+            full_text = result.to_csv(float_format=f"%.{self.precision}f")
+            reference = self._store(full_text)
+            content = format_compact(summarize_ohlcv(result, self.precision))
+        else:
+            full_text = format_compact(result) if not isinstance(result, (float, np.floating)) else str(result)
+            content = format_compact(round_values(result, self.precision))
+
+        if count_tokens(content) > self.max_tokens:
+            if reference is None:
+                reference = self._store(full_text)
+            # Leave room for the reference suffix below
+            content = self._truncate(content, self.max_tokens - 12)
+        if reference is not None:
+            content += f" [full data: ref={reference}]"
+
+        saved = max(count_tokens(full_text) - count_tokens(content), 0)
+        self.saved_tokens += saved
+        self.turn_saved_tokens += saved
+        return content
+
+    def get_full_result(self, reference):
+        """
+        Get the full data of a compacted tool result.
+
+        Parameters:
+            reference (str): The reference printed in the compacted message.
+
+        Returns:
+            result (str): The full result.
+        """
+        return self.full_results.get(reference, "No data stored under this reference anymore, call the tool again.")
+
+    def collapse_full_result(self, reference):
+        """
+        Get the content replacing a get_full_data result once its turn is answered.
+
+        Parameters:
+            reference (str): The reference of the full data.
+
+        Returns:
+            content (str): A short note, the full data stays available under its reference.
+        """
+        content = f"[full data of ref={reference} used for that answer, call get_full_data again to see it]"
+        saved = max(count_tokens(self.get_full_result(reference)) - count_tokens(content), 0)
+        self.saved_tokens += saved
+        self.turn_saved_tokens += saved
+        return content
+
+    def report(self):
+        """
+        Report the token savings.
+
+        Returns:
+            report (str): The savings of this turn and per later turn.
+        """
+        return (f"Tool compaction saved {self.turn_saved_tokens} tokens this turn, "
+                f"{self.saved_tokens} tokens on every following turn.")
+
+    def _store(self, full_text):
+        reference = uuid.uuid4().hex[:8]
+        self.full_results[reference] = full_text
+        # A 5 year history is ~15k tokens of CSV, written with the session on every turn
+        for old in list(self.full_results)[:-self.max_full_results]:
+            del self.full_results[old]
+        return reference
+
+    def _truncate(self, content, max_tokens):
+        # Cut proportionally, then trim until the ceiling is met
+        keep = int(len(content) * max_tokens / max(count_tokens(content), 1))
+        while keep > 0 and count_tokens(content[:keep]) > max_tokens:
+            keep = int(keep * 0.9)
+        return content[:keep] + "…"
@@ -1,9 +1,29 @@
-from openai import OpenAI
+from openai import APITimeoutError, OpenAI
 from configparser import ConfigParser
 import json
+import logging
 import os
 import yfinance as yf
-import numpy as np
+import uuid
+
+from backtest import default_backtester
+from conversation_flow import PROFILE, READY, ConversationFlow
+from deadline import TURN_BUDGET, Deadline, DeadlineExceeded, call_with_deadline
+from indicators import default_indicators, format_indicators
+from market_data import get_quotes, normalize_symbol
+from model_router import RouteDecision, default_router
+from paper_trading import OrderRejected, default_engine
+from portfolio_risk import default_risk_model
+from prefetch import default_prefetcher, detect_symbols
+from risk_snapshot import default_snapshot
+from price_feed import default_feed
+from tool_compaction import ToolResultCompactor
+from trade_ledger import LedgerError
+
+logger = logging.getLogger(__name__)
+
+# Content of a tool that did not finish within the turn, its fetch goes on and warms the caches
+TIMED_OUT = "Not available yet: the data took too long to fetch. It is still being fetched, the user can ask again in a moment."
 
 
 class GPTAssistant:
@@ -12,15 +32,42 @@ class GPTAssistant:
 
     Attributes:
         client (OpenAI): The OpenAI client.
-        default_model (str): The default model.
+        default_model (str): The model of every turn, None to let the router pick one per turn.
+        router (ModelRouter): Picks the model of each turn and logs the latency of the calls.
         assistant_prompt (dict): The assistant prompt.
         messages (list): The messages.
+        compactor (ToolResultCompactor): Compacts the tool results added to the messages.
+        session_id (str): The session used for the paper-trading account.
+        trading_engine (PaperTradingEngine): The engine the trades are submitted to.
+        risk_model (PortfolioRiskModel): The portfolio risk analytics.
+        price_feed (PriceFeed): The local feed of the last trades.
+        flow (ConversationFlow): Handles the profile questions and the trade confirmations without the LLM.
+        last_prices (dict): The last price given to the user for each stock, the price of a confirmed trade.
+        prefetcher (Prefetcher): Fetches the stock data of a user message while the first completion runs.
+        risk_snapshot (RiskSnapshot): The precomputed volatility and betas of the popular stocks.
+        turn_budget (float): The seconds a turn may take, the completions and the tool calls included.
+        traded (bool): Whether the last turn submitted an order to the trading engine.
+        final_reserve (float): The seconds of the budget kept for the final completion when tools run.
     """
 
-    def __init__(self, model="gpt-4o"):
+    def __init__(self, model=None, compactor=None, session_id=None, trading_engine=None, risk_model=None,
+                 price_feed=None, router=None, prefetcher=None, risk_snapshot=None, turn_budget=None, final_reserve=3.0):
         api_key = ""
         self.client = OpenAI(api_key=api_key)
         self.default_model = model
+        self.router = router or default_router
+        self.compactor = compactor or ToolResultCompactor()
+        self.session_id = session_id or uuid.uuid4().hex
+        self.trading_engine = trading_engine or default_engine
+        self.risk_model = risk_model or default_risk_model
+        self.price_feed = price_feed or default_feed
+        self.flow = ConversationFlow()
+        self.last_prices = {}
+        self.prefetcher = prefetcher or default_prefetcher
+        self.risk_snapshot = risk_snapshot or default_snapshot
+        self.turn_budget = turn_budget or TURN_BUDGET
+        self.final_reserve = final_reserve
+        self.traded = False
         self.initialize_conversation()
 
     def constract_prompt(self):
@@ -69,6 +116,112 @@ Perform only one step at a time and never skip a step. Don't include the step nu
                     },
                 },
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "get_stock_quotes",
+                    "description": "Get the current price, daily change and volatility of several stocks at once. Use it instead of several calls when the user asks about or compares more than one stock.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "stock_names": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "The name codes of the stocks",
+                            },
+                        },
+                        "required": ["stock_names"],
+                    },
+                },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "get_historical_data",
+                    "description": "Get a summary of the price history of a stock: range, return, drawdown, trend and volume.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "stock_name": {
+                                "type": "string",
+                                "description": "The name code of the stock",
+                            },
+                            "period": {"type": "string", "description": "The period, e.g. 5d, 1mo, 6mo, 1y", "default": "1mo"},
+                        },
+                        "required": ["stock_name"],
+                    },
+                },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "get_technical_indicators",
+                    "description": "Get the technical indicators of one or more stocks: moving averages, RSI, MACD, Bollinger bands, ATR, and the candlestick patterns of the last 5 days. Use it for questions about trends, momentum or candles.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "stock_names": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "The name codes of the stocks",
+                            },
+                        },
+                        "required": ["stock_names"],
+                    },
+                },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "backtest_strategy",
+                    "description": "Backtest a trading rule on the daily history of one or more stocks, net of fees and slippage, and compare it with buy and hold. Sweeps the rule parameters and gives the best ones in-sample. Use it for questions like 'would a moving average crossover have worked on AAPL?'.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "stock_names": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "The name codes of the stocks",
+                            },
+                            "strategy": {"type": "string", "description": "The trading rule", "enum": ["ma_crossover", "rsi", "buy_and_hold"]},
+                            "period": {"type": "string", "description": "The history, e.g. 1y, 5y, 10y", "default": "5y"},
+                        },
+                        "required": ["stock_names", "strategy"],
+                    },
+                },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "get_full_data",
+                    "description": "Get the full data behind a summarized tool result, only when the user explicitly asks for it.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "ref": {"type": "string", "description": "The ref given in the summarized result"},
+                        },
+                        "required": ["ref"],
+                    },
+                },
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "get_portfolio_risk",
+                    "description": "Get the volatility, beta, VaR and CVaR of the user's whole portfolio, and whether a proposed trade keeps it within their risk level (unknown when the stock has no price history).",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "risk_level": {"type": "string", "description": "The risk the user is willing to take", "enum": ["low", "medium", "high"]},
+                            "stock_name": {"type": "string", "description": "The name code of the stock of the proposed trade"},
+                            "quantity": {"type": "integer", "description": "The number of shares of the proposed trade"},
+                            "action": {"type": "string", "description": "The action of the proposed trade", "enum": ["buy", "sell"]},
+                            "price": {"type": "number", "description": "The price of the proposed trade"},
+                        },
+                        "required": ["risk_level"],
+                    },
+                },
+            },
             {
                 "type": "function",
                 "function": {
@@ -83,6 +236,7 @@ Perform only one step at a time and never skip a step. Don't include the step nu
                             },
                             "price": {"type": "number", "description": "The price of the stock"},
                             "action": {"type": "string", "description": "The action to take", "enum": ["buy", "sell"]},
+                            "quantity": {"type": "integer", "description": "The number of shares", "default": 1},
                         },
                         "required": ["stock_name", "price", "action"],
                     },
@@ -102,34 +256,94 @@ Perform only one step at a time and never skip a step. Don't include the step nu
         """
         self.messages = [self.constract_prompt()]
 
-    def conversation(self, user_input, model="default", max_tokens=150, temperature=0.2):
+    def dump_state(self):
+        """
+        Get the conversation state, to be saved in a session store.
+
+        Returns:
+            state (dict): The messages after the system prompt and the compacted tool results.
+        """
+        return {
+            "messages": self.messages[1:],
+            "full_results": self.compactor.full_results,
+            "saved_tokens": self.compactor.saved_tokens,
+            "flow": self.flow.to_dict(),
+            "last_prices": self.last_prices,
+        }
+
+    def load_state(self, state):
+        """
+        Restore a conversation state saved by dump_state.
+
+        Parameters:
+            state (dict): The state.
+        """
+        self.messages = [self.constract_prompt()] + list(state["messages"])
+        self.compactor.full_results = dict(state.get("full_results", {}))
+        self.compactor.saved_tokens = state.get("saved_tokens", 0)
+        if "flow" in state:
+            self.flow = ConversationFlow.from_dict(state["flow"])
+        self.last_prices = dict(state.get("last_prices", {}))
+
+    def conversation(self, user_input, model="default", max_tokens=150, temperature=0.2, deadline=None):
         """
         Generate a response to the user input.
 
+        When the deadline passes, the response is built from the tool results
+        gathered so far, or from the cached data of the stocks mentioned.
+
         Parameters:
             user_input (str): The user input.
             model (str): The model to use.
             max_tokens (int): The maximum number of tokens to generate.
             temperature (float): The temperature.
+            deadline (Deadline): The deadline of the turn, turn_budget seconds from now by default.
 
         Returns:
             response (str): The response.
         """
-        # if user has not specified a model, use the default model
+        deadline = deadline or Deadline(self.turn_budget)
+        self.traded = False
+        # The structured steps (profile answers, yes or no to a proposed trade) are answered locally
+        previous_state = self.flow.state
+        response = self.flow.handle(user_input, self.confirm_trade)
+        if response is not None:
+            self.messages.append({"role": "user", "content": user_input})
+            if previous_state == PROFILE and self.flow.state == READY:
+                self.messages.append(self.flow.profile_message())
+            self.messages.append({"role": "system", "content": response})
+            return response
+
+        # if user has not specified a model, use the default model, or the one picked by the router
         model = self.default_model if model == "default" else model
+        if model is None:
+            decision = self.router.route(self.messages, user_input)
+        else:
+            decision = RouteDecision(model, "fixed", {}, uuid.uuid4().hex)
+
+        # Speculate on the stocks of the message, the tool call then finds their data warm
+        symbols = detect_symbols(user_input, known=self.last_prices)
+        self.prefetcher.prefetch([symbol for symbol in symbols if symbol not in self.risk_snapshot])
 
         # Add the user input to the history of messages
         self.messages.append({"role": "user", "content": user_input})
+        self.compactor.start_turn()
 
-        # Generate Response
-        self.client.completions
-        completion = self.client.chat.completions.create(
-            model=model,
-            messages=self.messages,
-            max_tokens=max_tokens,
-            tools=self.tools,
-            temperature=temperature,
-        )
+        # Generate Response, the router escalates to the large model when needed
+        try:
+            completion, model = self.router.create(
+                self.client,
+                decision,
+                deadline,
+                messages=self.messages,
+                max_tokens=max_tokens,
+                tools=self.tools,
+                temperature=temperature,
+            )
+        except (APITimeoutError, DeadlineExceeded):
+            response = self.out_of_time_answer(symbols)
+            self.messages.append({"role": "system", "content": response})
+            return response
 
         # Handle the case where the model returns an empty response
         if not completion.choices:
@@ -138,43 +352,109 @@ Perform only one step at a time and never skip a step. Don't include the step nu
         tool_calls = completion.choices[0].message.tool_calls
 
         if tool_calls:
+            def bounded(func):
+                # The market data tools give up on the deadline, keeping time for the final completion
+                def call(**kwargs):
+                    try:
+                        return call_with_deadline(func, deadline, reserve=self.final_reserve, **kwargs)
+                    except DeadlineExceeded:
+                        return TIMED_OUT
+                return call
+
             available_functions = {
-                "get_stock_info": self.get_stock_info,
+                "get_stock_info": bounded(self.get_stock_info),
+                "get_stock_quotes": bounded(self.get_stock_quotes),
+                "get_historical_data": bounded(self.get_historical_data),
+                "get_technical_indicators": bounded(self.get_technical_indicators),
+                "backtest_strategy": bounded(self.backtest_strategy),
+                "get_full_data": self.compactor.get_full_result,
+                "get_portfolio_risk": bounded(self.get_portfolio_risk),
                 "trade_stock": self.trade_stock,
             }
-            self.messages.append(completion.choices[0].message)
+            # Kept as a plain dict so that the conversation can be serialized
+            self.messages.append(completion.choices[0].message.model_dump(exclude_none=True))
+            executed = []
+            results = []
+            # The full data only serves the answer of this turn, the history keeps a short note
+            full_data_messages = []
             for tool_call in tool_calls:
                 function_name = tool_call.function.name
                 function_to_call = available_functions[function_name]
                 function_args = json.loads(tool_call.function.arguments)
                 function_response = None
+                executed.append((function_name, function_args))
                 if function_name == "get_stock_info":
                     function_response = function_to_call(
                         stock_name=function_args.get("stock_name"),
                         date=function_args.get("date"),
                     )
+                elif function_name == "get_stock_quotes":
+                    function_response = function_to_call(stock_names=function_args.get("stock_names") or [])
+                elif function_name == "get_historical_data":
+                    function_response = function_to_call(
+                        stock_name=function_args.get("stock_name"),
+                        period=function_args.get("period") or "1mo",
+                    )
+                elif function_name == "get_technical_indicators":
+                    function_response = function_to_call(stock_names=function_args.get("stock_names") or [])
+                elif function_name == "backtest_strategy":
+                    function_response = function_to_call(
+                        stock_names=function_args.get("stock_names") or [],
+                        strategy=function_args.get("strategy") or "ma_crossover",
+                        period=function_args.get("period") or "5y",
+                    )
+                elif function_name == "get_full_data":
+                    function_response = function_to_call(function_args.get("ref"))
+                elif function_name == "get_portfolio_risk":
+                    function_response = function_to_call(
+                        risk_level=function_args.get("risk_level") or "medium",
+                        stock_name=function_args.get("stock_name"),
+                        quantity=function_args.get("quantity"),
+                        action=function_args.get("action"),
+                        price=function_args.get("price"),
+                    )
                 elif function_name == "trade_stock":
                     function_response = function_to_call(
                         action=function_args.get("action"),
                         stock_name=function_args.get("stock_name"),
                         price=function_args.get("price"),
+                        quantity=function_args.get("quantity") or 1,
                     )
 
+                content = (function_response if function_name == "get_full_data"
+                           else self.compactor.compact(function_name, function_response))
+                results.append(content)
                 self.messages.append(
                     {
                         "tool_call_id": tool_call.id,
                         "role": "tool",
                         "name": function_name,
-                        "content": str(function_response),
+                        "content": content,
                     }
                 )
+                if function_name == "get_full_data":
+                    full_data_messages.append((self.messages[-1], function_args.get("ref")))
 
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=self.messages,
-                max_tokens=max_tokens,
-                temperature=temperature,
-            ).choices[0].message.content
+            try:
+                response = self.router.call(
+                    self.client,
+                    model,
+                    decision._replace(model=model),
+                    "final",
+                    deadline,
+                    messages=self.messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                ).choices[0].message.content
+            except (APITimeoutError, DeadlineExceeded):
+                response = self.out_of_time_answer(symbols, results)
+            for message, reference in full_data_messages:
+                message["content"] = self.compactor.collapse_full_result(reference)
+            logger.info(self.compactor.report())
+            logger.info(self.prefetcher.report())
+            self.flow.observe(user_input, executed, self.last_prices, response)
+        else:
+            self.flow.observe(user_input, [], self.last_prices, response)
 
         # Remove any space or newline characters
         if response:
@@ -187,46 +467,145 @@ Perform only one step at a time and never skip a step. Don't include the step nu
 
         return response
 
+    def out_of_time_answer(self, symbols, results=()):
+        """
+        Answer without a completion once the deadline of the turn has passed.
+
+        Parameters:
+            symbols (list): The stocks the user message mentions.
+            results (list): The tool results gathered during the turn.
+
+        Returns:
+            response (str): The tool results, or else the cached data of the stocks.
+        """
+        found = [result for result in results if result != TIMED_OUT]
+        if found:
+            return "I ran out of time to write a full answer. Here is what I found:\n" + "\n".join(found)
+
+        precision = self.compactor.precision
+        lines = []
+        for symbol in symbols:
+            # A stale snapshot or a finished prefetch is better than nothing at this point
+            record = self.risk_snapshot.lookup(symbol, max_age=float("inf"))
+            if record is not None:
+                price, volatility = self.price_feed.last_price(symbol) or record["price"], record["volatility"]
+            else:
+                data = self.prefetcher.peek(symbol)
+                if data is None:
+                    continue
+                price, volatility = data[0], data[1]
+            lines.append(f"{symbol}: price {round(float(price), precision)}, volatility {round(float(volatility), precision)}")
+        if lines:
+            return ("Sorry, I could not answer in time. The latest data I have:\n" + "\n".join(lines)
+                    + "\nPlease ask again in a moment.")
+        return "Sorry, I could not answer in time. Please ask again in a moment."
+
     # Example dummy function hard coded to return the price 
     # a specific stock on a specific date
     def get_stock_info(self, stock_name, date):
         try:
             """Get the current stock price and volatility in a given date"""
-            stock = yf.Ticker(stock_name)
-            stock_data = stock.history(period="1d")
-            stock_price = stock_data["Close"].values[0]
-
-            """Get the volatility of a stock over a given period"""
-            data = yf.download(stock_name, period="1y", interval="1d")
-            data['Log Return'] = np.log(data['Adj Close'] / data['Adj Close'].shift(1))
-            volatility = data['Log Return'].std()
-            volatility = volatility * np.sqrt(252)
+            # Keep the symbol on the feed, the confirmation and the trade use its last price
+            self.price_feed.watch(stock_name)
+
+            """Get the volatility and the betas of a stock over a given period"""
+            live_price = self.price_feed.last_price(stock_name)
+            snapshot = self.risk_snapshot.lookup(stock_name)
+            if snapshot is not None:
+                # Precomputed by the batch job, only the price has to be live
+                volatility, beta_st, beta_lt = snapshot["volatility"], snapshot["beta_st"], snapshot["beta_lt"]
+                stock_price = live_price
+                if stock_price is None:
+                    stock_price = yf.Ticker(stock_name).history(period="1d")["Close"].values[0]
+            else:
+                # Usually already fetched, or being fetched, since the user message mentioned the stock
+                stock_price, volatility, beta_st, beta_lt = self.prefetcher.get(stock_name)
+                if live_price is not None:
+                    stock_price = live_price
             print(stock_name)
             print(volatility)
 
-            def calculate_beta(stock_ticker, period, interval):
-                stock_data = yf.download(stock_ticker, period=period, interval=interval)
-                market_data = yf.download('^GSPC', period=period, interval=interval)
-                stock_returns = stock_data['Adj Close'].pct_change().dropna()
-                market_returns = market_data['Adj Close'].pct_change().dropna()
-                combined_data = stock_returns.to_frame('Stock').join(market_returns.to_frame('Market'), how='inner')
-                covariance_matrix = np.cov(combined_data['Stock'], combined_data['Market'])
-                beta = covariance_matrix[0, 1] / covariance_matrix[1, 1]
-                return beta
-            beta_st = calculate_beta(stock_name, "1y", "1d")
-            beta_lt = calculate_beta(stock_name, "5y", "1mo")
-
-            return f"The stock price is: {stock_price} and volatility is: {volatility} . The beta over 5 years was: {beta_lt} and over the past year: {beta_st} ."
+            precision = self.compactor.precision
+            self.last_prices[stock_name] = round(float(stock_price), precision)
+            return (f"The stock price is: {round(float(stock_price), precision)} and volatility is: {round(float(volatility), precision)} . "
+                    f"The beta over 5 years was: {round(float(beta_lt), precision)} and over the past year: {round(float(beta_st), precision)} .")
         except:
             return("Stock data not found. Please try again.")
 
-    # Example dummy function hard coded to trade a stock
-    # with a specific action (buy or sell)
-    def trade_stock(self, action, stock_name, price):
-        """Trade a stock"""
+    def get_stock_quotes(self, stock_names):
+        """Get the quotes of several stocks with a single download"""
+        try:
+            return get_quotes(stock_names, precision=self.compactor.precision)
+        except Exception:
+            return "Stock data not found. Please try again."
+
+    def get_historical_data(self, stock_name, period="1mo"):
+        """Get the OHLCV history of a stock, summarized by the compactor before it reaches the prompt"""
+        try:
+            hist = yf.Ticker(stock_name).history(period=period)
+            return hist.drop(columns=["Dividends", "Stock Splits"], errors="ignore")
+        except Exception:
+            return "Stock data not found. Please try again."
+
+    def get_technical_indicators(self, stock_names):
+        """Get the indicators of the last bar and the recent candlestick patterns of several stocks"""
+        try:
+            return format_indicators(default_indicators.latest(stock_names), precision=self.compactor.precision)
+        except Exception:
+            return "Stock data not found. Please try again."
+
+    def backtest_strategy(self, stock_names, strategy="ma_crossover", period="5y"):
+        """Backtest a trading rule on several stocks against buy and hold"""
+        try:
+            return default_backtester.evaluate(stock_names, strategy, period, precision=self.compactor.precision)
+        except Exception:
+            return "Stock data not found. Please try again."
+
+    def get_portfolio_risk(self, risk_level="medium", stock_name=None, quantity=None, action=None, price=None):
+        """Get the risk of the session's portfolio, before and after a proposed trade"""
+        # The session may have traded through another worker
+        self.trading_engine.sync()
+        positions = dict(self.trading_engine.account(self.session_id).positions)
+        try:
+            if stock_name and quantity and action:
+                return self.risk_model.check_trade(positions, normalize_symbol(stock_name), quantity, action,
+                                                   risk_level, price)
+            return self.risk_model.analyze(positions)[0]
+        except Exception:
+            return "Portfolio data not found. Please try again."
+
+    def confirm_trade(self, action, stock_name, price, quantity):
+        """Execute a trade confirmed by the user, without a completion"""
+        return f"Done. {self.trade_stock(action, stock_name, price, quantity)}"
+
+    def trade_stock(self, action, stock_name, price, quantity=1):
+        """Trade a stock on the paper-trading engine at the confirmed price"""
         assert action in ["buy", "sell"]
-        print(f"Traded {stock_name} at {price} with action {action}")
-        return f"Traded {stock_name} at {price} with action {action}"
+        stock_name = normalize_symbol(stock_name)
+        # Fill at the live price when the feed has one, the confirmed price is the limit. The order is
+        # immediate or cancel: one the market moved away from is not left resting with the cash reserved
+        market_price = self.price_feed.last_price(stock_name)
+        try:
+            result = self.trading_engine.submit_order(
+                self.session_id, stock_name, action, quantity,
+                order_type="limit", limit_price=price,
+                reference_price=market_price if market_price is not None else price,
+                time_in_force="ioc",
+            )
+        except OrderRejected as e:
+            return f"Trade rejected: {e}"
+        except LedgerError as e:
+            print(f"Trade of {stock_name} not recorded: {str(e)}")
+            return "The trade could not be recorded, it may not be kept. Please try again later."
+        self.traded = True
+        account = self.trading_engine.account(self.session_id).snapshot()
+        print(f"Traded {stock_name} at {price} with action {action}: {result.status}")
+        if not result.filled_quantity:
+            return (f"Order {result.order_id} cancelled: the price of {stock_name} moved past the confirmed "
+                    f"price of {price}, nothing was traded. Cash: {account['available_cash']}")
+        return (f"Order {result.order_id} {result.status}: {action} {result.filled_quantity}/{quantity} {stock_name} "
+                f"at an average price of {result.average_price}. Cash: {account['available_cash']}, "
+                f"{stock_name} shares held: {account['positions'].get(stock_name, 0)}")
 
     if __name__ == "__main__":
         assistant = GPTAssistant()
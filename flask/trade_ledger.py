@@ -0,0 +1,536 @@
+import contextlib
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from paper_trading import MARKET_SESSION
+
+# Record header: payload length, crc32 of the lsn and payload, lsn
+_HEADER = struct.Struct("<IIQ")
+_SEGMENT_SUFFIX = ".wal"
+_SNAPSHOT_PREFIX = "snapshot-"
+_LOCK_FILE = "LOCK"
+
+
+class LedgerError(Exception):
+    """Raised when the ledger can no longer make the trades durable, or its log is corrupted."""
+
+
+class TradeLedger:
+    """
+    A durable, append-only ledger of the executed trades.
+
+    Trade events are written to a checksummed write-ahead log. With group commit
+    the appends of all the sessions arriving within a short window are written
+    and fsynced together by a single writer thread, instead of one fsync per
+    trade. Periodic snapshots of the accounts let older log segments be deleted;
+    recovery loads the latest snapshot and replays the log tail.
+
+    By default a directory has a single writer: the ledger takes an exclusive
+    lock on it, and a second process opening it fails instead of corrupting the
+    log. A shared ledger lets several processes, e.g. the workers of a web
+    server, keep their engines on the same directory: every order runs under an
+    exclusive file lock, first applying the records the other processes
+    appended, then appending and fsyncing its own, so each order matches against
+    the accounts of all the processes. Resting orders are not logged and would
+    only live in one process, so engines on a shared ledger do not take them.
+
+    Attributes:
+        directory (str): The directory of the log segments and snapshots.
+        group_commit (bool): Whether to batch the fsyncs, or fsync every append.
+        shared (bool): Whether several processes write to the directory.
+        commit_window (float): The seconds the writer waits to gather a batch.
+        snapshot_every (int): The number of records between two snapshots.
+        commit_timeout (float): The seconds wait gives a record to become durable by default.
+        records (int): The number of records written.
+        fsyncs (int): The number of log fsyncs.
+    """
+
+    def __init__(self, directory="trade_ledger", group_commit=True, commit_window=0.002,
+                 max_batch=4096, snapshot_every=10_000, commit_timeout=30.0, shared=False):
+        if shared and fcntl is None:
+            raise RuntimeError("A shared trade ledger needs fcntl file locks")
+        self.directory = directory
+        self.group_commit = group_commit
+        self.shared = shared
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self.snapshot_every = snapshot_every
+        self.commit_timeout = commit_timeout
+        self.records = 0
+        self.fsyncs = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, _LOCK_FILE), "a") if shared else self._lock_directory()
+
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._next_lsn = 1
+        self._durable_lsn = 0
+        self._snapshot_lsn = 0
+        self._snapshotting = False
+        self._closed = False
+        self._error = None
+        self._file = None
+        self._writer = None
+        # Where a shared ledger reads the records of the other processes from
+        self._read_path = None
+        self._read_offset = 0
+
+    def recover(self, engine):
+        """
+        Restore the accounts of an engine from the latest snapshot and the log tail.
+
+        A torn record at the end of the last segment is a write cut by a crash: the
+        segment is truncated there. A corrupted record in an older segment raises
+        LedgerError, the records after it cannot be replayed on top of a gap.
+
+        Parameters:
+            engine (PaperTradingEngine): The engine to restore.
+
+        Returns:
+            replayed (int): The number of records replayed on top of the snapshot.
+        """
+        with engine.lock, self._file_lock():
+            snapshot_lsn, accounts = self._load_snapshot()
+            self._restore(engine, accounts)
+            replayed, last_lsn = self._replay(engine, self._segments(), 0, snapshot_lsn, truncate=True)
+
+        self._snapshot_lsn = snapshot_lsn
+        self._next_lsn = last_lsn + 1
+        self._durable_lsn = last_lsn
+        if not self.shared:
+            # A shared ledger appends to the newest segment of all the processes, found per order
+            self._open_segment(self._next_lsn)
+        return replayed
+
+    @contextlib.contextmanager
+    def transaction(self, engine):
+        """
+        Hold a shared ledger while an order is matched and logged.
+
+        Takes the exclusive file lock and applies the records the other processes
+        appended first, so that the order sees their trades. Called under the
+        engine lock; a ledger with a single writer has nothing to do.
+
+        Parameters:
+            engine (PaperTradingEngine): The engine the order is matched by.
+        """
+        if not self.shared:
+            yield
+            return
+        with self._file_lock():
+            self._catch_up(engine, truncate=True)
+            segments = self._segments()
+            if not segments:
+                self._open_segment(self._next_lsn)
+            elif self._file is None or self._file.name != segments[-1]:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(segments[-1], "ab")
+            yield
+
+    def catch_up(self, engine):
+        """
+        Apply the records the other processes appended to a shared ledger.
+
+        Called under the engine lock, e.g. before reading the accounts.
+
+        Parameters:
+            engine (PaperTradingEngine): The engine to update.
+
+        Returns:
+            applied (int): The number of records applied.
+        """
+        if not self.shared:
+            return 0
+        with self._file_lock(exclusive=False):
+            return self._catch_up(engine, truncate=False)
+
+    def submit(self, event):
+        """
+        Queue a trade event for the log without waiting for it to be durable.
+
+        Called under the engine lock so that the log order is the execution order.
+
+        Parameters:
+            event (dict): The JSON serializable event.
+
+        Returns:
+            lsn (int): The log sequence number of the event.
+        """
+        payload = json.dumps(event, separators=(",", ":")).encode()
+        if self.shared or not self.group_commit:
+            # Naive durability: write and fsync every record on its own, in lsn order. A shared
+            # ledger cannot batch, the record must be durable before the file lock is released.
+            with self._write_lock:
+                with self._lock:
+                    lsn = self._reserve_lsn()
+                try:
+                    self._write_batch([(lsn, payload)])
+                except Exception as e:
+                    with self._lock:
+                        self._error = e
+                    raise LedgerError(f"The trade ledger failed to write: {e}") from e
+                if self.shared:
+                    self._read_path, self._read_offset = self._file.name, self._file.tell()
+            return lsn
+        with self._lock:
+            lsn = self._reserve_lsn()
+            self._pending.append((lsn, payload))
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="trade-ledger-writer", daemon=True)
+                self._writer.start()
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._committed.notify_all()
+        return lsn
+
+    def wait(self, lsn, timeout=None):
+        """
+        Wait until an event is durable.
+
+        Parameters:
+            lsn (int): The log sequence number returned by submit.
+            timeout (float): The seconds to wait, commit_timeout by default.
+        """
+        deadline = time.monotonic() + (self.commit_timeout if timeout is None else timeout)
+        with self._lock:
+            while self._durable_lsn < lsn:
+                if self._error is not None:
+                    raise LedgerError(f"The trade ledger failed to write: {self._error}") from self._error
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LedgerError(f"Record {lsn} of the trade ledger not durable after {timeout or self.commit_timeout}s")
+                self._committed.wait(remaining)
+
+    def check(self):
+        """Raise LedgerError when the ledger can no longer write, before a trade is executed."""
+        if self._error is not None:
+            raise LedgerError(f"The trade ledger failed to write: {self._error}")
+
+    def append(self, event):
+        """
+        Append a trade event and wait until it is durable.
+
+        Parameters:
+            event (dict): The JSON serializable event.
+
+        Returns:
+            lsn (int): The log sequence number of the event.
+        """
+        lsn = self.submit(event)
+        self.wait(lsn)
+        return lsn
+
+    def maybe_snapshot(self, engine):
+        """
+        Start a snapshot in the background when enough records were written since the last one.
+
+        Parameters:
+            engine (PaperTradingEngine): The engine whose accounts are snapshotted.
+        """
+        with self._lock:
+            if self._snapshotting or self._next_lsn - 1 - self._snapshot_lsn < self.snapshot_every:
+                return
+            self._snapshotting = True
+        threading.Thread(target=self.snapshot, args=(engine,), name="trade-ledger-snapshot", daemon=True).start()
+
+    def snapshot(self, engine):
+        """
+        Write a compacted snapshot of the accounts and delete the log segments it covers.
+
+        Parameters:
+            engine (PaperTradingEngine): The engine whose accounts are snapshotted.
+
+        Returns:
+            lsn (int): The last log sequence number included in the snapshot.
+        """
+        try:
+            if self.shared:
+                return self._snapshot_shared(engine)
+            # Holding the engine lock, every applied trade has been submitted and no other can be
+            with engine.lock:
+                with self._lock:
+                    lsn = self._next_lsn - 1
+                accounts = self._account_states(engine)
+            # Never snapshot trades that were not acknowledged as durable
+            self.wait(lsn)
+            self._write_snapshot(lsn, accounts)
+
+            # Start a new segment so that the older ones only hold records up to here
+            with self._write_lock:
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                    self._snapshot_lsn = lsn
+                self._write_batch(batch)
+                with self._lock:
+                    # Records submitted meanwhile go to the new segment
+                    self._open_segment(self._pending[0][0] if self._pending else self._next_lsn)
+            self._compact(lsn)
+            return lsn
+        finally:
+            self._snapshotting = False
+
+    def _snapshot_shared(self, engine):
+        # Under the file lock no process appends, and this one has applied every record
+        with engine.lock, self.transaction(engine):
+            lsn = self._next_lsn - 1
+            latest_lsn = self._latest_snapshot_lsn()
+            if lsn - latest_lsn < self.snapshot_every:
+                # Another process took it
+                self._snapshot_lsn = latest_lsn
+                return latest_lsn
+            self._write_snapshot(lsn, self._account_states(engine))
+            self._snapshot_lsn = lsn
+            self._open_segment(lsn + 1)
+            self._read_path, self._read_offset = self._file.name, 0
+            self._compact(lsn)
+        return lsn
+
+    def close(self):
+        """Write what is pending and close the log."""
+        with self._lock:
+            self._closed = True
+            self._committed.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            self._write_batch(batch)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _lock_directory(self):
+        lock_file = open(os.path.join(self.directory, _LOCK_FILE), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                raise RuntimeError(f"The trade ledger {self.directory} is used by another process: "
+                                   "open it as a shared ledger for several processes")
+        return lock_file
+
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive=True):
+        # A ledger with a single writer holds its directory lock from the start
+        if not self.shared:
+            yield
+            return
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _catch_up(self, engine, truncate):
+        segments = self._segments()
+        applied_lsn = self._next_lsn - 1
+        offset = 0
+        if self._read_path in segments:
+            segments = segments[segments.index(self._read_path):]
+            offset = self._read_offset
+        else:
+            # Another process took a snapshot and deleted the segment read so far
+            snapshot_lsn, accounts = self._load_snapshot()
+            if snapshot_lsn > applied_lsn:
+                self._restore(engine, accounts, reset=True)
+                applied_lsn = snapshot_lsn
+        applied, last_lsn = self._replay(engine, segments, offset, applied_lsn, truncate)
+        with self._lock:
+            self._next_lsn = last_lsn + 1
+            self._durable_lsn = last_lsn
+        return applied
+
+    def _replay(self, engine, segments, offset, after_lsn, truncate):
+        # Apply the records after after_lsn, reading the first segment from offset
+        replayed = 0
+        last_lsn = after_lsn
+        for index, path in enumerate(segments):
+            records, end, size = self._scan(path, offset if index == 0 else 0)
+            for lsn, event in records:
+                if lsn <= last_lsn:
+                    continue
+                self._apply(engine, event)
+                replayed += 1
+                last_lsn = lsn
+            if end < size:
+                if index < len(segments) - 1:
+                    raise LedgerError(f"The trade ledger segment {path} is corrupted at byte {end}")
+                if truncate:
+                    # Torn write of the last batch before a crash
+                    print(f"Truncating the trade ledger segment {path} at byte {end}")
+                    with open(path, "r+b") as f:
+                        f.truncate(end)
+                        os.fsync(f.fileno())
+            self._read_path, self._read_offset = path, end
+        return replayed, last_lsn
+
+    def _reserve_lsn(self):
+        if self._closed:
+            raise RuntimeError("The trade ledger is closed")
+        self.check()
+        if self._file is None:
+            self._open_segment(self._next_lsn)
+        lsn = self._next_lsn
+        self._next_lsn += 1
+        return lsn
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._committed.wait()
+                if not self._pending and self._closed:
+                    return
+            # Let the other sessions join the batch
+            if self.commit_window:
+                deadline = time.monotonic() + self.commit_window
+                while len(self._pending) < self.max_batch and time.monotonic() < deadline:
+                    time.sleep(self.commit_window / 4)
+            with self._write_lock:
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    # e.g. a disk full or fsync error: fail the waiters instead of leaving them blocked
+                    print(f"Trade ledger writer stopped: {str(e)}")
+                    with self._lock:
+                        self._error = e
+                        self._committed.notify_all()
+                    return
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        buffer = bytearray()
+        for lsn, payload in batch:
+            lsn_bytes = struct.pack("<Q", lsn)
+            buffer += _HEADER.pack(len(payload), zlib.crc32(payload, zlib.crc32(lsn_bytes)), lsn)
+            buffer += payload
+        self._file.write(buffer)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        with self._lock:
+            self.fsyncs += 1
+            self.records += len(batch)
+            self._durable_lsn = batch[-1][0]
+            self._committed.notify_all()
+
+    def _open_segment(self, first_lsn):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, f"{first_lsn:020d}{_SEGMENT_SUFFIX}")
+        self._file = open(path, "ab")
+        self._fsync_directory()
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, f"*{_SEGMENT_SUFFIX}")))
+
+    @staticmethod
+    def _scan(path, start=0):
+        # The complete records from start, the offset after the last one and the size of the segment
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        records = []
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, checksum, lsn = _HEADER.unpack_from(data, offset)
+            payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload, zlib.crc32(struct.pack("<Q", lsn))) != checksum:
+                break
+            records.append((lsn, json.loads(payload)))
+            offset += _HEADER.size + length
+        return records, start + offset, start + len(data)
+
+    def _latest_snapshot_lsn(self):
+        snapshots = sorted(glob.glob(os.path.join(self.directory, f"{_SNAPSHOT_PREFIX}*.json")))
+        return int(os.path.basename(snapshots[-1])[len(_SNAPSHOT_PREFIX):-len(".json")]) if snapshots else 0
+
+    def _write_snapshot(self, lsn, accounts):
+        path = os.path.join(self.directory, f"{_SNAPSHOT_PREFIX}{lsn:020d}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"lsn": lsn, "accounts": accounts}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_directory()
+
+    def _load_snapshot(self):
+        for path in sorted(glob.glob(os.path.join(self.directory, f"{_SNAPSHOT_PREFIX}*.json")), reverse=True):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+                return snapshot["lsn"], snapshot["accounts"]
+            except (ValueError, KeyError):
+                continue
+        return 0, {}
+
+    def _compact(self, snapshot_lsn):
+        segments = self._segments()
+        # A segment holds the records up to the first lsn of the next one
+        for path, next_path in zip(segments, segments[1:]):
+            next_first_lsn = int(os.path.basename(next_path)[:-len(_SEGMENT_SUFFIX)])
+            if next_first_lsn - 1 <= snapshot_lsn:
+                os.remove(path)
+        snapshots = sorted(glob.glob(os.path.join(self.directory, f"{_SNAPSHOT_PREFIX}*.json")))
+        for path in snapshots[:-1]:
+            os.remove(path)
+
+    def _fsync_directory(self):
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _account_states(engine):
+        return {
+            session_id: {"cash": account.cash, "positions": {s: q for s, q in account.positions.items() if q}}
+            for session_id, account in engine.accounts.items()
+        }
+
+    @staticmethod
+    def _restore(engine, accounts, reset=False):
+        if reset:
+            # The snapshot holds every account that traded
+            for account in engine.accounts.values():
+                account.cash = engine.initial_cash
+                account.positions = {}
+        for session_id, state in accounts.items():
+            account = engine.account(session_id)
+            account.cash = state["cash"]
+            account.positions = dict(state["positions"])
+
+    @staticmethod
+    def _apply(engine, event):
+        for symbol, price, quantity, buy_session, sell_session in event["fills"]:
+            notional = price * quantity
+            if buy_session != MARKET_SESSION:
+                buyer = engine.account(buy_session)
+                buyer.cash -= notional
+                buyer.positions[symbol] = buyer.positions.get(symbol, 0) + quantity
+            if sell_session != MARKET_SESSION:
+                seller = engine.account(sell_session)
+                seller.cash += notional
+                seller.positions[symbol] = seller.positions.get(symbol, 0) - quantity
@@ -0,0 +1,189 @@
+import hashlib
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+
+import yfinance as yf
+from langchain_community.vectorstores import Chroma
+
+
+def normalize_url(url):
+    '''
+    Drop the query string and fragment, which only carry tracking parameters for news links.
+    '''
+    parts = urlsplit(url or "")
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+
+
+def content_hash(title, summary):
+    '''
+    Hash the normalized text of an article, to catch the same story syndicated under several URLs.
+    '''
+    text = re.sub(r"\W+", " ", f"{title} {summary}".lower()).strip()
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def parse_news_item(item):
+    '''
+    Read a yfinance news item, in the flat format or the newer nested "content" format.
+    '''
+    content = item.get("content") or {}
+    title = item.get("title") or content.get("title") or ""
+    summary = item.get("summary") or content.get("summary") or ""
+    link = item.get("link") or (content.get("canonicalUrl") or {}).get("url") or ""
+    published = item.get("providerPublishTime")
+    if published is None and content.get("pubDate"):
+        published = datetime.fromisoformat(content["pubDate"].replace("Z", "+00:00")).timestamp()
+    return {
+        "title": title,
+        "summary": summary,
+        "link": link,
+        "published": float(published or time.time()),
+    }
+
+
+class NewsIngester:
+    '''
+    Ingest the news of the watched tickers in the background into a local vector store.
+
+    Each poll only keeps the articles newer than the last one seen for the ticker,
+    drops duplicates by URL and by content hash, and embeds the new headlines and
+    summaries in batches. News questions are then answered from the local index,
+    ranked by relevance decayed with the age of the article.
+    '''
+
+    def __init__(self, embedding, persist_directory="chroma_store_news", interval=300,
+                 half_life_hours=24, batch_size=64):
+        self.vector_store = Chroma(
+            collection_name="news",
+            embedding_function=embedding,
+            persist_directory=persist_directory
+        )
+        self.interval = interval
+        self.half_life_hours = half_life_hours
+        self.batch_size = batch_size
+        self.watched = set()
+        self.last_published = {}
+        self.lock = threading.Lock()
+        self._thread = None
+
+        # Rebuild the dedup state from what is already indexed
+        stored = self.vector_store.get(include=["metadatas"])
+        self.seen_hashes = set(stored["ids"])
+        self.seen_urls = {metadata["url"] for metadata in stored["metadatas"]}
+        for metadata in stored["metadatas"]:
+            ticker = metadata["ticker"]
+            self.last_published[ticker] = max(self.last_published.get(ticker, 0), metadata["published"])
+
+    def watch(self, ticker):
+        '''
+        Add a ticker to the polled ones.
+        '''
+        with self.lock:
+            self.watched.add(ticker.upper())
+
+    def start(self):
+        '''
+        Start polling the watched tickers in a background thread.
+        '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="news-ingester", daemon=True)
+            self._thread.start()
+
+    def ingest(self, tickers):
+        '''
+        Fetch the news of the tickers and index the new articles.
+
+        The new articles are held as seen while they are written and released if
+        the write fails, and the last published time of a ticker only moves
+        forward once its articles are written, so the next poll retries them.
+        '''
+        texts, metadatas, ids, keys = [], [], [], []
+        newest = {}
+        for ticker in tickers:
+            try:
+                items = yf.Ticker(ticker).news or []
+            except Exception as e:
+                print(f"News fetch failed for {ticker}: {str(e)}")
+                continue
+            with self.lock:
+                last_published = self.last_published.get(ticker, 0)
+            newest[ticker] = last_published
+            for item in map(parse_news_item, items):
+                # Incremental: older articles were indexed by a previous poll
+                if item["published"] < last_published or not item["title"]:
+                    continue
+                url = normalize_url(item["link"])
+                digest = content_hash(item["title"], item["summary"])
+                with self.lock:
+                    # Articles being written by another ingest count as seen
+                    if digest in self.seen_hashes or (url and url in self.seen_urls):
+                        continue
+                    self.seen_hashes.add(digest)
+                    self.seen_urls.add(url)
+                keys.append((digest, url))
+                newest[ticker] = max(newest[ticker], item["published"])
+                texts.append(f"{item['title']}\n{item['summary']}".strip())
+                metadatas.append({"ticker": ticker, "title": item["title"], "url": url or item["link"],
+                                  "published": item["published"]})
+                ids.append(digest)
+
+        written = 0
+        try:
+            for start in range(0, len(texts), self.batch_size):
+                self.vector_store.add_texts(
+                    texts=texts[start:start + self.batch_size],
+                    metadatas=metadatas[start:start + self.batch_size],
+                    ids=ids[start:start + self.batch_size]
+                )
+                written = start + len(ids[start:start + self.batch_size])
+        except Exception as e:
+            print(f"News write failed after {written} of {len(texts)} articles: {str(e)}")
+            with self.lock:
+                # Not written, the next poll fetches them again
+                for digest, url in keys[written:]:
+                    self.seen_hashes.discard(digest)
+                    self.seen_urls.discard(url)
+            return written
+
+        with self.lock:
+            for ticker, published in newest.items():
+                self.last_published[ticker] = max(self.last_published.get(ticker, 0), published)
+        return written
+
+    def latest(self, ticker, n=5):
+        '''
+        Get the most recent indexed articles of a ticker, without any network call.
+        '''
+        stored = self.vector_store.get(where={"ticker": ticker.upper()}, include=["metadatas"])
+        return sorted(stored["metadatas"], key=lambda metadata: metadata["published"], reverse=True)[:n]
+
+    def search(self, query, ticker=None, k=5):
+        '''
+        Search the indexed articles, weighting the relevance by the recency of the article.
+        '''
+        candidates = self.vector_store.similarity_search_with_relevance_scores(
+            query,
+            k=k * 4,
+            filter={"ticker": ticker.upper()} if ticker else None
+        )
+        now = time.time()
+        ranked = []
+        for document, relevance in candidates:
+            age_hours = max(now - document.metadata["published"], 0) / 3600
+            # Some distance functions give negative relevances, the decay would rank those old articles first
+            relevance = min(max(relevance, 0.0), 1.0)
+            ranked.append((relevance * 0.5 ** (age_hours / self.half_life_hours), document.metadata["published"],
+                           document))
+        ranked.sort(key=lambda entry: entry[:2], reverse=True)
+        return [document for _, _, document in ranked[:k]]
+
+    def _run(self):
+        while True:
+            with self.lock:
+                tickers = sorted(self.watched)
+            if tickers:
+                self.ingest(tickers)
+            time.sleep(self.interval)
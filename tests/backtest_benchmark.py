@@ -0,0 +1,57 @@
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask"))
+
+from backtest import METRICS, Backtester, sweep_statistics  # noqa: E402
+from compute_pool import ComputePool  # noqa: E402
+
+TICKERS = 50
+BARS = 1260
+GRIDS = {
+    "ma_crossover": [(fast, slow) for fast, slow in itertools.product(range(5, 55, 5), range(50, 260, 10)) if fast < slow],
+    "rsi": list(itertools.product((7, 14, 21), range(15, 45, 5), range(55, 90, 5))),
+}
+
+
+def synthetic_closes(symbols, period):
+    # 5 years of geometric random walks, standing in for the cached yfinance closes
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(end="2024-12-31", periods=BARS)
+    returns = rng.normal(0.0004, 0.02, (BARS, len(symbols)))
+    return pd.DataFrame(100 * np.exp(np.cumsum(returns, axis=0)), index=dates, columns=symbols)
+
+
+if __name__ == "__main__":
+    symbols = [f"T{i:03d}" for i in range(TICKERS)]
+    pool = ComputePool()
+    backtester = Backtester(pool=pool, downloader=synthetic_closes)
+    _, closes = backtester.load(symbols, "5y")
+    pool.start()
+
+    start_time = time.perf_counter()
+    for strategy, grid in GRIDS.items():
+        backtests = len(grid) * TICKERS
+
+        output = np.empty((len(grid), TICKERS, len(METRICS)))
+        begin = time.perf_counter()
+        sweep_statistics(output, closes, strategy, grid)
+        in_process = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        pooled = backtester.sweep(closes, strategy, grid)
+        in_pool = time.perf_counter() - begin
+        assert np.allclose(pooled, output, equal_nan=True)
+
+        print(f"{strategy}: {backtests:,} backtests of {BARS} bars, "
+              f"{backtests / in_process:,.0f}/s in process, "
+              f"{backtests / in_pool:,.0f}/s over {pool.max_workers} workers")
+    end_time = time.perf_counter()
+    pool.shutdown()
+
+    print(f"Run time: {end_time - start_time} seconds")
@@ -0,0 +1,23 @@
+import json
+import time
+import httpx
+
+CHATBOT_URL = "http://localhost:8000/finbot-rag-agent/batch"
+
+questions = [
+    "What is the most popular stocks now?",
+    "Can I buy 10 Apple shares?",
+    "What is candle plot?",
+    "what is  candle plot?",
+] * 25
+
+start_time = time.perf_counter()
+with httpx.stream("POST", CHATBOT_URL, json={"queries": questions}, timeout=httpx.Timeout(timeout=600)) as response:
+    # One line per unique question, as soon as it is answered
+    for line in response.iter_lines():
+        if line:
+            result = json.loads(line)
+            print(f"{len(result['indices'])} x {result['query']!r}: {result['run_seconds']} seconds")
+end_time = time.perf_counter()
+
+print(f"Run time: {end_time - start_time} seconds")
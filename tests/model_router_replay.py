@@ -0,0 +1,81 @@
+import difflib
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask"))
+
+from model_router import ModelRouter  # noqa: E402
+from paper_trading import PaperTradingEngine  # noqa: E402
+from trade_agent import GPTAssistant  # noqa: E402
+
+# Replay a conversation set with the routing and with every turn on the large model, then compare
+# their latency and answers. The set is a JSON lines file of {"turns": [user inputs]}.
+replay_path = sys.argv[1] if len(sys.argv) > 1 else None
+LARGE_MODEL = os.getenv("ROUTER_LARGE_MODEL", "gpt-4o")
+
+DEFAULT_SET = [
+    {"turns": ["Hi", "I am a beginner, low risk, 5000 dollars", "What is the price of AAPL?",
+               "I want to buy 10 shares of AAPL", "yes"]},
+    {"turns": ["Hello", "Some experience, medium risk, $20k", "What is a candle plot?",
+               "Compare MSFT and GOOGL", "Show me the RSI of TSLA"]},
+    {"turns": ["Hi", "Experienced, high risk, 50k USD", "Sell 5 NVDA", "no",
+               "How did a moving average crossover do on SPY over 5 years?"]},
+]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def tool_names(messages):
+    return [call["function"]["name"] for message in messages if isinstance(message, dict)
+            for call in message.get("tool_calls") or ()]
+
+
+def replay(conversations, model, log_path):
+    """Run every conversation with a fresh assistant and trading account, return the turns."""
+    turns = []
+    for conversation in conversations:
+        assistant = GPTAssistant(model=model, router=ModelRouter(large_model=LARGE_MODEL, log_path=log_path),
+                                 trading_engine=PaperTradingEngine())
+        for user_input in conversation["turns"]:
+            start = len(assistant.messages)
+            start_time = time.perf_counter()
+            response = assistant.conversation(user_input, temperature=0)
+            turns.append({
+                "latency": time.perf_counter() - start_time,
+                "response": response or "",
+                "tools": tool_names(assistant.messages[start:]),
+                "state": assistant.flow.state,
+            })
+    return turns
+
+
+if replay_path:
+    with open(replay_path) as replay_file:
+        conversations = [json.loads(line) for line in replay_file if line.strip()]
+else:
+    conversations = DEFAULT_SET
+
+log_dir = tempfile.mkdtemp(prefix="router_replay_")
+baseline = replay(conversations, LARGE_MODEL, os.path.join(log_dir, "baseline.jsonl"))
+routed = replay(conversations, None, os.path.join(log_dir, "routed.jsonl"))
+
+for name, turns in (("large only", baseline), ("routed", routed)):
+    latencies = [turn["latency"] for turn in turns]
+    print(f"{name}: {len(turns)} turns, p50 {percentile(latencies, 0.5):.3f}s, p95 {percentile(latencies, 0.95):.3f}s")
+
+# Quality against the large model: same tools called, same step of the conversation, similar answer
+same_tools = sum(a["tools"] == b["tools"] for a, b in zip(baseline, routed))
+same_state = sum(a["state"] == b["state"] for a, b in zip(baseline, routed))
+similarity = [difflib.SequenceMatcher(None, a["response"], b["response"]).ratio() for a, b in zip(baseline, routed)]
+print(f"Same tools: {same_tools}/{len(routed)}, same conversation step: {same_state}/{len(routed)}, "
+      f"answer similarity p50 {percentile(similarity, 0.5):.2f}")
+for index, (a, b) in enumerate(zip(baseline, routed)):
+    if a["tools"] != b["tools"] or a["state"] != b["state"]:
+        print(f"Turn {index} differs: large only {a['tools']} {a['state']}, routed {b['tools']} {b['state']}")
+print(f"Router logs in {log_dir}, summarize them with model_router_report.py")
@@ -0,0 +1,34 @@
+import json
+import sys
+from collections import defaultdict
+
+# Summarize a ROUTER_LOG written while replaying a conversation set, e.g. before and after a routing change
+log_path = sys.argv[1] if len(sys.argv) > 1 else "router_log.jsonl"
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+with open(log_path) as log:
+    calls = [json.loads(line) for line in log if line.strip()]
+
+by_model = defaultdict(list)
+by_reason = defaultdict(list)
+turns = defaultdict(float)
+escalations = 0
+for call in calls:
+    by_model[call["model"]].append(call["latency"])
+    by_reason[call["reason"]].append(call["latency"])
+    escalations += call["stage"] == "escalated"
+    turns[call["turn_id"]] += call["latency"]
+
+for name, groups in (("model", by_model), ("reason", by_reason)):
+    for key, latencies in sorted(groups.items()):
+        print(f"{name} {key}: {len(latencies)} calls, p50 {percentile(latencies, 0.5):.3f}s, "
+              f"p95 {percentile(latencies, 0.95):.3f}s")
+
+turn_latencies = list(turns.values())
+print(f"{len(turn_latencies)} turns, {escalations} escalated, cost {sum(c['cost'] for c in calls):.4f}$")
+print(f"Turn latency: p50 {percentile(turn_latencies, 0.5):.3f}s, p95 {percentile(turn_latencies, 0.95):.3f}s")
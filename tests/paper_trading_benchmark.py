@@ -0,0 +1,40 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask"))
+
+from paper_trading import PaperTradingEngine  # noqa: E402
+
+SYMBOLS = ["AAPL", "MSFT", "NVDA", "AMZN", "GOOGL", "META", "TSLA", "JPM"]
+SESSIONS = [f"session-{i}" for i in range(1000)]
+ORDERS = 500_000
+
+random.seed(0)
+engine = PaperTradingEngine(initial_cash=float("inf"), allow_short=True)
+
+# Pre-generate the order flow so that only the engine is timed:
+# mostly limit orders around a mid price, with some market orders crossing the book
+orders = []
+for _ in range(ORDERS):
+    side = random.choice(("buy", "sell"))
+    if random.random() < 0.2:
+        orders.append((random.choice(SESSIONS), random.choice(SYMBOLS), side, random.randint(1, 100), "market", None))
+    else:
+        price = round(100 + random.gauss(0, 1), 2)
+        orders.append((random.choice(SESSIONS), random.choice(SYMBOLS), side, random.randint(1, 100), "limit", price))
+
+submit_order = engine.submit_order
+fills = 0
+start_time = time.perf_counter()
+for session_id, symbol, side, quantity, order_type, price in orders:
+    try:
+        fills += len(submit_order(session_id, symbol, side, quantity, order_type, price).fills)
+    except Exception:
+        # Market orders hitting an empty side are rejected
+        pass
+end_time = time.perf_counter()
+
+print(f"Run time: {end_time - start_time} seconds")
+print(f"{ORDERS / (end_time - start_time):,.0f} orders per second, {fills:,} fills")
@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask"))
+
+from price_feed import PriceFeed, ReplaySource  # noqa: E402
+
+SYMBOLS = ["AAPL", "MSFT", "NVDA", "TSLA"]
+TICKS = 200_000
+
+# Recorded ticks, replayed as fast as the feed publishes them
+ticks = [(1_700_000_000 + i * 0.001, SYMBOLS[i % len(SYMBOLS)], 100.0 + i * 0.01) for i in range(TICKS)]
+last_ticks = {symbol: price for _, symbol, price in ticks}
+
+feed = PriceFeed(max_age=None)
+latest = {}
+received = 0
+
+
+def slow_session():
+    # A chat session reading its updates from a synchronous thread, slower than the feed
+    global received
+    for quotes in feed.updates(["AAPL", "TSLA"], timeout=0.5):
+        if not quotes:
+            return
+        for symbol, quote in quotes.items():
+            # Coalesced quotes are always the latest of their symbol, never an older one
+            assert quote.price >= latest.get(symbol, 0.0)
+            latest[symbol] = quote.price
+        received += len(quotes)
+        time.sleep(0.001)
+
+
+source = ReplaySource(ticks, speed=0)
+feed.start(source)
+session = threading.Thread(target=slow_session)
+start_time = time.perf_counter()
+session.start()
+session.join()
+end_time = time.perf_counter()
+feed.stop()
+
+assert {symbol: quote.price for symbol, quote in feed.quotes.items()} == last_ticks
+assert latest == {"AAPL": last_ticks["AAPL"], "TSLA": last_ticks["TSLA"]}
+print(f"Run time: {end_time - start_time} seconds, {TICKS / (end_time - start_time):,.0f} ticks per second, "
+      f"{received} updates received by the slow session for {TICKS // 2} ticks of its symbols")
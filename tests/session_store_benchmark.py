@@ -0,0 +1,56 @@
+import multiprocessing as mp
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask"))
+
+from session_store import CachedSessionStore, ConcurrentUpdateError, SQLiteSessionStore  # noqa: E402
+
+SESSIONS = 2000
+TURNS_PER_WORKER = 4000
+# Roughly the size of a conversation after a few turns with tool calls
+MESSAGE = {"role": "assistant", "content": "x" * 400}
+
+
+def worker(path, seed, results):
+    store = CachedSessionStore(SQLiteSessionStore(path))
+    rng = random.Random(seed)
+    conflicts = 0
+    start_time = time.perf_counter()
+    for _ in range(TURNS_PER_WORKER):
+        session_id = f"session-{rng.randrange(SESSIONS)}"
+        # A chat turn: load, append the messages, save, retry on a concurrent update
+        while True:
+            state, version = store.load(session_id)
+            state = state or {"messages": []}
+            state["messages"] = state["messages"][-20:] + [MESSAGE]
+            try:
+                store.save(session_id, state, version)
+                break
+            except ConcurrentUpdateError:
+                conflicts += 1
+    results.put((time.perf_counter() - start_time, conflicts))
+
+
+def run(workers):
+    path = os.path.join(tempfile.mkdtemp(prefix="sessions_"), "sessions.db")
+    SQLiteSessionStore(path)
+    results = mp.Queue()
+    processes = [mp.Process(target=worker, args=(path, seed, results)) for seed in range(workers)]
+    start_time = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    end_time = time.perf_counter()
+    conflicts = sum(results.get()[1] for _ in processes)
+    turns = workers * TURNS_PER_WORKER
+    print(f"{workers} workers: Run time: {end_time - start_time} seconds, "
+          f"{turns / (end_time - start_time):,.0f} turns per second, {conflicts} conflicts retried")
+
+
+for workers in (1, 2, 4):
+    run(workers)
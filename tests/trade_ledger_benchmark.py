@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flask"))
+
+from paper_trading import PaperTradingEngine  # noqa: E402
+from trade_ledger import TradeLedger  # noqa: E402
+
+SESSIONS = 64
+TRADES_PER_SESSION = 200
+
+
+def run(group_commit):
+    directory = tempfile.mkdtemp(prefix="trade_ledger_")
+    ledger = TradeLedger(directory, group_commit=group_commit)
+    engine = PaperTradingEngine(initial_cash=1e12, ledger=ledger)
+    ledger.recover(engine)
+
+    def session(session_id):
+        for i in range(TRADES_PER_SESSION):
+            engine.submit_order(session_id, "AAPL", "buy", 1, "limit", 100.0, reference_price=100.0)
+
+    threads = [threading.Thread(target=session, args=(f"session-{i}",)) for i in range(SESSIONS)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    end_time = time.perf_counter()
+    ledger.close()
+
+    # Recovery must give the same accounts back
+    recovered = PaperTradingEngine(initial_cash=1e12)
+    TradeLedger(directory).recover(recovered)
+    assert recovered.account("session-0").positions == engine.account("session-0").positions
+
+    trades = SESSIONS * TRADES_PER_SESSION
+    print(f"group_commit={group_commit}: Run time: {end_time - start_time} seconds, "
+          f"{trades / (end_time - start_time):,.0f} trades per second, "
+          f"{ledger.fsyncs / ledger.records:.3f} fsyncs per trade")
+    shutil.rmtree(directory)
+
+
+def trade_shared(directory):
+    # Small snapshot interval: the processes also compact the segments the others read
+    ledger = TradeLedger(directory, shared=True, snapshot_every=500)
+    engine = PaperTradingEngine(initial_cash=1e12, ledger=ledger)
+    ledger.recover(engine)
+    for i in range(TRADES_PER_SESSION):
+        # Every process trades in every session, on top of the trades of the others
+        for session in range(SESSIONS // 8):
+            engine.submit_order(f"session-{session}", "AAPL", "buy", 1, "limit", 100.0,
+                                reference_price=100.0, time_in_force="ioc")
+    ledger.close()
+
+
+def run_shared(processes):
+    directory = tempfile.mkdtemp(prefix="trade_ledger_")
+    workers = [multiprocessing.Process(target=trade_shared, args=(directory,)) for _ in range(processes)]
+    start_time = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    end_time = time.perf_counter()
+
+    recovered = PaperTradingEngine(initial_cash=1e12)
+    TradeLedger(directory).recover(recovered)
+    assert recovered.account("session-0").positions == {"AAPL": processes * TRADES_PER_SESSION}
+
+    trades = processes * TRADES_PER_SESSION * (SESSIONS // 8)
+    print(f"shared by {processes} processes: Run time: {end_time - start_time} seconds, "
+          f"{trades / (end_time - start_time):,.0f} trades per second")
+    shutil.rmtree(directory)
+
+
+run(group_commit=False)
+run(group_commit=True)
+run_shared(processes=4)
@@ -2,8 +2,13 @@ from openai import OpenAI
 from configparser import ConfigParser
 import json
 import os
+import sys
 import yfinance as yf
 
+# The market data of the flask app's tools, appended so that the modules of this directory come first
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "flask"))
+from market_data import get_quotes  # noqa: E402
+
 
 class GPTAssistant:
     """
@@ -71,6 +76,24 @@ Perform only one step at a time and never skip a step. Don't include the step nu
                     "required": ["stock_name"],
                 },
             },
+        },
+          {
+            "type": "function",
+            "function": {
+                "name": "get_stock_prices",
+                "description": "Get the current price, daily change and volatility of several stocks at once",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "stock_names": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "The name codes of the stocks",
+                        },
+                    },
+                    "required": ["stock_names"],
+                },
+            },
         },
           {
             "type": "function",
@@ -145,6 +168,7 @@ Perform only one step at a time and never skip a step. Don't include the step nu
         if tool_calls:
             available_functions = {
                 "get_stock_price": self.get_stock_price,
+                "get_stock_prices": self.get_stock_prices,
                 "trade_stock": self.trade_stock,
             }
             self.messages.append(completion.choices[0].message)
@@ -158,6 +182,10 @@ Perform only one step at a time and never skip a step. Don't include the step nu
                         stock_name=function_args.get("stock_name"),
                         date=function_args.get("date"),
                     )
+                elif function_name == "get_stock_prices":
+                    function_response = function_to_call(
+                        stock_names=function_args.get("stock_names") or [],
+                    )
                 elif function_name == "trade_stock":
                     function_response = function_to_call(
                         action=function_args.get("action"),
@@ -201,6 +229,13 @@ Perform only one step at a time and never skip a step. Don't include the step nu
         stock_price = stock_data["Close"].values[0]
         return stock_price
 
+    def get_stock_prices(self, stock_names):
+        """Get the price, daily change and volatility of several stocks with one download"""
+        try:
+            return get_quotes(stock_names)
+        except Exception:
+            return "Stock data not found. Please try again."
+
     # Example dummy function hard coded to trade a stock
     # with a specific action (buy or sell)
     def trade_stock(self, action, stock_name, price):